@@ -5,6 +5,7 @@ from flask import Blueprint
 
 app = Flask(__name__)
 config_name = os.environ.get('FLASK_CONFIG', 'development')
+app.config.from_pyfile(os.path.join(os.getcwd(), 'config', 'default.py'))
 cfg = os.path.join(os.getcwd(), 'config', config_name + '.py')
 app.config.from_pyfile(cfg)
 
@@ -1,6 +1,10 @@
-from flask import jsonify, request
+from flask import Response, jsonify, request
 from . import app, api
+from .exceptions import ValidationError
 from mesos import framework
+from mesos import index
+from mesos import metrics
+from mesos import utils
 import registry
 
 
@@ -11,9 +15,10 @@ def submit_cluster():
     if is_valid(request):
         data = request.get_json()
         clusterdn = data['clusterdn']
+        priority = priority_arg(data)
         app.logger.info('POST /clusters: {}'.format(clusterdn))
         cluster = registry.Cluster(clusterdn)
-        framework.submit(cluster)
+        framework.submit(cluster, priority)
         clusterid = registry.id_from(str(cluster))
         return jsonify({'message': 'Service instance queued',
                         'url': '/clusters/{}'.format(clusterid)}), 200
@@ -22,6 +27,25 @@ def submit_cluster():
         return jsonify({'error': 'Invalid json or missing clusterdn'}), 400
 
 
+@api.route('/clusters/bulk', methods=['POST'])
+def submit_clusters():
+    """Submit several cluster instances to Mesos in the background"""
+    data = request.get_json()
+    if not data or not isinstance(data.get('clusterdns'), list):
+        app.logger.warn('POST /clusters/bulk: Invalid request')
+        return jsonify({'error': 'Invalid json or missing clusterdns list'}), 400
+    clusterdns = data['clusterdns']
+    if not all(isinstance(clusterdn, basestring) for clusterdn in clusterdns):
+        raise ValidationError('clusterdns must be a list of strings')
+    priority = priority_arg(data)
+    app.logger.info('POST /clusters/bulk: {} clusters'.format(len(clusterdns)))
+    clusterids = framework.submit_many(clusterdns, priority)
+    return jsonify({'message': 'Service instances accepted',
+                    'clusters': [{'clusterdn': clusterdn,
+                                  'url': '/clusters/{}'.format(clusterid)}
+                                 for clusterdn, clusterid in zip(clusterdns, clusterids)]}), 202
+
+
 @api.route('/clusters/<clusterid>', methods=['DELETE'])
 def kill_cluster(clusterid):
     """Kill a cluster instance"""
@@ -34,8 +58,47 @@ def kill_cluster(clusterid):
 
 @api.route('/clusters', methods=['GET'])
 def list_clusters():
-    """Get a list of queued tasks"""
-    return jsonify({"queued_tasks": framework.pending()})
+    """Get a page of clusters, optionally only the ones with nodes in a given state"""
+    state = request.args.get('state')
+    limit = int_arg('limit', index.PAGE_SIZE)
+    cursor = int_arg('cursor', 0)
+    return jsonify(framework.clusters(state, limit, cursor))
+
+
+@api.route('/clusters/<clusterid>', methods=['GET'])
+def get_cluster(clusterid):
+    """Get the status of a cluster instance"""
+    status = framework.cluster(clusterid)
+    if status is None:
+        return jsonify({'status': 404, 'error': 'not found',
+                        'message': 'Unknown cluster {}'.format(clusterid)}), 404
+    return jsonify(status)
+
+
+@api.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Get the scheduler metrics in the Prometheus text format"""
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def int_arg(name, default):
+    """Get a non negative integer query string argument"""
+    value = request.args.get(name, default)
+    try:
+        value = int(value)
+    except ValueError:
+        raise ValidationError('{} must be an integer'.format(name))
+    if value < 0:
+        raise ValidationError('{} must not be negative'.format(name))
+    return value
+
+
+def priority_arg(data):
+    """Get the priority class of a submission, normal if not given"""
+    priority = data.get('priority', utils.NORMAL)
+    if priority not in utils.PRIORITIES:
+        raise ValidationError('priority must be one of: {}'.format(', '.join(utils.PRIORITIES)))
+    return priority
 
 
 def is_valid(request):
@@ -0,0 +1,350 @@
+"""Benchmarks of the offer handling hot path
+
+There are two suites:
+
+    micro: compares the current resource representations with the previous
+        dict-backed ones (reimplemented here as the baseline) and reports, per
+        operation, the time spent and the number of objects allocated.
+    scheduler: drives BigDataScheduler.resourceOffers with batches of
+        synthetic offers, a fake driver and the in-process registry and disks
+        service backends, and reports the offers handled and jobs placed per
+        second and the latency of the callback for several queue sizes.
+
+Run the micro-benchmarks from this directory with:
+
+    python benchmarks.py
+
+The scheduler uses package relative imports, so its suite is run from the
+root of the repository:
+
+    python -m app.mesos.benchmarks scheduler --jobs 1000 10000 --agents 50 200
+"""
+from __future__ import print_function
+
+import argparse
+import gc
+import logging
+import sys
+import time
+import uuid
+
+from mesos.interface import mesos_pb2
+
+import registry
+import placement
+import snapshot
+import utils
+
+OFFERS = 1000
+JOBS = 200
+
+# Defaults of the scheduler suite
+QUEUE_SIZES = (1000, 10000)
+AGENTS = (100,)
+# Offers received in each resourceOffers call
+BATCH = 10
+# Nodes of each synthetic cluster
+CLUSTER_SIZE = 4
+# Resources offered by each synthetic agent
+AGENT_CPUS = 32
+AGENT_MEM = 65536
+AGENT_DISKS = 12
+# Give up if the queue is not drained after offering every agent this many times
+MAX_ROUNDS = 1000
+
+
+class BaselineResources(object):
+    """Dict-backed resources, as used before slotted Resources"""
+    def __init__(self, cpus, mem, disks, host=None):
+        self.cpus = cpus
+        self.mem = mem
+        self.disks = disks
+        self.host = host
+
+
+def baseline_resources_from_offer(offer):
+    """Offer parser used before the single-pass one"""
+    disks = None
+    for resource in offer.resources:
+        if resource.name == "cpus":
+            cpus = resource.scalar.value
+        if resource.name == "mem":
+            mem = resource.scalar.value
+        if resource.name == "dataDisks":
+            disks = list(resource.set.item)
+    host = offer.hostname
+    return BaselineResources(cpus=cpus, mem=mem, disks=disks, host=host)
+
+
+def baseline_resources_from_job(job):
+    """Requirements built for every job/offer pair, as done before"""
+    return BaselineResources(cpus=job.cpus, mem=job.mem, disks=job.disks, host=job.host)
+
+
+def generate_offer(hostname, cpus=12, mem=8096, disks=('disk1', 'disk2', 'disk3')):
+    offer = mesos_pb2.Offer()
+    offer.id.value = str(uuid.uuid4())
+    offer.framework_id.value = 'PaaS'
+    offer.slave_id.value = hostname
+    offer.hostname = hostname
+
+    offer_cpus = offer.resources.add()
+    offer_cpus.name = "cpus"
+    offer_cpus.type = mesos_pb2.Value.SCALAR
+    offer_cpus.scalar.value = cpus
+
+    offer_mem = offer.resources.add()
+    offer_mem.name = "mem"
+    offer_mem.type = mesos_pb2.Value.SCALAR
+    offer_mem.scalar.value = mem
+
+    offer_disks = offer.resources.add()
+    offer_disks.name = "dataDisks"
+    offer_disks.type = mesos_pb2.Value.SET
+    for disk in disks:
+        offer_disks.set.item.append(disk)
+
+    return offer
+
+
+def generate_jobs(count, clusterdn='instances/bench/example/0.1.0/1'):
+    """Build jobs from an in-memory cluster definition"""
+    entries = {}
+    for i in range(count):
+        nodedn = '{}/nodes/node{}'.format(clusterdn, i)
+        entries[nodedn + '/cpu'] = str(1 + i % 4)
+        entries[nodedn + '/mem'] = str(1024 * (1 + i % 8))
+        entries[nodedn + '/disks/disk1/origin'] = ''
+    definition = snapshot.ClusterSnapshot(clusterdn, entries)
+    return [utils.Job(node, definition.view(node)) for node in definition.nodes]
+
+
+def measure(operation, items):
+    """Run operation over all the items
+
+    Returns the microseconds and the number of objects allocated per item.
+    The results are kept alive until the end so they are counted.
+    """
+    gc.collect()
+    gc.disable()
+    try:
+        before = len(gc.get_objects())
+        start = time.time()
+        results = [operation(item) for item in items]
+        elapsed = time.time() - start
+        allocated = len(gc.get_objects()) - before - 1
+    finally:
+        gc.enable()
+    del results
+    return elapsed / len(items) * 1e6, float(allocated) / len(items)
+
+
+def sizeof(obj):
+    """Bytes used by an object and its attribute dict, if any"""
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+
+def report(name, baseline, current):
+    print('{:<28} {:>12.2f} {:>12.2f} {:>14.2f} {:>14.2f}'.format(
+        name, baseline[0], current[0], baseline[1], current[1]))
+
+
+def micro():
+    offers = [generate_offer('c14-{}'.format(i)) for i in range(OFFERS)]
+    jobs = generate_jobs(JOBS)
+    pairs = [(offer, job) for offer in offers[:OFFERS // 10] for job in jobs]
+
+    print('{:<28} {:>12} {:>12} {:>14} {:>14}'.format(
+        '', 'base us/op', 'new us/op', 'base objs/op', 'new objs/op'))
+    report('parse offer',
+           measure(baseline_resources_from_offer, offers),
+           measure(utils.resources_from_offer, offers))
+
+    baseline_parsed = dict((offer.id.value, baseline_resources_from_offer(offer))
+                           for offer in offers)
+    parsed = dict((offer.id.value, utils.resources_from_offer(offer)) for offer in offers)
+
+    def baseline_fit(pair):
+        offer, job = pair
+        return utils.offer_has_enough_resources(baseline_parsed[offer.id.value],
+                                                baseline_resources_from_job(job))
+
+    def fit(pair):
+        offer, job = pair
+        return utils.offer_has_enough_resources(parsed[offer.id.value],
+                                                utils.resources_from_job(job))
+
+    def baseline_pair_requirements(pair):
+        return baseline_resources_from_job(pair[1])
+
+    report('job requirements per pair',
+           measure(baseline_pair_requirements, pairs),
+           measure(lambda pair: utils.resources_from_job(pair[1]), pairs))
+    report('fit check per pair', measure(baseline_fit, pairs), measure(fit, pairs))
+
+    print()
+    print('Bytes per Resources object: baseline={}, new={}'.format(
+        sizeof(BaselineResources(1, 1024, 1)), sizeof(utils.Resources(1, 1024, 1))))
+
+
+class FakeDriver(object):
+    """SchedulerDriver that only records the calls made by the scheduler"""
+
+    def __init__(self):
+        self.launched = 0
+        self.declined = 0
+        self.suppressed = 0
+        self.revived = 0
+
+    def launchTasks(self, offer_id, tasks, filters=None):
+        self.launched += len(tasks)
+
+    def declineOffer(self, offer_id, filters=None):
+        self.declined += 1
+
+    def suppressOffers(self):
+        self.suppressed += 1
+
+    def reviveOffers(self):
+        self.revived += 1
+
+    def reconcileTasks(self, statuses):
+        pass
+
+    def killTask(self, task_id):
+        pass
+
+
+def populate(kv, jobs, cluster_size=CLUSTER_SIZE):
+    """Store in kv the definitions of clusters with the given total of nodes
+
+    Returns the DNs of the clusters. All the keys written by the scheduler
+    are created in advance so the benchmark does not measure their insertion.
+    """
+    clusterdns = []
+    for i in range(0, jobs, cluster_size):
+        clusterdn = 'instances/bench/example/0.1.0/{}'.format(i // cluster_size)
+        for attr in ('status', 'progress', 'step'):
+            kv.set('{}/{}'.format(clusterdn, attr), '')
+        for j in range(min(cluster_size, jobs - i)):
+            nodedn = '{}/nodes/node{}'.format(clusterdn, j)
+            n = i + j
+            kv.set(nodedn + '/cpu', 1 + n % 4)
+            kv.set(nodedn + '/mem', 1024 * (1 + n % 4))
+            kv.set(nodedn + '/status', '')
+            for d in range(1 + n % 2):
+                kv.set('{}/disks/disk{}/origin'.format(nodedn, d + 1), '')
+        clusterdns.append(clusterdn)
+    return clusterdns
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+def run_scheduler(jobs, agents, batch=BATCH, policy=placement.BEST_FIT, gang=False,
+                  cluster_size=CLUSTER_SIZE):
+    """Queue the given number of jobs and offer the agents until all are placed
+
+    Every agent is offered with all its resources in each round, as if the
+    tasks launched in the previous round had already finished. Returns a dict
+    with the results.
+    """
+    # Imported here so the micro suite can still be run as a script
+    from app.mesos.scheduler import BigDataScheduler
+
+    executor = mesos_pb2.ExecutorInfo()
+    executor.executor_id.value = 'BenchmarkExecutor'
+    scheduler = BigDataScheduler(executor, policy=policy, gang=gang)
+    utils.connect_registry(utils.MEMORY)
+    utils.connect_disks_service(backend=utils.MEMORY)
+    driver = scheduler.driver = FakeDriver()
+
+    clusterdns = populate(registry._kv, jobs, cluster_size)
+    start = time.time()
+    for clusterdn in clusterdns:
+        scheduler.enqueue(registry.Cluster(clusterdn))
+    enqueue_time = time.time() - start
+
+    disks = ['disk{}'.format(d + 1) for d in range(AGENT_DISKS)]
+    hostnames = ['agent-{}'.format(i) for i in range(agents)]
+    latencies = []
+    offered = 0
+    rounds = 0
+    while len(scheduler.queue) and rounds < MAX_ROUNDS:
+        rounds += 1
+        # The tasks of the previous round are done and their disks free again
+        utils.disks_client.hosts.clear()
+        scheduler.inventory.clear()
+        for i in range(0, agents, batch):
+            # Mesos does not offer again the resources held in the offer pool
+            pooled = set(offer.hostname for offer in scheduler.pool.offers())
+            offers = [generate_offer(hostname, AGENT_CPUS, AGENT_MEM, disks)
+                      for hostname in hostnames[i:i + batch] if hostname not in pooled]
+            if not offers:
+                continue
+            start = time.time()
+            scheduler.resourceOffers(driver, offers)
+            latencies.append(time.time() - start)
+            offered += len(offers)
+            if not len(scheduler.queue):
+                break
+    scheduler.stop()
+    scheduler.writer.stop()
+
+    elapsed = sum(latencies)
+    return {
+        'jobs': jobs,
+        'agents': agents,
+        'enqueued_per_sec': jobs / enqueue_time,
+        'offers_per_sec': offered / elapsed,
+        'placed_per_sec': driver.launched / elapsed,
+        'placed': driver.launched,
+        'calls': len(latencies),
+        'p50_ms': percentile(latencies, 0.5) * 1e3,
+        'p99_ms': percentile(latencies, 0.99) * 1e3,
+    }
+
+
+def scheduler_suite(args):
+    logging.basicConfig(level=logging.WARNING)
+    print('policy={}, gang={}, batch={} offers, clusters of {} nodes'.format(
+        args.policy, args.gang, args.batch, args.cluster_size))
+    header = '{:>8} {:>7} {:>8} {:>11} {:>11} {:>11} {:>7} {:>9} {:>9}'
+    row = ('{jobs:>8} {agents:>7} {placed:>8} {enqueued_per_sec:>11.0f} {offers_per_sec:>11.0f} '
+           '{placed_per_sec:>11.0f} {calls:>7} {p50_ms:>9.2f} {p99_ms:>9.2f}')
+    print(header.format('jobs', 'agents', 'placed', 'enqueued/s', 'offers/s',
+                        'placed/s', 'calls', 'p50 ms', 'p99 ms'))
+    for jobs in args.jobs:
+        for agents in args.agents:
+            result = run_scheduler(jobs, agents, args.batch, args.policy, args.gang,
+                                   args.cluster_size)
+            print(row.format(**result))
+            sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of the offer handling hot path')
+    parser.add_argument('suite', nargs='?', default='micro', choices=('micro', 'scheduler'))
+    parser.add_argument('--jobs', type=int, nargs='+', default=QUEUE_SIZES,
+                        help='queue sizes of the scheduler suite')
+    parser.add_argument('--agents', type=int, nargs='+', default=AGENTS,
+                        help='number of agents offered in the scheduler suite')
+    parser.add_argument('--batch', type=int, default=BATCH,
+                        help='offers received in each resourceOffers call')
+    parser.add_argument('--policy', default=placement.BEST_FIT, choices=placement.POLICIES)
+    parser.add_argument('--gang', action='store_true', help='use gang scheduling')
+    parser.add_argument('--cluster-size', type=int, default=CLUSTER_SIZE)
+    args = parser.parse_args()
+    if args.suite == 'micro':
+        micro()
+    else:
+        scheduler_suite(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,20 +8,250 @@
 from __future__ import print_function
 
 import logging
+import os
 import sys
 import time
-from threading import Thread
+import threading
 import json
 import subprocess
+from collections import OrderedDict
 
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
 from mesos.interface import Executor, mesos_pb2
 from mesos.native import MesosExecutorDriver
 import registry
 
+# Maximum number of tasks being started (image pulled, container created) at
+# the same time, the containers already running are not counted
+WORKERS = int(os.environ.get('BIGDATA_EXECUTOR_WORKERS', 4))
+# Seconds the start of a task (pulling its image) can take before the task is
+# failed, 0 to wait forever. The running container is never timed out
+TASK_TIMEOUT = int(os.environ.get('BIGDATA_EXECUTOR_TASK_TIMEOUT', 0))
+# Maximum number of docker-executor destroy processes at the same time
+DESTROY_WORKERS = int(os.environ.get('BIGDATA_EXECUTOR_DESTROY_WORKERS', 8))
+# Seconds to wait for the containers to be destroyed
+DESTROY_TIMEOUT = int(os.environ.get('BIGDATA_EXECUTOR_DESTROY_TIMEOUT', 60))
+# Maximum number of images pulled in advance kept in the agent
+IMAGE_CACHE_SIZE = int(os.environ.get('BIGDATA_EXECUTOR_IMAGE_CACHE_SIZE', 20))
+# Minimum seconds between two progress messages sent to the scheduler
+PROGRESS_INTERVAL = float(os.environ.get('BIGDATA_EXECUTOR_PROGRESS_INTERVAL', 1))
+
+
+def send_status(driver, task_id, state, message=None):
+    """Send a status update of the given task"""
+    update = mesos_pb2.TaskStatus()
+    update.task_id.value = task_id
+    update.state = state
+    if message:
+        update.message = message
+    driver.sendStatusUpdate(update)
+
+
+def wait(process, timeout=None):
+    """Wait for a process, killing it after timeout seconds if given
+
+    Returns True if the process was killed because it timed out.
+    """
+    if timeout is None:
+        process.wait()
+        return False
+    expired = threading.Event()
+
+    def expire():
+        expired.set()
+        try:
+            process.kill()
+        except OSError:
+            # It has just finished
+            pass
+
+    timer = threading.Timer(timeout, expire)
+    timer.start()
+    try:
+        process.wait()
+    finally:
+        timer.cancel()
+    return expired.is_set()
+
+
+class PullTimeout(Exception):
+    pass
+
+
+class ProgressReporter(object):
+    """Sends the progress of the tasks to the scheduler, rate limited
+
+    Only the last phase reported of each task is kept and all the pending
+    phases are sent together, in at most one framework message every
+    `interval` seconds.
+    """
+    def __init__(self, interval=PROGRESS_INTERVAL):
+        self.interval = interval
+        self.driver = None
+        self.pending = {}
+        self.sent = 0
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def report(self, driver, task_id, phase):
+        """Record the current phase of a task"""
+        with self.lock:
+            self.driver = driver
+            self.pending[task_id] = phase
+            if self.timer is not None:
+                return
+            delay = self.sent + self.interval - time.time()
+            if delay > 0:
+                self.timer = threading.Timer(delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+                return
+        self.flush()
+
+    def discard(self, task_id):
+        """Drop the pending phase of a task, e.g. once it has ended"""
+        with self.lock:
+            self.pending.pop(task_id, None)
+
+    def flush(self):
+        """Send the pending phases now"""
+        with self.lock:
+            self.timer = None
+            if not self.pending:
+                return
+            tasks, self.pending = self.pending, {}
+            self.sent = time.time()
+            driver = self.driver
+        driver.sendFrameworkMessage(json.dumps({'type': 'progress', 'tasks': tasks}))
+
+    def stop(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+
+class ImageCache(object):
+    """LRU cache of the docker images available in the agent
+
+    Images hinted by the scheduler are pulled in the background, one at a
+    time. When there are more than `size` images the least recently used one
+    is removed. on_change is called with the list of cached images each time
+    it changes.
+    """
+    def __init__(self, size=IMAGE_CACHE_SIZE, on_change=None):
+        self.size = size
+        self.on_change = on_change
+        self.images = OrderedDict()
+        self.pulling = set()
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=1)
+
+    def prefetch(self, images):
+        """Pull in the background the given images if they are not cached"""
+        for image in images:
+            with self.lock:
+                if image in self.images or image in self.pulling:
+                    continue
+                self.pulling.add(image)
+            self.pool.submit(self.pull, image)
+
+    def cached(self, image):
+        with self.lock:
+            return image in self.images
+
+    def pull(self, image, timeout=None):
+        """Pull an image, returns True if it succeeded
+
+        Raises PullTimeout if it takes more than timeout seconds.
+        """
+        logging.info('docker pull {}'.format(image))
+        timed_out = False
+        try:
+            if timeout:
+                process = subprocess.Popen(['docker', 'pull', image])
+                timed_out = wait(process, timeout)
+                returncode = process.returncode
+            else:
+                returncode = subprocess.call(['docker', 'pull', image])
+        except OSError as e:
+            logging.error('Unable to run docker: {}'.format(e))
+            returncode = None
+        with self.lock:
+            self.pulling.discard(image)
+        if timed_out:
+            raise PullTimeout('docker pull {} timed out after {}s'.format(image, timeout))
+        if returncode == 0:
+            self.add(image)
+            return True
+        logging.error('Unable to pull {}, exit code {}'.format(image, returncode))
+        return False
+
+    def add(self, image):
+        """Record the image as the most recently used, evicting the oldest ones"""
+        evicted = []
+        with self.lock:
+            self.images.pop(image, None)
+            self.images[image] = True
+            while len(self.images) > self.size:
+                evicted.append(self.images.popitem(last=False)[0])
+            cached = list(self.images)
+        for old in evicted:
+            logging.info('docker rmi {}'.format(old))
+            try:
+                # It fails if a container still uses it, it is only best effort
+                subprocess.call(['docker', 'rmi', old])
+            except OSError as e:
+                logging.error('Unable to run docker: {}'.format(e))
+        if self.on_change is not None:
+            self.on_change(cached)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False)
+
 
 class BigDataExecutor(Executor):
-    def __init__(self):
+    """Executor that runs the containers of the tasks with docker-executor
+
+    Launched tasks wait in a FIFO queue until one of the workers is free, so
+    at most `workers` containers are started at the same time. A task is
+    TASK_STARTING when a worker picks it and TASK_RUNNING once its
+    docker-executor process is started. From then on the process, which lives
+    as long as the container, is watched by its own thread and the worker is
+    free to start the next task. Only the start is timed out.
+
+    Killed containers are destroyed in parallel by at most `destroy_workers`
+    processes, each task is reported as TASK_KILLED once its container is
+    destroyed.
+
+    The scheduler can send the images of the upcoming tasks so they are pulled
+    before the tasks arrive; the executor replies with the images cached.
+
+    While a task is starting its phase (pull, create) is sent to the scheduler
+    through a ProgressReporter.
+    """
+    def __init__(self, workers=WORKERS, timeout=TASK_TIMEOUT,
+                 destroy_workers=DESTROY_WORKERS, destroy_timeout=DESTROY_TIMEOUT,
+                 image_cache_size=IMAGE_CACHE_SIZE, progress_interval=PROGRESS_INTERVAL):
+        self.driver = None
+        self.images = ImageCache(image_cache_size, self.send_images)
+        self.progress = ProgressReporter(progress_interval)
         self.running_dockers = []
+        self.timeout = timeout
+        self.destroy_timeout = destroy_timeout
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.teardown = ThreadPoolExecutor(max_workers=destroy_workers)
+        # Futures of the tasks waiting for a worker by task id
+        self.queued = {}
+        # Ids of the tasks a worker is starting
+        self.starting = set()
+        # docker-executor run processes by node DN
+        self.processes = {}
+        # Threads watching the running processes by task id
+        self.watchers = {}
+        self.killed = set()
+        # A task is always either queued, running or done, never in between
+        self.lock = threading.Lock()
 
     def registered(self, driver, executor_info, framework_info, slave_info):
         """
@@ -30,6 +260,7 @@ class BigDataExecutor(Executor):
           executors through the FrameworkInfo.ExecutorInfo's data field.
         """
         logging.info('Executor registered')
+        self.driver = driver
 
     def reregistered(self, driver, slave_info):
         """
@@ -52,31 +283,99 @@ class BigDataExecutor(Executor):
           callbacks will be invoked on this executor until this callback has
           returned.
         """
-        # Tasks should always be run in their own thread or process.
-        def run_task():
-            logging.info("Running task: {}".format(task.task_id.value))
-            update = mesos_pb2.TaskStatus()
-            update.task_id.value = task.task_id.value
-            update.state = mesos_pb2.TASK_RUNNING
-            driver.sendStatusUpdate(update)
-
-            logging.info('Received task.data: {}'.format(task.data))
-            data = json.loads(task.data)
-            node_dn = data['node_dn']
+        # Tasks are run in the worker threads, in the order they are received
+        self.driver = driver
+        logging.info('Queueing task: {}'.format(task.task_id.value))
+        with self.lock:
+            self.queued[task.task_id.value] = self.pool.submit(self.run_task, driver, task)
+
+    def run_task(self, driver, task):
+        """Run the container of a task and report its progress"""
+        try:
+            self._run_task(driver, task)
+        except Exception as e:
+            # The pool would silently drop the exception
+            logging.exception('Task {} failed'.format(task.task_id.value))
+            send_status(driver, task.task_id.value, mesos_pb2.TASK_FAILED, str(e))
+        finally:
+            with self.lock:
+                self.starting.discard(task.task_id.value)
+            self.progress.discard(task.task_id.value)
+
+    def _run_task(self, driver, task):
+        task_id = task.task_id.value
+        logging.info('Received task.data: {}'.format(task.data))
+        data = json.loads(task.data)
+        node_dn = data['node_dn']
+        with self.lock:
+            self.queued.pop(task_id, None)
+            if task_id in self.killed:
+                return
+            logging.info("Running task: {}".format(task_id))
+            self.starting.add(task_id)
+            send_status(driver, task_id, mesos_pb2.TASK_STARTING)
+        image = data.get('image')
+        if image and not self.images.cached(image):
+            # Pulled here so it is cached and its progress is visible
+            self.progress.report(driver, task_id, 'pull')
+            try:
+                self.images.pull(image, self.timeout or None)
+            except PullTimeout as e:
+                logging.error('Task {} not started: {}'.format(task_id, e))
+                send_status(driver, task_id, mesos_pb2.TASK_FAILED, str(e))
+                return
+        with self.lock:
+            if task_id in self.killed:
+                return
+            self.progress.report(driver, task_id, 'create')
             logging.info('docker-executor run {}'.format(node_dn))
+            try:
+                process = subprocess.Popen(['docker-executor', 'run', node_dn])
+            except OSError as e:
+                logging.error('Unable to run docker-executor: {}'.format(e))
+                send_status(driver, task_id, mesos_pb2.TASK_FAILED,
+                            'Unable to run docker-executor: {}'.format(e))
+                return
+            self.processes[node_dn] = process
             self.running_dockers.append(node_dn)
-            subprocess.call(['docker-executor', 'run', node_dn])
+            self.starting.discard(task_id)
+            watcher = threading.Thread(target=self.watch, name='Task-{}'.format(task_id),
+                                       args=(driver, task_id, node_dn, process, image))
+            watcher.daemon = True
+            self.watchers[task_id] = watcher
+        send_status(driver, task_id, mesos_pb2.TASK_RUNNING)
+        watcher.start()
 
-            update = mesos_pb2.TaskStatus()
-            update.task_id.value = task.task_id.value
-            update.state = mesos_pb2.TASK_FINISHED
-            driver.sendStatusUpdate(update)
-            logging.info('Task finished, sent final status update.')
+    def watch(self, driver, task_id, node_dn, process, image):
+        """Wait for the docker-executor run process of a task and report its end"""
+        try:
+            self._watch(driver, task_id, node_dn, process, image)
+        except Exception as e:
+            logging.exception('Task {} failed'.format(task_id))
+            send_status(driver, task_id, mesos_pb2.TASK_FAILED, str(e))
+        finally:
+            with self.lock:
+                self.watchers.pop(task_id, None)
+
+    def _watch(self, driver, task_id, node_dn, process, image):
+        process.wait()
+        with self.lock:
+            self.processes.pop(node_dn, None)
             if node_dn in self.running_dockers:
                 self.running_dockers.remove(node_dn)
-
-        thread = Thread(target=run_task, args=())
-        thread.start()
+            if task_id in self.killed:
+                # Its status is sent once the container is destroyed
+                return
+        if process.returncode != 0:
+            logging.error('Task {} failed with exit code {}'.format(task_id, process.returncode))
+            send_status(driver, task_id, mesos_pb2.TASK_FAILED,
+                        'docker-executor run exited with code {}'.format(process.returncode))
+        else:
+            send_status(driver, task_id, mesos_pb2.TASK_FINISHED)
+            logging.info('Task finished, sent final status update.')
+            if image:
+                # docker-executor has pulled it if it was not already there
+                self.images.add(image)
 
     def killTask(self, driver, task_id):
         """
@@ -86,12 +385,72 @@ class BigDataExecutor(Executor):
           TaskStatus (i.e., with TASK_KILLED) and invoking ExecutorDriver's
           sendStatusUpdate.
         """
-        logging.warn('Killing task {}'.format(task_id.value))
-        node_dn = registry.dn_from(task_id.value)
+        task_id = task_id.value
+        logging.warn('Killing task {}'.format(task_id))
+        with self.lock:
+            self.killed.add(task_id)
+            queued = self.queued.pop(task_id, None)
+        if queued is not None:
+            # It never started, so there is no container to destroy
+            queued.cancel()
+            send_status(driver, task_id, mesos_pb2.TASK_KILLED)
+            return
+        # Destroyed in the background, the callback thread must not block
+        self.teardown.submit(self.destroy, driver, task_id,
+                             time.time() + self.destroy_timeout)
+
+    def destroy(self, driver, task_id, deadline):
+        """Destroy the container of a task and send its terminal status
+
+        Gives up when the deadline (a time.time() value) is reached.
+        """
+        try:
+            self._destroy(driver, task_id, deadline)
+        except Exception as e:
+            logging.exception('Unable to destroy task {}'.format(task_id))
+            send_status(driver, task_id, mesos_pb2.TASK_FAILED, str(e))
+
+    def _destroy(self, driver, task_id, deadline):
+        node_dn = registry.dn_from(task_id)
+        with self.lock:
+            process = self.processes.get(node_dn)
+        if process is not None:
+            # Stop starting the container before destroying it
+            try:
+                process.kill()
+            except OSError:
+                pass
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            logging.error('No time left to destroy {}'.format(node_dn))
+            send_status(driver, task_id, mesos_pb2.TASK_FAILED,
+                        'Container not destroyed before the deadline')
+            return
         logging.info('docker-executor destroy {}'.format(node_dn))
-        subprocess.call(['docker-executor', 'destroy', node_dn])
-        if node_dn in self.running_dockers:
-            self.running_dockers.remove(node_dn)
+        try:
+            destroyer = subprocess.Popen(['docker-executor', 'destroy', node_dn])
+        except OSError as e:
+            logging.error('Unable to run docker-executor: {}'.format(e))
+            send_status(driver, task_id, mesos_pb2.TASK_FAILED,
+                        'Unable to run docker-executor: {}'.format(e))
+            return
+        timed_out = wait(destroyer, remaining)
+        with self.lock:
+            if node_dn in self.running_dockers:
+                self.running_dockers.remove(node_dn)
+        if timed_out:
+            logging.error('Destroying {} timed out'.format(node_dn))
+            send_status(driver, task_id, mesos_pb2.TASK_FAILED,
+                        'docker-executor destroy timed out')
+        elif destroyer.returncode != 0:
+            logging.error('Unable to destroy {}, exit code {}'
+                          .format(node_dn, destroyer.returncode))
+            send_status(driver, task_id, mesos_pb2.TASK_FAILED,
+                        'docker-executor destroy exited with code {}'
+                        .format(destroyer.returncode))
+        else:
+            send_status(driver, task_id, mesos_pb2.TASK_KILLED)
+            logging.info('Task {} killed'.format(task_id))
 
     def frameworkMessage(self, driver, message):
         """
@@ -99,7 +458,28 @@ class BigDataExecutor(Executor):
           messages are best effort; do not expect a framework message to be
           retransmitted in any reliable fashion.
         """
-        pass
+        self.driver = driver
+        try:
+            data = json.loads(message)
+            kind = data['type']
+        except (ValueError, TypeError, KeyError):
+            logging.warn('Invalid framework message: {}'.format(message))
+            return
+        if kind == 'prefetch':
+            images = data.get('images')
+            if (not isinstance(images, list)
+                    or not all(isinstance(image, basestring) for image in images)):
+                logging.warn('Invalid framework message: {}'.format(message))
+                return
+            logging.info('Image hints received: {}'.format(images))
+            self.images.prefetch(images)
+        else:
+            logging.warn('Unknown framework message type: {}'.format(kind))
+
+    def send_images(self, images):
+        """Tell the scheduler which images are cached in this agent"""
+        if self.driver is not None:
+            self.driver.sendFrameworkMessage(json.dumps({'type': 'images', 'images': images}))
 
     def shutdown(self, driver):
         """
@@ -110,12 +490,28 @@ class BigDataExecutor(Executor):
           etc) a TASK_LOST status update will be created.
         """
         logging.info('Shutting down executor')
+        with self.lock:
+            queued = self.queued.items()
+            self.queued.clear()
+            running = [registry.id_from(node_dn) for node_dn in self.running_dockers]
+            # Their start is abandoned once the image is pulled
+            running.extend(self.starting)
+            self.killed.update(task_id for task_id, _ in queued)
+            self.killed.update(running)
+        for task_id, future in queued:
+            future.cancel()
+            send_status(driver, task_id, mesos_pb2.TASK_KILLED)
         logging.debug('List of running containers to stop: {}'.format(self.running_dockers))
-        for node_dn in self.running_dockers:
-            logging.info('docker-executor destroy {}'.format(node_dn))
-            # We must run in the background because in other case the script is killed
-            # before launching all the destroy processes
-            subprocess.Popen(['docker-executor', 'destroy', node_dn])
+        # We must wait because in other case the executor is killed before
+        # all the containers are destroyed
+        deadline = time.time() + self.destroy_timeout
+        wait_futures([self.teardown.submit(self.destroy, driver, task_id, deadline)
+                      for task_id in running])
+        logging.info('All containers destroyed')
+        self.pool.shutdown(wait=False)
+        self.teardown.shutdown(wait=False)
+        self.images.shutdown()
+        self.progress.stop()
 
     def error(self, error, message):
         """
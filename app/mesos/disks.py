@@ -0,0 +1,214 @@
+"""Disks service client
+
+All the requests share a requests.Session so the connections to the disks
+service are kept alive and reused. Every request has a timeout so a slow
+disks service can not stall the offer handling for long.
+"""
+from __future__ import print_function
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DISKS_ENDPOINT = 'http://disks.service.int.cesga.es:5000/resources/disks/v1'
+
+# Seconds to wait to connect and to receive a response
+TIMEOUT = (2, 5)
+# Maximum number of hosts allocated in parallel
+MAX_WORKERS = 8
+
+# Status of a disk that can be allocated
+FREE = 'free'
+# Status of a disk allocated to a node and of a broken disk
+USED = 'used'
+FAILED = 'failed'
+# Status of the disks that are known not to be allocatable
+UNAVAILABLE = frozenset([USED, FAILED])
+# Status codes of a disks service without bulk requests, any other error
+# (e.g. 404 for an unknown host) only concerns the request that got it
+BULK_UNSUPPORTED = (405, 501)
+
+
+class DiskServiceError(Exception):
+    pass
+
+
+class DisksClient(object):
+    """Client of the disks service
+
+    Allocations for different hosts are run in parallel using at most
+    max_workers threads. The disks of a host are allocated with a single bulk
+    request, falling back to one request per disk if the disks service does
+    not support it (it answers 405 or 501). Allocations and releases fall
+    back independently.
+    """
+    def __init__(self, endpoint=DISKS_ENDPOINT, timeout=TIMEOUT,
+                 max_workers=MAX_WORKERS):
+        self.endpoint = endpoint
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        # Whether bulk requests are supported, by disk status
+        self._bulk = {USED: True, FREE: True}
+        self._bulk_lock = threading.Lock()
+
+    def _request(self, method, path, **kwargs):
+        try:
+            with metrics.DISKS_SECONDS.time(method=method):
+                return self.session.request(method, self.endpoint + path,
+                                            timeout=self.timeout, **kwargs)
+        except requests.RequestException as e:
+            raise DiskServiceError('Unable to contact the disks service: {}'.format(e))
+
+    def get_disk_info(self, host, disk):
+        """Get disk info from the disks service"""
+        r = self._request('GET', '/{}/disks/{}'.format(host, disk))
+        if r.status_code == 200:
+            return r.json()[disk]
+        else:
+            raise DiskServiceError('Unable to get information from the disks service')
+
+    def get_host_disks(self, host, etag=None):
+        """Get the info of all the disks of a host by disk name
+
+        Returns a (disks, etag) tuple. If etag is given and the disks did not
+        change since then, disks is None.
+        """
+        headers = {'If-None-Match': etag} if etag else {}
+        r = self._request('GET', '/{}/disks'.format(host), headers=headers)
+        if r.status_code == 304:
+            return None, etag
+        if r.status_code == 200:
+            return r.json(), r.headers.get('ETag')
+        raise DiskServiceError('Unable to get the disks of {} from the disks service'
+                               .format(host))
+
+    def get_many_host_disks(self, hosts):
+        """Get the disks of the given (host, etag) pairs in parallel
+
+        Returns a list with the (disks, etag) tuple of each host, or the
+        error if the request failed, in the same order as the hosts.
+        """
+        futures = [self._executor.submit(self._get_host_disks, host, etag)
+                   for host, etag in hosts]
+        return [future.result() for future in futures]
+
+    def _get_host_disks(self, host, etag):
+        try:
+            return self.get_host_disks(host, etag)
+        except DiskServiceError as e:
+            return e
+
+    def set_disk_as_used(self, host, nodedn, disk):
+        """Set the disk as used in the disks service"""
+        payload = {'status': USED, 'clustername': nodedn, 'node': host}
+        r = self._request('PUT', '/{}/disks/{}'.format(host, disk), data=payload)
+        if r.status_code != 204:
+            raise DiskServiceError('Error setting disk as used in the disks service')
+
+    def set_disk_as_free(self, host, nodedn, disk):
+        """Set the disk used by the given node as free in the disks service"""
+        payload = {'status': FREE, 'clustername': nodedn, 'node': host}
+        r = self._request('PUT', '/{}/disks/{}'.format(host, disk), data=payload)
+        if r.status_code != 204:
+            raise DiskServiceError('Error setting disk as free in the disks service')
+
+    def _put_many(self, status, host, disks, nodedn):
+        """Set the status of all the given disks of a host with a single request
+
+        Returns False, without setting any disk, if the disks service does not
+        support bulk requests for that status.
+        """
+        with self._bulk_lock:
+            if not self._bulk[status]:
+                return False
+        payload = {'status': status, 'clustername': nodedn, 'node': host,
+                   'disks': ','.join(disks)}
+        r = self._request('PUT', '/{}/disks'.format(host), data=payload)
+        if r.status_code == 204:
+            return True
+        if r.status_code not in BULK_UNSUPPORTED:
+            raise DiskServiceError('Error setting disks as {} in the disks service'
+                                   .format(status))
+        with self._bulk_lock:
+            if self._bulk[status]:
+                logger.info('Bulk requests to set disks as {} not supported by the '
+                            'disks service, sending one per disk'.format(status))
+                self._bulk[status] = False
+        return False
+
+    def allocate(self, host, disks, nodedn):
+        """Set all the given disks of a host as used"""
+        if not disks or self._put_many(USED, host, disks, nodedn):
+            return
+        allocated = []
+        try:
+            for disk in disks:
+                self.set_disk_as_used(host, nodedn, disk)
+                allocated.append(disk)
+        except DiskServiceError:
+            # All or nothing, as the bulk allocation
+            for disk in allocated:
+                try:
+                    self.set_disk_as_free(host, nodedn, disk)
+                except DiskServiceError as e:
+                    logger.warn('Unable to release disk {} of {} after a failed '
+                                'allocation: {}'.format(disk, host, e))
+            raise
+
+    def release(self, host, disks, nodedn):
+        """Set all the given disks of a host used by the node as free"""
+        if not disks or self._put_many(FREE, host, disks, nodedn):
+            return
+        for disk in disks:
+            self.set_disk_as_free(host, nodedn, disk)
+
+    def allocate_many(self, allocations):
+        """Run the given (host, disks, nodedn) allocations in parallel by host
+
+        Returns a list with the error of each allocation or None if it
+        succeeded, in the same order as the allocations.
+        """
+        return self._run_many(self.allocate, allocations)
+
+    def release_many(self, releases):
+        """Run the given (host, disks, nodedn) releases in parallel by host
+
+        Returns a list with the error of each release or None if it
+        succeeded, in the same order as the releases.
+        """
+        return self._run_many(self.release, releases)
+
+    def _run_many(self, method, calls):
+        byhost = {}
+        for i, (host, disks, nodedn) in enumerate(calls):
+            byhost.setdefault(host, []).append((i, disks, nodedn))
+        futures = [self._executor.submit(self._run_host, method, host, pending)
+                   for host, pending in byhost.items()]
+        errors = [None] * len(calls)
+        for future in futures:
+            for i, error in future.result():
+                errors[i] = error
+        return errors
+
+    def _run_host(self, method, host, pending):
+        """Run sequentially the requests of a single host"""
+        results = []
+        for i, disks, nodedn in pending:
+            try:
+                method(host, disks, nodedn)
+                results.append((i, None))
+            except DiskServiceError as e:
+                results.append((i, e))
+        return results
@@ -5,22 +5,50 @@ from threading import Thread
 
 from mesos.interface import mesos_pb2
 from mesos.native import MesosSchedulerDriver
-from scheduler import BigDataScheduler
+from scheduler import BigDataScheduler, REFUSE_SECONDS
+import disks
+import index
+import ingest
+import inventory
+import journal
+import metrics
+import pool
+import reclaim
+import scoring
+import snapshot
+import txn
+import utils
 import registry
 
 logger = logging.getLogger(__name__)
 
 driver = None
 scheduler = None
+ingestor = None
 
 
-def submit(cluster):
-    """Submit a cluster instance to Mesos"""
-    scheduler.enqueue(cluster)
+def submit(cluster, priority=utils.NORMAL):
+    """Submit a cluster instance to Mesos with the given priority class"""
+    scheduler.enqueue(cluster, priority)
+
+
+def submit_many(clusterdns, priority=utils.NORMAL):
+    """Submit in the background the cluster instances with the given DNs
+
+    Returns the list of cluster ids, the state of each submission can be
+    obtained with submission().
+    """
+    return ingestor.accept(clusterdns, priority=priority)
+
+
+def submission(clusterid):
+    """Return the state of a background submission or None if unknown"""
+    return ingestor.state(clusterid)
 
 
 def kill(cluster):
     """Kill all the tasks of a given cluster"""
+    scheduler.kill(registry.id_from(str(cluster).strip('/')))
     for node in cluster.nodes:
         taskid = mesos_pb2.TaskID()
         taskid.value = registry.id_from(str(node))
@@ -34,9 +62,26 @@ def pending():
     return scheduler.pending()
 
 
-def start(master):
-    """Start the mesos framework"""
-    global driver, scheduler
+def clusters(state=None, limit=index.PAGE_SIZE, cursor=0):
+    """Return a page of the clusters with nodes in the given state"""
+    return scheduler.index.page(state, limit, cursor)
+
+
+def cluster(clusterid):
+    """Return the status of a cluster or None if it is unknown"""
+    status = scheduler.index.cluster(clusterid)
+    if status is None:
+        status = submission(clusterid)
+    return status
+
+
+def start(master, config=None):
+    """Start the mesos framework
+
+    config is a dict-like object (usually the Flask app.config) with the
+    scheduler settings, e.g. PLACEMENT_POLICY or GANG_SCHEDULING.
+    """
+    global driver, scheduler, ingestor
 
     if driver and scheduler:
         return driver, scheduler
@@ -52,7 +97,59 @@ def start(master):
     framework.name = 'PaaS'
     framework.checkpoint = True
 
-    scheduler = BigDataScheduler(executor)
+    config = config or {}
+    # The executor settings are passed in its environment
+    for name, key in (('BIGDATA_EXECUTOR_WORKERS', 'EXECUTOR_WORKERS'),
+                      ('BIGDATA_EXECUTOR_TASK_TIMEOUT', 'EXECUTOR_TASK_TIMEOUT'),
+                      ('BIGDATA_EXECUTOR_DESTROY_WORKERS', 'EXECUTOR_DESTROY_WORKERS'),
+                      ('BIGDATA_EXECUTOR_DESTROY_TIMEOUT', 'EXECUTOR_DESTROY_TIMEOUT'),
+                      ('BIGDATA_EXECUTOR_IMAGE_CACHE_SIZE', 'EXECUTOR_IMAGE_CACHE_SIZE'),
+                      ('BIGDATA_EXECUTOR_PROGRESS_INTERVAL', 'EXECUTOR_PROGRESS_INTERVAL')):
+        if key in config:
+            variable = executor.command.environment.variables.add()
+            variable.name = name
+            variable.value = str(config[key])
+    registry_backend = config.get('REGISTRY_BACKEND', utils.CONSUL)
+    registry_endpoint = config.get('REGISTRY_ENDPOINT', utils.ENDPOINT)
+    utils.connect_registry(registry_backend, registry_endpoint)
+    txn_endpoint = None
+    # Transactions are sent to Consul, the in-process store is written directly
+    if config.get('REGISTRY_TRANSACTIONS', False) and registry_backend == utils.CONSUL:
+        txn_endpoint = txn.txn_endpoint(registry_endpoint)
+    utils.connect_disks_service(
+        config.get('DISKS_ENDPOINT', utils.DISKS_ENDPOINT),
+        backend=config.get('DISKS_BACKEND', utils.HTTP),
+        timeout=config.get('DISKS_TIMEOUT', disks.TIMEOUT),
+        max_workers=config.get('DISKS_MAX_WORKERS', disks.MAX_WORKERS))
+    queue_journal = None
+    if config.get('JOURNAL_PATH'):
+        queue_journal = journal.Journal(
+            config['JOURNAL_PATH'],
+            compact_every=config.get('JOURNAL_COMPACT_EVERY', journal.COMPACT_EVERY))
+    scheduler = BigDataScheduler(
+        executor, policy=config.get('PLACEMENT_POLICY', 'first-fit'),
+        gang=config.get('GANG_SCHEDULING', False),
+        txn_endpoint=txn_endpoint,
+        snapshot_ttl=config.get('SNAPSHOT_TTL', snapshot.TTL),
+        refuse_seconds=config.get('OFFER_REFUSE_SECONDS', REFUSE_SECONDS),
+        journal=queue_journal,
+        aging=config.get('PRIORITY_AGING', utils.AGING),
+        backfill=config.get('BACKFILL_RESERVATION', True),
+        pool_size=config.get('OFFER_POOL_SIZE', pool.SIZE),
+        pool_window=config.get('OFFER_POOL_WINDOW', pool.WINDOW),
+        weights=config.get('PLACEMENT_WEIGHTS', scoring.WEIGHTS),
+        inventory_ttl=config.get('DISKS_INVENTORY_TTL', inventory.TTL),
+        retries=config.get('TASK_RETRIES', reclaim.RETRIES),
+        retry_backoff=config.get('TASK_RETRY_BACKOFF', reclaim.BACKOFF),
+        release_interval=config.get('DISKS_RELEASE_INTERVAL', reclaim.INTERVAL),
+        sweep_interval=config.get('DISKS_SWEEP_INTERVAL', reclaim.SWEEP_INTERVAL))
+    # Rebuild the queue left by the previous run before receiving offers
+    scheduler.restore()
+    metrics.JOBS.set_function(scheduler.index.counts)
+    metrics.QUEUE_LENGTH.set_function(lambda: len(scheduler.queue))
+    metrics.OFFER_POOL_SIZE.set_function(lambda: len(scheduler.pool))
+
+    ingestor = ingest.Ingestor(submit, workers=config.get('INGEST_WORKERS', ingest.WORKERS))
 
     implicitAcknowledgements = 1
 
@@ -88,8 +185,17 @@ def start(master):
 
 def stop():
     """Stop the framework"""
-    global driver, scheduler
+    global driver, scheduler, ingestor
     logger.info('Shutting down scheduler')
+    ingestor.stop()
+    # Release the pooled offers while the driver can still decline them
+    scheduler.stop()
     driver.stop()
+    logger.info('Flushing pending registry updates')
+    scheduler.writer.stop()
+    if scheduler.journal is not None:
+        scheduler.journal.compact()
+        scheduler.journal.close()
     driver = None
     scheduler = None
+    ingestor = None
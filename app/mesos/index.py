@@ -0,0 +1,150 @@
+"""In-memory index of the clusters known by the scheduler
+
+Keeps the state of each job (node) grouped by cluster, so the REST API can
+answer status queries without touching the job queue or the registry. The
+serialized views returned are cached and only rebuilt after the index
+changes, so frequent polling is cheap.
+
+Killed clusters are removed once their tasks end. Finished clusters are
+kept so their final state can still be queried, but only the most recent
+max_finished of them.
+"""
+from __future__ import print_function
+
+import threading
+from collections import OrderedDict
+
+# Default and maximum number of clusters returned in a page
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 1000
+# Maximum number of finished clusters kept, the oldest are forgotten first
+MAX_FINISHED = 10000
+
+
+class ClusterIndex(object):
+    """Index of job states by cluster id and of cluster ids by job state"""
+
+    def __init__(self, max_finished=MAX_FINISHED):
+        self.max_finished = max_finished
+        self._clusters = OrderedDict()
+        # Ids of the finished clusters, the oldest first
+        self._finished = OrderedDict()
+        # Number of jobs of each cluster in a given state
+        self._states = {}
+        self._lock = threading.Lock()
+        # Cached serialized views, dropped when they become stale
+        self._views = {}
+        self._pages = {}
+
+    def update(self, clusterid, jobname, state):
+        """Set the state of a job of the given cluster"""
+        with self._lock:
+            jobs = self._clusters.get(clusterid)
+            if jobs is None:
+                jobs = self._clusters[clusterid] = OrderedDict()
+            previous = jobs.get(jobname)
+            if previous == state:
+                return
+            # It is running again, e.g. a node was queued again
+            self._finished.pop(clusterid, None)
+            if previous is not None:
+                self._count(previous, clusterid, -1)
+            jobs[jobname] = state
+            self._count(state, clusterid, 1)
+            self._views.pop(clusterid, None)
+            self._pages.clear()
+
+    def remove(self, clusterid):
+        """Forget a cluster"""
+        with self._lock:
+            self._remove(clusterid)
+
+    def finish(self, clusterid):
+        """Record that none of the jobs of a cluster will run again
+
+        The oldest finished clusters are forgotten once there are more than
+        max_finished.
+        """
+        with self._lock:
+            if clusterid not in self._clusters:
+                return
+            self._finished.pop(clusterid, None)
+            self._finished[clusterid] = True
+            while len(self._finished) > self.max_finished:
+                self._remove(next(iter(self._finished)))
+
+    def _remove(self, clusterid):
+        self._finished.pop(clusterid, None)
+        for state in self._clusters.pop(clusterid, {}).itervalues():
+            self._count(state, clusterid, -1)
+        self._views.pop(clusterid, None)
+        self._pages.clear()
+
+    def _count(self, state, clusterid, increment):
+        clusters = self._states.get(state)
+        if clusters is None:
+            clusters = self._states[state] = OrderedDict()
+        count = clusters.get(clusterid, 0) + increment
+        if count > 0:
+            clusters[clusterid] = count
+        else:
+            del clusters[clusterid]
+            if not clusters:
+                del self._states[state]
+
+    def size(self, clusterid):
+        """Returns the number of jobs of a cluster"""
+        with self._lock:
+            return len(self._clusters.get(clusterid, ()))
+
+    def counts(self):
+        """Returns the number of jobs in each state"""
+        with self._lock:
+            return dict((state, sum(clusters.itervalues()))
+                        for state, clusters in self._states.iteritems())
+
+    def cluster(self, clusterid):
+        """Returns the serialized view of a cluster or None if it is unknown"""
+        with self._lock:
+            return self._view(clusterid)
+
+    def page(self, state=None, limit=PAGE_SIZE, cursor=0):
+        """Returns a page of clusters with at least one job in the given state
+
+        cursor is the position of the first cluster to return, the page
+        includes the cursor of the next page (None if it is the last one).
+        """
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        with self._lock:
+            key = (state, limit, cursor)
+            page = self._pages.get(key)
+            if page is None:
+                if state is None:
+                    clusterids = self._clusters.keys()
+                else:
+                    clusterids = self._states.get(state, {}).keys()
+                selected = clusterids[cursor:cursor + limit]
+                following = cursor + limit
+                page = self._pages[key] = {
+                    'clusters': [self._view(clusterid) for clusterid in selected],
+                    'total': len(clusterids),
+                    'next': following if following < len(clusterids) else None,
+                }
+            return page
+
+    def _view(self, clusterid):
+        view = self._views.get(clusterid)
+        if view is None:
+            jobs = self._clusters.get(clusterid)
+            if jobs is None:
+                return None
+            states = {}
+            for jobstate in jobs.itervalues():
+                states[jobstate] = states.get(jobstate, 0) + 1
+            view = self._views[clusterid] = {
+                'id': clusterid,
+                'url': '/clusters/{}'.format(clusterid),
+                'nodes': dict(jobs),
+                'states': states,
+            }
+        return view
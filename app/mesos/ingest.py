@@ -0,0 +1,78 @@
+"""Background ingestion of submitted clusters
+
+Enqueueing a cluster reads its definition from the registry and initializes
+the status of the cluster and its nodes, so it is too slow to be done while
+the client waits for the response of a bulk submission. The Ingestor accepts
+the cluster DNs right away and enqueues them from a small pool of worker
+threads, keeping track of the state of each submission.
+"""
+from __future__ import print_function
+
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import registry
+
+logger = logging.getLogger(__name__)
+
+# Number of clusters enqueued in parallel
+WORKERS = 4
+# Maximum number of submissions whose state is remembered
+MAX_TRACKED = 10000
+
+ACCEPTED = 'accepted'
+QUEUED = 'queued'
+FAILED = 'failed'
+
+
+class Ingestor(object):
+    """Enqueue clusters in the background using the given submit function"""
+
+    def __init__(self, submit, workers=WORKERS, max_tracked=MAX_TRACKED):
+        self.submit = submit
+        self.max_tracked = max_tracked
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    def accept(self, clusterdns, **options):
+        """Accept the given cluster DNs for submission
+
+        options are passed to the submit function, e.g. the priority.
+        Returns the ids of the clusters in the same order.
+        """
+        clusterids = []
+        for clusterdn in clusterdns:
+            # Same id as the scheduler, e.g. without a trailing slash
+            cluster = registry.Cluster(clusterdn)
+            clusterid = registry.id_from(str(cluster))
+            self._set_state(clusterid, {'state': ACCEPTED})
+            self._executor.submit(self._ingest, cluster, clusterid, options)
+            clusterids.append(clusterid)
+        return clusterids
+
+    def state(self, clusterid):
+        """Returns the state of the submission of the cluster or None"""
+        with self._lock:
+            return self._states.get(clusterid)
+
+    def stop(self):
+        """Wait for the accepted clusters to be enqueued"""
+        self._executor.shutdown(wait=True)
+
+    def _ingest(self, cluster, clusterid, options):
+        try:
+            self.submit(cluster, **options)
+            self._set_state(clusterid, {'state': QUEUED})
+        except Exception as e:
+            logger.exception('Unable to enqueue cluster {}'.format(cluster))
+            self._set_state(clusterid, {'state': FAILED, 'error': str(e)})
+
+    def _set_state(self, clusterid, state):
+        with self._lock:
+            self._states.pop(clusterid, None)
+            self._states[clusterid] = state
+            while len(self._states) > self.max_tracked:
+                self._states.popitem(last=False)
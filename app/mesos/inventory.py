@@ -0,0 +1,127 @@
+"""In-memory inventory of the disks of each host
+
+Allocating a disk that is already used or has failed is only detected when
+the disks service rejects the allocation, and then the whole offer is lost.
+The DiskInventory keeps the status of the disks of the offered hosts, read
+from the disks service in bulk and refreshed once it is older than ttl
+seconds (revalidated with an ETag, so unchanged hosts are cheap), so those
+disks are left out before placing any job. The scheduler refreshes it before
+taking the placement lock, the placement rounds only read what is cached.
+"""
+from __future__ import print_function
+
+import logging
+import threading
+import time
+
+import disks
+import metrics
+import utils
+
+logger = logging.getLogger(__name__)
+
+# Seconds the disks of a host are used before reading them again
+TTL = 30
+
+
+class HostDisks(object):
+    """Status of the disks of a host by disk name, as last read"""
+    __slots__ = ('disks', 'etag', 'timestamp')
+
+    def __init__(self, disks, etag, timestamp):
+        self.disks = disks
+        self.etag = etag
+        self.timestamp = timestamp
+
+
+class DiskInventory(object):
+    """Cache of the disks of each host, read from utils.disks_client"""
+
+    def __init__(self, ttl=TTL):
+        self.ttl = ttl
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def refresh(self, hosts, now=None):
+        """Read in a single batch the disks of the given hosts that are stale
+
+        Hosts that can not be read keep their last known disks, or none if
+        they were unknown, and are not read again until ttl seconds later.
+        """
+        now = now or time.time()
+        with self._lock:
+            stale = []
+            for host in set(hosts):
+                entry = self._hosts.get(host)
+                if entry is None or now - entry.timestamp >= self.ttl:
+                    stale.append((host, entry.etag if entry is not None else None))
+        if not stale:
+            return
+        results = utils.disks_client.get_many_host_disks(stale)
+        with self._lock:
+            for (host, etag), result in zip(stale, results):
+                if isinstance(result, Exception):
+                    logger.warn('Unable to read the disks of {}: {}'.format(host, result))
+                    metrics.DISK_INVENTORY.inc(result='error')
+                    entry = self._hosts.get(host)
+                    if entry is None:
+                        entry = self._hosts[host] = HostDisks({}, None, now)
+                    entry.timestamp = now
+                    continue
+                info, etag = result
+                entry = self._hosts.get(host)
+                if info is None and entry is not None:
+                    metrics.DISK_INVENTORY.inc(result='not_modified')
+                    entry.timestamp = now
+                    continue
+                metrics.DISK_INVENTORY.inc(result='refreshed')
+                statuses = dict((name, disk.get('status'))
+                                for name, disk in (info or {}).iteritems())
+                self._hosts[host] = HostDisks(statuses, etag, now)
+
+    def unavailable(self, hosts):
+        """Returns the disks that can not be allocated of each given host
+
+        Disks are unavailable if they are used or failed in the disks
+        service, disks with any other status are left to the allocation.
+        Unknown hosts have no unavailable disks.
+        """
+        with self._lock:
+            unavailable = {}
+            for host in hosts:
+                entry = self._hosts.get(host)
+                if entry is None:
+                    continue
+                names = set(name for name, status in entry.disks.iteritems()
+                            if status in disks.UNAVAILABLE)
+                if names:
+                    unavailable[host] = names
+            return unavailable
+
+    def used(self, host, names):
+        """Record disks just allocated, they are unavailable until read again"""
+        with self._lock:
+            entry = self._hosts.get(host)
+            if entry is None:
+                return
+            for name in names:
+                entry.disks[name] = disks.USED
+
+    def released(self, host, names):
+        """Record disks just released, they can be allocated again"""
+        with self._lock:
+            entry = self._hosts.get(host)
+            if entry is None:
+                return
+            for name in names:
+                entry.disks[name] = disks.FREE
+
+    def invalidate(self, host):
+        """Forget the disks of a host so they are read in the next refresh"""
+        with self._lock:
+            self._hosts.pop(host, None)
+
+    def clear(self):
+        """Forget the disks of all the hosts"""
+        with self._lock:
+            self._hosts.clear()
@@ -0,0 +1,149 @@
+"""Local journal of the job queue
+
+The job queue only lives in memory, so the events that change it (a job is
+enqueued, removed or launched, a launched task finishes) are appended to a
+local file, one JSON object per line. When the scheduler restarts the
+journal is replayed to rebuild the queue without reading anything from the
+registry.
+
+To keep the replay fast the journal is periodically compacted: the current
+state is written to a snapshot file and the journal is truncated.
+"""
+from __future__ import print_function
+
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Number of events appended between compactions
+COMPACT_EVERY = 10000
+
+
+class Journal(object):
+    """Append-only journal of queue events with snapshot compaction
+
+    Besides writing the events, the journal keeps in memory the state they
+    describe: the records of the queued jobs and of the launched jobs whose
+    task has not finished yet.
+    """
+
+    def __init__(self, path, compact_every=COMPACT_EVERY):
+        self.path = path
+        self.snapshot_path = path + '.snapshot'
+        self.compact_every = compact_every
+        self.queued = OrderedDict()
+        self.running = OrderedDict()
+        self._lock = threading.Lock()
+        self._events = 0
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._file = None
+
+    def replay(self):
+        """Load the snapshot and the events appended after it
+
+        Returns the (queued, running) job records, both are ordered dicts
+        keyed by job name.
+        """
+        with self._lock:
+            self.queued = OrderedDict()
+            self.running = OrderedDict()
+            if os.path.exists(self.snapshot_path):
+                with open(self.snapshot_path) as f:
+                    state = json.load(f)
+                for record in state['queued']:
+                    self.queued[record['name']] = record
+                for record in state['running']:
+                    self.running[record['name']] = record
+            self._events = 0
+            if os.path.exists(self.path):
+                with open(self.path) as f:
+                    for line in f:
+                        try:
+                            event = json.loads(line)
+                        except ValueError:
+                            # A partially written last line after a crash
+                            logger.warn('Ignoring corrupted journal entry: {}'.format(line))
+                            continue
+                        self._apply(event)
+                        self._events += 1
+            return self.queued, self.running
+
+    def enqueued(self, jobs, total):
+        """Append the new queued jobs of a cluster with total nodes"""
+        self._append([{'op': 'enqueue', 'job': dict(job.to_record(), total=total)}
+                      for job in jobs])
+
+    def removed(self, jobs):
+        """Append the removal of queued jobs that will not be launched"""
+        self._append([{'op': 'remove', 'name': job.name} for job in jobs])
+
+    def launched(self, jobs):
+        """Append the launch of queued jobs in the agents and disks assigned to them"""
+        self._append([{'op': 'launch', 'name': job.name, 'slave_id': job.slave_id,
+                       'hostname': job.hostname, 'allocated': job.disks} for job in jobs])
+
+    def finished(self, name):
+        """Append that a launched task reached a terminal state"""
+        self._append([{'op': 'finish', 'name': name}])
+
+    def compact(self):
+        """Write the current state to the snapshot and truncate the journal"""
+        with self._lock:
+            self._compact()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _append(self, events):
+        if not events:
+            return
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'a')
+            for event in events:
+                self._apply(event)
+                self._file.write(json.dumps(event) + '\n')
+            self._file.flush()
+            self._events += len(events)
+            if self._events >= self.compact_every:
+                self._compact()
+
+    def _apply(self, event):
+        op = event['op']
+        if op == 'enqueue':
+            record = event['job']
+            self.queued[record['name']] = record
+        elif op == 'remove':
+            self.queued.pop(event['name'], None)
+        elif op == 'launch':
+            record = self.queued.pop(event['name'], None)
+            if record is not None:
+                record = dict(record, slave_id=event['slave_id'],
+                              hostname=event['hostname'], allocated=event.get('allocated'))
+                self.running[record['name']] = record
+        elif op == 'finish':
+            self.running.pop(event['name'], None)
+
+    def _compact(self):
+        state = {'queued': self.queued.values(), 'running': self.running.values()}
+        tmp = self.snapshot_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.snapshot_path)
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self.path, 'w')
+        self._events = 0
+        logger.info('Journal compacted: {} queued jobs, {} running tasks'
+                    .format(len(self.queued), len(self.running)))
@@ -0,0 +1,214 @@
+"""In-process registry and disks service backends
+
+MemoryKV replaces the kvstore.Client used by the registry library and
+MemoryDisksClient replaces the DisksClient, so the scheduler can run without
+Consul or the disks service, e.g. in tests, benchmarks or local load runs.
+They are selected with the REGISTRY_BACKEND and DISKS_BACKEND settings.
+"""
+from __future__ import print_function
+
+import bisect
+import itertools
+import threading
+
+import kvstore
+
+from disks import DiskServiceError, FREE, USED
+
+
+class MemoryKV(object):
+    """Dict-backed key/value store with the interface of kvstore.Client
+
+    Keys are also kept sorted so recurse only visits the requested subtree.
+    Values are stored as strings, as Consul does.
+    """
+
+    def __init__(self, entries=None):
+        self.data = {}
+        self.keys = []
+        self._index = 0
+        self._lock = threading.Lock()
+        for k, v in (entries or {}).iteritems():
+            self.set(k, v)
+
+    def set(self, k, v):
+        k = k.lstrip('/')
+        with self._lock:
+            if k not in self.data:
+                bisect.insort(self.keys, k)
+            self.data[k] = str(v)
+            self._index += 1
+
+    def get(self, k, wait=False, wait_index=False, timeout='5m'):
+        k = k.lstrip('/')
+        try:
+            return self.data[k]
+        except KeyError:
+            raise kvstore.KeyDoesNotExist('Key ' + k + ' does not exist')
+
+    def recurse(self, k, wait=False, wait_index=None, timeout='5m'):
+        k = k.lstrip('/')
+        entries = {}
+        with self._lock:
+            start = bisect.bisect_left(self.keys, k)
+            for key in itertools.islice(self.keys, start, None):
+                if not key.startswith(k):
+                    break
+                entries[key] = self.data[key]
+        if not entries:
+            raise kvstore.KeyDoesNotExist('Key ' + k + ' does not exist')
+        return entries
+
+    def index(self, k, recursive=False):
+        return str(self._index)
+
+    def delete(self, k, recursive=False):
+        k = k.lstrip('/')
+        with self._lock:
+            if recursive:
+                start = bisect.bisect_left(self.keys, k)
+                end = start
+                while end < len(self.keys) and self.keys[end].startswith(k):
+                    del self.data[self.keys[end]]
+                    end += 1
+                del self.keys[start:end]
+            elif self.data.pop(k, None) is not None:
+                del self.keys[bisect.bisect_left(self.keys, k)]
+            self._index += 1
+
+
+class MemoryDisksClient(object):
+    """In-process disks service with the interface of disks.DisksClient
+
+    Hosts and disks can be registered with add_host, in other case they are
+    registered as free the first time they are used.
+    """
+
+    def __init__(self):
+        self.hosts = {}
+        # Incremented on every change of the disks of a host, used as ETag
+        self.versions = {}
+        self._lock = threading.Lock()
+
+    def add_host(self, host, disks):
+        """Register the given free disks of a host"""
+        with self._lock:
+            for disk in disks:
+                self._disk(host, disk)
+
+    def _disk(self, host, disk):
+        disks = self.hosts.setdefault(host, {})
+        info = disks.get(disk)
+        if info is None:
+            number = disk.replace('disk', '')
+            info = disks[disk] = {'name': disk, 'node': host, 'status': FREE,
+                                  'clustername': None, 'path': '/data/{}'.format(number)}
+            self._changed(host)
+        return info
+
+    def _changed(self, host):
+        self.versions[host] = self.versions.get(host, 0) + 1
+
+    def set_status(self, host, disk, status):
+        """Change the status of a disk, e.g. to mark it as failed"""
+        with self._lock:
+            self._disk(host, disk)['status'] = status
+            self._changed(host)
+
+    def get_disk_info(self, host, disk):
+        """Get disk info"""
+        with self._lock:
+            return dict(self._disk(host, disk))
+
+    def get_host_disks(self, host, etag=None):
+        """Get the info of all the disks of a host and its etag"""
+        with self._lock:
+            current = str(self.versions.get(host, 0))
+            if etag == current:
+                return None, etag
+            return (dict((name, dict(info)) for name, info in self.hosts.get(host, {}).items()),
+                    current)
+
+    def get_many_host_disks(self, hosts):
+        """Get the disks of the given (host, etag) pairs"""
+        return [self.get_host_disks(host, etag) for host, etag in hosts]
+
+    def set_disk_as_used(self, host, nodedn, disk):
+        """Set the disk as used by the given node"""
+        with self._lock:
+            self._use(host, nodedn, disk)
+
+    def _check(self, host, nodedn, disk):
+        info = self._disk(host, disk)
+        if info['status'] == USED and info['clustername'] != nodedn:
+            raise DiskServiceError('Disk {} of {} already used by {}'
+                                   .format(disk, host, info['clustername']))
+        if info['status'] not in (FREE, USED):
+            raise DiskServiceError('Disk {} of {} is {}'.format(disk, host, info['status']))
+        return info
+
+    def _use(self, host, nodedn, disk):
+        info = self._check(host, nodedn, disk)
+        info['status'] = USED
+        info['clustername'] = nodedn
+        self._changed(host)
+
+    def allocate(self, host, disks, nodedn):
+        """Set all the given disks of a host as used, or none of them"""
+        with self._lock:
+            for disk in disks:
+                self._check(host, nodedn, disk)
+            for disk in disks:
+                self._use(host, nodedn, disk)
+
+    def set_disk_as_free(self, host, nodedn, disk):
+        """Set the disk used by the given node as free"""
+        with self._lock:
+            self._free(host, nodedn, disk)
+
+    def _free(self, host, nodedn, disk):
+        info = self._disk(host, disk)
+        if info['status'] != USED:
+            return
+        if info['clustername'] != nodedn:
+            raise DiskServiceError('Disk {} of {} is used by {}, not by {}'
+                                   .format(disk, host, info['clustername'], nodedn))
+        info['status'] = FREE
+        info['clustername'] = None
+        self._changed(host)
+
+    def release(self, host, disks, nodedn):
+        """Set all the given disks of a host used by the node as free"""
+        with self._lock:
+            for disk in disks:
+                self._free(host, nodedn, disk)
+
+    def release_many(self, releases):
+        """Run the given (host, disks, nodedn) releases
+
+        Returns a list with the error of each release or None if it
+        succeeded, in the same order as the releases.
+        """
+        errors = []
+        for host, disks, nodedn in releases:
+            try:
+                self.release(host, disks, nodedn)
+                errors.append(None)
+            except DiskServiceError as e:
+                errors.append(e)
+        return errors
+
+    def allocate_many(self, allocations):
+        """Run the given (host, disks, nodedn) allocations
+
+        Returns a list with the error of each allocation or None if it
+        succeeded, in the same order as the allocations.
+        """
+        errors = []
+        for host, disks, nodedn in allocations:
+            try:
+                self.allocate(host, disks, nodedn)
+                errors.append(None)
+            except DiskServiceError as e:
+                errors.append(e)
+        return errors
@@ -0,0 +1,187 @@
+"""Scheduler metrics in the Prometheus text exposition format
+
+Metrics are plain in-process counters, histograms and gauges registered in a
+module level registry when they are created, render() returns all of them in
+the format scraped by Prometheus:
+
+    https://prometheus.io/docs/instrumenting/exposition_formats/
+"""
+from __future__ import print_function
+
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the buckets of the latency histograms
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Buckets of the job latencies, from submission to launch and to running
+JOB_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+REGISTRY = []
+
+
+def render():
+    """Returns the text exposition of all the registered metrics"""
+    lines = []
+    for metric in REGISTRY:
+        lines.append('# HELP {} {}'.format(metric.name, metric.help))
+        lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+        lines.extend(metric.samples())
+    return '\n'.join(lines) + '\n'
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, escape(value))
+                          for name, value in pairs) + '}'
+
+
+def escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric(object):
+    """Base class of the metrics, values are stored by label values"""
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.labelnames)
+
+
+class Counter(Metric):
+    """Value that only goes up, e.g. the number of offers received"""
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return ['{}{} {}'.format(self.name, format_labels(self.labelnames, key),
+                                 format_value(value))
+                for key, value in values]
+
+
+class Histogram(Metric):
+    """Distribution of observed values, e.g. latencies, in cumulative buckets"""
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=BUCKETS):
+        super(Histogram, self).__init__(name, help, labelnames)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # One count per bucket followed by the sum of the values
+                counts = self._values[key] = [0] * len(self.buckets) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the seconds spent running the block"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def count(self, **labels):
+        counts = self._values.get(self._key(labels))
+        return sum(counts[:-1]) if counts else 0
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, list(counts)) for key, counts in self._values.items())
+        samples = []
+        for key, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append('{}_bucket{} {}'.format(
+                    self.name,
+                    format_labels(self.labelnames, key, [('le', format_value(bound))]),
+                    cumulative))
+            labels = format_labels(self.labelnames, key)
+            samples.append('{}_sum{} {}'.format(self.name, labels, format_value(counts[-1])))
+            samples.append('{}_count{} {}'.format(self.name, labels, cumulative))
+        return samples
+
+
+class Gauge(Metric):
+    """Value read when the metrics are rendered, e.g. the queue length
+
+    The function set with set_function returns the value, or a dict with the
+    value for each label value (a tuple of them if there are several labels).
+    """
+    type = 'gauge'
+
+    def __init__(self, name, help, labelnames=()):
+        super(Gauge, self).__init__(name, help, labelnames)
+        self.function = None
+
+    def set_function(self, function):
+        self.function = function
+
+    def samples(self):
+        if self.function is None:
+            return []
+        values = self.function()
+        if not isinstance(values, dict):
+            values = {(): values}
+        samples = []
+        for key, value in sorted(values.items()):
+            if not isinstance(key, tuple):
+                key = (key,)
+            samples.append('{}{} {}'.format(self.name, format_labels(self.labelnames, key),
+                                            format_value(value)))
+        return samples
+
+
+OFFERS = Counter('scheduler_offers_total',
+                 'Offers received, declined and used to launch tasks', ['result'])
+RESOURCE_OFFERS_SECONDS = Histogram('scheduler_resource_offers_seconds',
+                                    'Time spent handling each resourceOffers call')
+DISKS_SECONDS = Histogram('scheduler_disks_request_seconds',
+                          'Time spent in requests to the disks service', ['method'])
+REGISTRY_SECONDS = Histogram('scheduler_registry_request_seconds',
+                             'Time spent reading and writing the registry', ['operation'])
+DISK_INVENTORY = Counter('scheduler_disk_inventory_reads_total',
+                         'Reads of the disks of a host by the disk inventory', ['result'])
+JOBS = Gauge('scheduler_jobs', 'Number of jobs in each state', ['state'])
+QUEUE_LENGTH = Gauge('scheduler_queue_length', 'Number of jobs waiting in the queue')
+OFFER_POOL_SIZE = Gauge('scheduler_offer_pool_size', 'Number of unused offers kept in the pool')
+SUBMIT_TO_LAUNCH_SECONDS = Histogram('scheduler_submit_to_launch_seconds',
+                                     'Time from the submission of a job to its launch',
+                                     buckets=JOB_BUCKETS)
+LAUNCH_TO_RUNNING_SECONDS = Histogram('scheduler_launch_to_running_seconds',
+                                      'Time from the launch of a task until it is running',
+                                      buckets=JOB_BUCKETS)
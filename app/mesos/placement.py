@@ -0,0 +1,272 @@
+"""Placement of queued jobs into a batch of Mesos offers
+
+Instead of deciding offer by offer, all the offers received in a single
+resourceOffers call are considered together. Jobs are visited in the order
+the queue serves them (by priority, then FIFO) and each one is assigned to
+one of the offers it fits in according to the selected bin-packing policy:
+
+    first-fit: the first offer (in the order received) with enough resources
+    best-fit: the offer that would be left with the least free resources
+    worst-fit: the offer that would be left with the most free resources
+
+In gang mode all the queued jobs of a cluster are placed together or none of
+them is: if one of them does not fit, the resources tentatively assigned to
+the rest of the cluster are returned to the offers.
+
+If a scoring.Scoring is given, among the offers a job fits in the ones with
+the highest score are preferred and the policy only breaks the ties. The
+disks of an offer are then also taken least used first.
+
+Backfill follows EASY: the job at the head of the queue can hold a
+reservation on an agent. If it does not fit in any offer, the resources it
+needs are kept free in the offers of that agent, so later jobs can only use
+the rest of those offers and never delay the head job. Later jobs use the
+offers of the other agents freely. There is no reservation in gang mode: it
+would only hold the resources of the head job, not the ones of the rest of
+its cluster, so the gang could still be delayed forever.
+"""
+from collections import OrderedDict
+
+import utils
+
+FIRST_FIT = 'first-fit'
+BEST_FIT = 'best-fit'
+WORST_FIT = 'worst-fit'
+
+POLICIES = (FIRST_FIT, BEST_FIT, WORST_FIT)
+
+# Scores closer than this are considered a tie
+EPSILON = 1e-9
+
+
+class Plan(object):
+    """Launch plan for a single offer
+
+    Contains the following fields:
+        offer: the mesos_pb2.Offer
+        offered: the resources initially available in the offer
+        available: the resources still free after the assignments
+        assignments: list of (job, disks) tuples to launch in this offer
+        usage: number of times each disk of the agent was allocated, if known
+
+    Offered disks in excluded (e.g. known to be used or failed in the disks
+    service) are left out of the plan.
+    """
+    def __init__(self, offer, usage=None, excluded=None):
+        self.offer = offer
+        self.usage = usage
+        self.offered = utils.resources_from_offer(offer)
+        if excluded and self.offered.disks is not None:
+            self.offered.disks = [disk for disk in self.offered.disks if disk not in excluded]
+        self.available = self.offered.copy()
+        self.assignments = []
+        # Job whose resources must be kept free in this offer
+        self.reserved = None
+
+    def fits(self, job):
+        """Verify if the job fits in the remaining resources of the offer"""
+        if self.reserved is not None and job is not self.reserved:
+            return utils.offer_has_enough_resources(self.backfill(), job.required)
+        return utils.offer_has_enough_resources(self.available, job.required)
+
+    def backfill(self):
+        """Resources left after keeping free the ones of the reserved job"""
+        reserved = self.reserved
+        disks = self.available.disks
+        if disks is not None:
+            kept = utils.select_disks(disks, reserved.disks)
+            disks = [disk for disk in disks if disk not in kept]
+        return utils.Resources(self.available.cpus - reserved.cpus,
+                               self.available.mem - reserved.mem,
+                               disks, self.available.host)
+
+    def assign(self, job):
+        """Reserve the resources needed by the job in this offer"""
+        disks = utils.select_disks(self.available.disks, job.disks, self.usage)
+        self.available.cpus -= job.cpus
+        self.available.mem -= job.mem
+        self.available.disks = utils.remove_disks(self.available.disks, disks)
+        self.assignments.append((job, disks))
+        return disks
+
+    def unassign(self, job):
+        """Return the resources reserved for the job to the offer"""
+        for i, (assigned, disks) in enumerate(self.assignments):
+            if assigned is job:
+                del self.assignments[i]
+                self.available.cpus += job.cpus
+                self.available.mem += job.mem
+                self.available.disks.extend(disks)
+                return
+
+    def leftover(self, job):
+        """Fraction of the offer that would remain free after assigning the job"""
+        return (_fraction(self.available.cpus - job.cpus, self.offered.cpus) +
+                _fraction(self.available.mem - job.mem, self.offered.mem))
+
+
+def _fraction(value, total):
+    if not total:
+        return 0.0
+    return float(value) / total
+
+
+def place(offers, queue, policy=FIRST_FIT, gang=False, scoring=None, reservation=None,
+          unavailable=None):
+    """Compute a global assignment of the queued jobs to the given offers
+
+    scoring is an optional scoring.Scoring to rank the offers a job fits in,
+    unavailable an optional dict with the disks of each hostname that can
+    not be allocated even if offered, and reservation an optional
+    (job, hostname) pair with the head of the queue and its reserved agent,
+    ignored in gang mode.
+    The queue itself is not modified. Returns one Plan per offer, in the
+    same order as the offers were received.
+    """
+    if policy not in POLICIES:
+        raise ValueError('Unknown placement policy: {}'.format(policy))
+    usage = scoring.disk_usage if scoring is not None else {}
+    unavailable = unavailable or {}
+    plans = [Plan(offer, usage.get(offer.hostname), unavailable.get(offer.hostname))
+             for offer in offers]
+    jobs = candidates(plans, queue)
+    if reservation is not None and not gang:
+        jobs = place_head(plans, jobs, reservation, policy, scoring)
+    if not jobs:
+        return plans
+    # Jobs are skipped without looking at each offer if they are bigger than
+    # the largest one, and once the smallest job does not fit we are done
+    smallest = (min(job.cpus for job in jobs), min(job.mem for job in jobs),
+                min(utils.shape_of(job)[2] for job in jobs))
+    largest = bounds(plans)
+    visited = set()
+    # Offers only shrink during a round, so a gang with the same requirements
+    # as one that did not fit is not tried again
+    failed = set()
+    for job in jobs:
+        if not within(utils.shape_of(job), largest):
+            continue
+        if gang:
+            if job.cluster in visited:
+                continue
+            visited.add(job.cluster)
+            members = queue.cluster_jobs(job.cluster)
+            signature = gang_signature(members)
+            if signature in failed:
+                continue
+            if not place_gang(plans, members, policy, scoring):
+                failed.add(signature)
+                continue
+        else:
+            plan = choose(plans, job, policy, scoring)
+            if plan is None:
+                continue
+            plan.assign(job)
+        largest = bounds(plans)
+        if not within(smallest, largest):
+            break
+    return plans
+
+
+def bounds(plans):
+    """Returns the largest (cpus, mem, number of disks) still available in any plan"""
+    cpus = mem = ndisks = 0
+    for plan in plans:
+        available = plan.available
+        if available.disks is None:
+            continue
+        cpus = max(cpus, available.cpus)
+        mem = max(mem, available.mem)
+        ndisks = max(ndisks, len(available.disks))
+    return cpus, mem, ndisks
+
+
+def within(shape, largest):
+    """Verify if a (cpus, mem, number of disks) shape is not bigger than largest"""
+    return shape[0] <= largest[0] and shape[1] <= largest[1] and shape[2] <= largest[2]
+
+
+def place_head(plans, jobs, reservation, policy, scoring=None):
+    """Place the head of the queue first, reserving its agent if it does not fit
+
+    Returns the rest of the jobs to place.
+    """
+    head, hostname = reservation
+    plan = choose(plans, head, policy, scoring)
+    if plan is not None:
+        plan.assign(head)
+    else:
+        for plan in plans:
+            if plan.offer.hostname == hostname:
+                plan.reserved = head
+    return [job for job in jobs if job is not head]
+
+
+def gang_signature(jobs):
+    """Returns the requirements of a gang, equal for gangs that fit the same way"""
+    signature = []
+    for job in jobs:
+        disks = tuple(job.disks) if isinstance(job.disks, list) else job.disks
+        signature.append((job.cpus, job.mem, disks, job.host))
+    return tuple(sorted(signature))
+
+
+def place_gang(plans, jobs, policy, scoring=None):
+    """Place all the given jobs or none of them"""
+    placed = []
+    for job in jobs:
+        plan = choose(plans, job, policy, scoring)
+        if plan is None:
+            for plan, job in reversed(placed):
+                plan.unassign(job)
+            return False
+        plan.assign(job)
+        placed.append((plan, job))
+    return True
+
+
+def groups(plans, gang=False):
+    """Group the assignments of the plans in units that must be launched together
+
+    Each group is a list of (plan, job, disks) tuples. In gang mode there is a
+    group per cluster, in other case a group per job.
+    """
+    assignments = sorted(((plan, job, disks)
+                          for plan in plans for job, disks in plan.assignments),
+                         key=lambda assignment: assignment[1].seq)
+    if not gang:
+        return [[assignment] for assignment in assignments]
+    result = OrderedDict()
+    for assignment in assignments:
+        result.setdefault(assignment[1].cluster, []).append(assignment)
+    return result.values()
+
+
+def candidates(plans, queue):
+    """Returns, in serving order, the jobs that may fit in one of the offers
+
+    The queue is looked up once with the largest resources of any offer, so
+    some of the jobs returned may not fit in any single offer.
+    """
+    offered = [plan.available.disks for plan in plans if plan.available.disks is not None]
+    if not offered:
+        return []
+    cpus, mem, _ = bounds(plans)
+    envelope = utils.Resources(cpus, mem, max(offered, key=len))
+    return queue.candidates(envelope, hosts=set(plan.offer.hostname for plan in plans))
+
+
+def choose(plans, job, policy, scoring=None):
+    """Select the plan where the job should be placed or None if it does not fit"""
+    fitting = [plan for plan in plans if plan.fits(job)]
+    if not fitting:
+        return None
+    if scoring and len(fitting) > 1:
+        scores = [scoring.score(plan, job) for plan in fitting]
+        best = max(scores)
+        fitting = [plan for plan, score in zip(fitting, scores) if score >= best - EPSILON]
+    if policy == BEST_FIT:
+        return min(fitting, key=lambda plan: plan.leftover(job))
+    if policy == WORST_FIT:
+        return max(fitting, key=lambda plan: plan.leftover(job))
+    return fitting[0]
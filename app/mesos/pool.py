@@ -0,0 +1,82 @@
+"""Short-lived pool of the offers not used yet
+
+Instead of declining right away the offers where no queued job fits, the
+scheduler keeps them for a short window, so a job that needs a specific host
+or a gang spread over several agents can be placed once the rest of the
+offers it needs arrive. Offers are released (declined) when their window
+expires, when the pool is full or when there are no queued jobs, so the
+resources are not hoarded from other frameworks.
+"""
+from __future__ import print_function
+
+import threading
+import time
+from collections import OrderedDict
+
+# Seconds an unused offer is kept before it is declined
+WINDOW = 5
+# Maximum number of offers kept, the oldest ones are declined first
+SIZE = 100
+
+
+class OfferPool(object):
+    """Unused offers by offer id, in the order they were received"""
+
+    def __init__(self, size=SIZE, window=WINDOW):
+        self.size = size
+        self.window = window
+        # Offer and time it expires by offer id
+        self._offers = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._offers)
+
+    def __contains__(self, offer_id):
+        return offer_id in self._offers
+
+    def add(self, offers, now=None):
+        """Add new offers to the pool
+
+        Returns the oldest offers that no longer fit in the pool, they must be
+        declined.
+        """
+        expires = (now or time.time()) + self.window
+        evicted = []
+        with self._lock:
+            for offer in offers:
+                self._offers[offer.id.value] = (offer, expires)
+            while len(self._offers) > self.size:
+                evicted.append(self._offers.popitem(last=False)[1][0])
+        return evicted
+
+    def offers(self):
+        """Returns the pooled offers, the oldest first"""
+        with self._lock:
+            return [offer for offer, _ in self._offers.itervalues()]
+
+    def remove(self, offer_id):
+        """Remove an offer that was used or rescinded, returns it or None"""
+        with self._lock:
+            entry = self._offers.pop(offer_id, None)
+        return entry[0] if entry is not None else None
+
+    def expire(self, now=None):
+        """Remove and return the offers whose window has expired"""
+        now = now or time.time()
+        expired = []
+        with self._lock:
+            # All the offers have the same window, so the oldest expire first
+            for offer_id, (offer, expires) in self._offers.items():
+                if expires > now:
+                    break
+                del self._offers[offer_id]
+                expired.append(offer)
+        return expired
+
+    def clear(self):
+        """Remove and return all the offers"""
+        with self._lock:
+            offers = [offer for offer, _ in self._offers.itervalues()]
+            self._offers.clear()
+        return offers
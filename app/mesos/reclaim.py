@@ -0,0 +1,169 @@
+"""Reclamation of the resources of the tasks that ended
+
+When a task ends its disks must be set as free again in the disks service,
+and if it failed or was lost its node is queued again. The Reclaimer does
+both in a background thread: releases are sent in batches every interval
+seconds (or as soon as batch_size of them are waiting), the ones that fail
+are retried in the next batches up to attempts times, and failed nodes are
+requeued once their backoff expires. It also runs a periodic sweep, used by the scheduler to
+reconcile the disks service with the tasks that are still alive.
+"""
+from __future__ import print_function
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two batches of disk releases
+INTERVAL = 1
+# Maximum number of releases sent in a batch
+BATCH_SIZE = 100
+# Times a release is sent before giving up, the sweep may release it later
+RELEASE_ATTEMPTS = 10
+# Times a failed or lost node is queued again before giving up
+RETRIES = 3
+# Seconds before queueing again a node the first time, doubled every attempt
+BACKOFF = 10
+# Maximum seconds before queueing again a node
+MAX_BACKOFF = 600
+# Seconds between two sweeps
+SWEEP_INTERVAL = 300
+
+
+def backoff(attempt, base=BACKOFF, cap=MAX_BACKOFF):
+    """Returns the seconds to wait before the given attempt, the first is 1"""
+    return min(cap, base * 2 ** (attempt - 1))
+
+
+class Reclaimer(object):
+    """Batched disk releases, delayed requeues and periodic sweeps
+
+    release is called with a list of (host, disks, nodedn) tuples and must
+    return the error of each one or None, as utils.release_disks. requeue is
+    called with the jobs whose backoff expired and sweep, if given, every
+    sweep_interval seconds.
+    """
+
+    def __init__(self, release, requeue, sweep=None, interval=INTERVAL,
+                 batch_size=BATCH_SIZE, sweep_interval=SWEEP_INTERVAL,
+                 attempts=RELEASE_ATTEMPTS):
+        self._release = release
+        self._requeue = requeue
+        self._sweep = sweep
+        self.interval = interval
+        self.batch_size = batch_size
+        self.sweep_interval = sweep_interval
+        self.attempts = attempts
+        # Pending (host, disks, nodedn, attempts) releases, the oldest first
+        self._releases = []
+        # Heap of (time, seq, job) with the jobs to requeue and when
+        self._retries = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='Reclaimer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def release(self, host, disks, nodedn):
+        """Schedule the release of the disks of a node"""
+        if not disks:
+            return
+        with self._lock:
+            self._releases.append((host, list(disks), nodedn, 0))
+            full = len(self._releases) >= self.batch_size
+        if full:
+            self._wakeup.set()
+
+    def pending(self):
+        """Returns the number of releases not sent yet"""
+        with self._lock:
+            return len(self._releases)
+
+    def retry(self, job, delay, now=None):
+        """Schedule a job to be queued again after delay seconds"""
+        with self._lock:
+            heapq.heappush(self._retries, ((now or time.time()) + delay, next(self._seq), job))
+
+    def cancel(self, clusterid):
+        """Drop the scheduled requeues of the jobs of a cluster and return them"""
+        with self._lock:
+            cancelled = [entry[2] for entry in self._retries if entry[2].cluster == clusterid]
+            self._retries = [entry for entry in self._retries if entry[2].cluster != clusterid]
+            heapq.heapify(self._retries)
+        return cancelled
+
+    def scheduled(self, clusterid):
+        """Returns whether a job of the cluster is waiting to be queued again"""
+        with self._lock:
+            return any(entry[2].cluster == clusterid for entry in self._retries)
+
+    def due(self, now=None):
+        """Remove and return the jobs whose backoff has expired"""
+        now = now or time.time()
+        jobs = []
+        with self._lock:
+            while self._retries and self._retries[0][0] <= now:
+                jobs.append(heapq.heappop(self._retries)[2])
+        return jobs
+
+    def flush(self):
+        """Send a batch of the pending releases
+
+        The failed ones are kept for the next batches, until they have been
+        tried attempts times. Returns the number of releases that succeeded.
+        """
+        with self._lock:
+            batch = self._releases[:self.batch_size]
+            del self._releases[:self.batch_size]
+        if not batch:
+            return 0
+        errors = self._release([(host, disks, nodedn) for host, disks, nodedn, _ in batch])
+        failed = []
+        for (host, disks, nodedn, attempts), error in zip(batch, errors):
+            if error is None:
+                continue
+            failed.append((host, disks, nodedn, attempts + 1))
+            if attempts + 1 >= self.attempts:
+                logger.error('Unable to release disks {} of {} used by {} after {} '
+                             'attempts, giving up: {}'
+                             .format(disks, host, nodedn, attempts + 1, error))
+            else:
+                logger.warn('Unable to release disks {} of {} used by {}: {}'
+                            .format(disks, host, nodedn, error))
+        retried = [release for release in failed if release[3] < self.attempts]
+        if retried:
+            with self._lock:
+                self._releases.extend(retried)
+        return len(batch) - len(failed)
+
+    def _run(self):
+        swept = time.time()
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if self._stopped.is_set():
+                break
+            try:
+                self.flush()
+                jobs = self.due()
+                if jobs:
+                    self._requeue(jobs)
+                if self._sweep is not None and time.time() - swept >= self.sweep_interval:
+                    swept = time.time()
+                    self._sweep()
+            except Exception:
+                logger.exception('Error reclaiming resources')
+
+    def stop(self):
+        """Stop the background thread sending the releases still pending"""
+        self._stopped.set()
+        self._wakeup.set()
+        self._thread.join()
+        while self.pending() and self.flush():
+            pass
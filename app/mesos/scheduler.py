@@ -19,6 +19,7 @@ import signal
 import sys
 import time
 import uuid
+import threading
 from threading import Thread
 import json
 
@@ -27,20 +28,93 @@ from mesos.native import MesosSchedulerDriver
 
 import requests
 import registry
+from . import disks
+from . import index
+from . import inventory
+from . import metrics
+from . import placement
+from . import pool
+from . import reclaim
+from . import scoring
+from . import snapshot
+from . import tasks
 from . import utils
-from ..exceptions import ResourceException
+from . import writebehind
 
 logger = logging.getLogger(__name__)
 
 ENDPOINT = 'http://consul:8500/v1/kv'
 DISKS_ENDPOINT = 'http://disks.service.int.cesga.es:5000/resources/disks/v1'
+# Seconds to refuse offers from agents where no queued job fits
+REFUSE_SECONDS = 300
+# Terminal states of the tasks whose node is queued again
+RETRY_STATES = frozenset(['TASK_FAILED', 'TASK_LOST'])
 
 
 class BigDataScheduler(Scheduler):
-    def __init__(self, executor):
+    def __init__(self, executor, policy=placement.FIRST_FIT, gang=False,
+                 txn_endpoint=None, snapshot_ttl=snapshot.TTL, refuse_seconds=REFUSE_SECONDS,
+                 journal=None, aging=utils.AGING, backfill=True,
+                 pool_size=pool.SIZE, pool_window=pool.WINDOW, weights=None,
+                 inventory_ttl=inventory.TTL, retries=reclaim.RETRIES,
+                 retry_backoff=reclaim.BACKOFF, release_interval=reclaim.INTERVAL,
+                 sweep_interval=reclaim.SWEEP_INTERVAL):
         self.executor = executor
-        self.queue = utils.JobQueue()
-        registry.connect(ENDPOINT)
+        self.policy = policy
+        # Weight of each placement scorer, see scoring.SCORERS
+        self.weights = scoring.WEIGHTS if weights is None else weights
+        scoring.validate(self.weights)
+        self.gang = gang
+        # Reserve an agent for the head of the queue so backfill never delays it
+        self.backfill = backfill
+        self.reservation = None
+        self.queue = utils.JobQueue(aging)
+        self.progress = utils.Progress()
+        self.index = index.ClusterIndex()
+        self.tasks = tasks.TaskTable()
+        self.snapshots = snapshot.SnapshotCache(snapshot_ttl)
+        self.refuse_seconds = refuse_seconds
+        # Largest resources seen offered by each agent
+        self.capacity = {}
+        self.driver = None
+        self.suppressed = False
+        # Time until which the offers of each agent were declined with a filter
+        self.refused = {}
+        self.offers_lock = threading.Lock()
+        # Offers not used yet, placement runs over all of them
+        self.pool = pool.OfferPool(pool_size, pool_window)
+        # Serializes the placement rounds, they can be triggered by new
+        # offers, by new jobs or by the expiration of pooled offers
+        self.placing = threading.RLock()
+        self.stopped = threading.Event()
+        # Set to run a placement round over the pooled offers in the sweeper
+        # thread, so the threads adding jobs never wait for one
+        self.wakeup = threading.Event()
+        self.sweeper = Thread(target=self.sweep, name='OfferSweeper')
+        self.sweeper.daemon = True
+        self.sweeper.start()
+        self.writer = writebehind.WriteBehind(txn_endpoint)
+        # Optional journal.Journal where the queue changes are recorded
+        self.journal = journal
+        # Hostname of the agents where our executor runs by agent id
+        self.executors = {}
+        # Images already pulled in each agent, as reported by its executor
+        self.images = {}
+        # Number of times each disk was allocated by hostname
+        self.disk_usage = {}
+        # Status of the disks of the offered hosts in the disks service
+        self.inventory = inventory.DiskInventory(inventory_ttl)
+        # Launched jobs whose task has not ended by task id
+        self.jobs = {}
+        # Clusters being killed, their nodes are not queued again
+        self.killed = set()
+        # Times a failed or lost node is queued again and seconds to wait
+        # before the first time, doubled every attempt
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.reclaimer = reclaim.Reclaimer(self.reclaim_disks, self.requeue, self.sweep_disks,
+                                           interval=release_interval,
+                                           sweep_interval=sweep_interval)
 
     def registered(self, driver, framework_id, master_info):
         """
@@ -50,8 +124,13 @@ class BigDataScheduler(Scheduler):
           itself.
         """
         logging.info("Registered with framework ID: {}".format(framework_id.value))
+        self.driver = driver
+        # A new master does not know if we had suppressed or filtered offers
+        self.suppressed = False
+        self.refused.clear()
+        self.reconcile(driver)
 
-    def reregistered(self):
+    def reregistered(self, driver, master_info):
         """
           Invoked when the scheduler re-registers with a newly elected Mesos
           master.  This is only called when the scheduler has previously been
@@ -59,6 +138,10 @@ class BigDataScheduler(Scheduler):
           master.
         """
         logging.info('Reregistered')
+        self.driver = driver
+        self.suppressed = False
+        self.refused.clear()
+        self.reconcile(driver)
 
     def disconnected(self):
         """
@@ -82,67 +165,247 @@ class BigDataScheduler(Scheduler):
           framework has already launched tasks with those resources then those
           tasks will fail with a TASK_LOST status and a message saying as much).
         """
-        for offer in offers:
-            logger.debug('Received offer with ID: {}'.format(offer.id.value))
-            available = utils.resources_from_offer(offer)
-            logger.debug('Resources offered: node={}, cpus={}, mem={}, disks={}'
-                         .format(offer.hostname, available.cpus, available.mem,
-                                 available.disks))
-            # Mesos tasks to launch generated from the job queue
-            tasks = []
-            for job in self.queue.pending():
-                required = utils.resources_from_job(job)
-                if utils.offer_has_enough_resources(available, required):
-                    logger.info('OfferID {} resources: node={}, cpus={}, mem={}, disks={}'
-                                .format(offer.id.value, offer.hostname,
-                                        available.cpus, available.mem, available.disks))
-                    logger.info('Job {} fits into offer'.format(job.name))
-                    allocated_disks = utils.select_disks(available.disks, required.disks)
-                    # TODO: Refactor disks allocation to a method
-                    try:
-                        utils.update_disks_service_allocate(
-                            offer.hostname, allocated_disks, str(job.node))
-                    except(ResourceException):
-                        logger.error("Task %s encountered resource error with Offer %s "
-                                     "in node %s", job.name, offer.id, offer.hostname)
-                        logger.error("Please check that a node with \"%s\" name exists "
-                                     "in the resource tree of the kvstore", offer.hostname)
-                        driver.declineOffer(offer.id)
-                        #FIXME Offer can't be declined if it was previously used
-                        break
-                    job.disks = allocated_disks
-                    logger.info('Disks allocated for this job: {}'.format(job.disks))
-                    job.slave_id = offer.slave_id.value
-                    job.hostname = offer.hostname
-                    job.offer_id = offer.id
-
-                    # Update node object information
-                    node = job.node
-
-                    #node.mesos_slave_id = offer.slave_id.value
-                    #node.mesos_node_hostname = offer.hostname
-                    #node.mesos_offer_id = offer.id
-                    utils.update_disks_origin(node.disks, allocated_disks, str(node))
-
-                    # Reduce the remaining available resourses from this offer
-                    available.cpus -= job.cpus
-                    available.mem -= job.mem
-                    available.disks = utils.remove_disks(available.disks, allocated_disks)
-                    logger.info('Remaining offer resources: cpus={}, mem={}, disks={}'
-                                .format(available.cpus, available.mem, available.disks))
-
-                    utils.update_cluster_progress(node)
-
-                    logger.info("Scheduling new task for launch: {}".format(job.name))
-                    tasks.append(self.task_from(job))
-                    self.queue.remove(job)
-            if tasks:
+        metrics.OFFERS.inc(len(offers), result='received')
+        with metrics.RESOURCE_OFFERS_SECONDS.time():
+            # Read before placing so the other threads do not wait for the
+            # disks service, the rounds only use the cached disks
+            self.inventory.refresh([offer.hostname for offer in offers])
+            with self.placing:
+                for offer in offers:
+                    logger.debug('Received offer with ID: {}'.format(offer.id.value))
+                    self.update_capacity(offer)
+                for offer in self.pool.add(offers):
+                    # The pool is full, release the oldest offers
+                    self.decline(driver, offer)
+                self.handle_offers(driver)
+
+    def handle_offers(self, driver):
+        """Place the queued jobs in the pooled offers and launch them
+
+        Offers where some queued job could fit later stay in the pool until
+        they expire, the rest are declined. Must be called holding placing.
+        """
+        for offer in self.pool.expire():
+            self.decline(driver, offer)
+        offers = self.pool.offers()
+        if not offers:
+            return
+        hostnames = [offer.hostname for offer in offers]
+        plans = placement.place(offers, self.queue, self.policy, gang=self.gang,
+                                scoring=self.new_scoring(), reservation=self.reserve(),
+                                unavailable=self.inventory.unavailable(hostnames))
+        # Mesos tasks to launch in each offer generated from the job queue
+        launches = dict((plan.offer.id.value, []) for plan in plans)
+        launched = []
+        with self.writer.batch():
+            for group in self.allocate(placement.groups(plans, gang=self.gang)):
+                for plan, job, allocated_disks in group:
+                    launches[plan.offer.id.value].append(
+                        self.commit(plan.offer, job, allocated_disks))
+                    launched.append(job)
+        if self.journal is not None:
+            # Recorded before launching so a restart never queues them again
+            self.journal.launched(launched)
+        for plan in plans:
+            offer = plan.offer
+            offer_tasks = launches[offer.id.value]
+            if offer_tasks:
                 logger.info('Launching all tasks that fit inside this offer: {}'
-                            .format([t.name for t in tasks]))
-                logger.debug('Task details: \n{}'.format(tasks))
-                driver.launchTasks(offer.id, tasks)
+                            .format([t.name for t in offer_tasks]))
+                logger.info('Remaining offer resources: cpus={}, mem={}, disks={}'
+                            .format(plan.available.cpus, plan.available.mem,
+                                    plan.available.disks))
+                logger.debug('Task details: \n{}'.format(offer_tasks))
+                self.pool.remove(offer.id.value)
+                driver.launchTasks(offer.id, offer_tasks)
+                metrics.OFFERS.inc(result='used')
+            elif not self.queue.fits_any(plan.offered):
+                # More offers would not help, a job must fit in this one
+                self.pool.remove(offer.id.value)
+                self.decline(driver, offer)
+        self.suppress(driver)
+
+    def decline(self, driver, offer):
+        """Decline an unused offer
+
+        If no queued job could ever fit in the agent of the offer, the offer is
+        declined for refuse_seconds so Mesos does not offer it again soon.
+        """
+        metrics.OFFERS.inc(result='declined')
+        capacity = self.capacity.get(offer.hostname)
+        if capacity is None or self.queue.fits_any(capacity):
+            driver.declineOffer(offer.id)
+        else:
+            logger.debug('No queued job fits in {}, declining its offers for {}s'
+                         .format(offer.hostname, self.refuse_seconds))
+            filters = mesos_pb2.Filters()
+            filters.refuse_seconds = self.refuse_seconds
+            with self.offers_lock:
+                self.refused[offer.hostname] = time.time() + self.refuse_seconds
+            driver.declineOffer(offer.id, filters)
+
+    def new_scoring(self):
+        """Returns the scoring.Scoring of a placement round"""
+        return scoring.Scoring(self.weights, warm=self.images,
+                               disk_usage=self.disk_usage, nodes=self.tasks.hosts)
+
+    def reserve(self):
+        """Returns the (job, hostname) reservation of the head of the queue
+
+        The agent is kept while the head of the queue does not change. It is
+        the largest known agent where the job fits once the agent is empty.
+        Returns None if backfill is disabled, in gang mode (see placement) or
+        if no known agent is big enough.
+        """
+        if not self.backfill or self.gang:
+            return None
+        head = self.queue.head()
+        if head is None:
+            self.reservation = None
+            return None
+        if self.reservation is not None and self.reservation[0] == head.name:
+            return head, self.reservation[1]
+        hosts = [hostname for hostname, capacity in self.capacity.items()
+                 if utils.offer_has_enough_resources(capacity, head.required)]
+        if not hosts:
+            self.reservation = None
+            return None
+        hostname = max(hosts, key=lambda hostname: (self.capacity[hostname].cpus,
+                                                    self.capacity[hostname].mem))
+        logger.info('Reserving {} for job {}'.format(hostname, head.name))
+        self.reservation = (head.name, hostname)
+        return head, hostname
+
+    def update_capacity(self, offer):
+        """Record the largest resources seen offered by the agent of the offer"""
+        hostname = offer.hostname
+        offered = utils.resources_from_offer(offer)
+        capacity = self.capacity.get(hostname)
+        if capacity is None:
+            capacity = self.capacity[hostname] = utils.Resources(
+                cpus=0, mem=0, disks=[], host=hostname)
+        capacity.cpus = max(capacity.cpus, offered.cpus)
+        capacity.mem = max(capacity.mem, offered.mem)
+        for disk in offered.disks or []:
+            if disk not in capacity.disks:
+                capacity.disks.append(disk)
+
+    def reconcile(self, driver):
+        """Ask the master for the current state of the known active tasks"""
+        statuses = self.tasks.statuses()
+        logger.info('Reconciling {} tasks'.format(len(statuses)))
+        driver.reconcileTasks(statuses)
+
+    def suppress(self, driver):
+        """Stop receiving offers if there are no queued jobs"""
+        with self.offers_lock:
+            if not self.suppressed and not len(self.queue):
+                logger.info('Job queue is empty, suppressing offers')
+                driver.suppressOffers()
+                self.suppressed = True
+
+    def revive(self, jobs):
+        """Receive offers again if new jobs need them
+
+        Offers are revived if they are suppressed or if one of the jobs fits
+        in an agent whose offers were declined with a filter. Reviving also
+        clears all the filters.
+        """
+        with self.offers_lock:
+            if self.driver is None:
+                return
+            now = time.time()
+            for hostname, until in self.refused.items():
+                if until <= now:
+                    del self.refused[hostname]
+            if not self.suppressed and not self.fits_refused(jobs):
+                return
+            logger.info('Reviving offers')
+            self.driver.reviveOffers()
+            self.suppressed = False
+            self.refused.clear()
+
+    def fits_refused(self, jobs):
+        """Verify if any of the jobs fits in an agent whose offers are filtered"""
+        for hostname in self.refused:
+            capacity = self.capacity.get(hostname)
+            if capacity is None:
+                continue
+            for job in jobs:
+                if utils.offer_has_enough_resources(capacity, job.required):
+                    return True
+        return False
+
+    def allocate(self, groups):
+        """Allocate in the disks service the disks of the given assignment groups
+
+        The allocations of all the groups are run in parallel. Returns the
+        groups whose allocations all succeeded; the jobs of the other groups
+        stay queued and will be placed in a later offer, and the disks that
+        were allocated to them are released.
+        """
+        assignments = [assignment for group in groups for assignment in group]
+        errors = utils.allocate_disks([(plan.offer.hostname, allocated_disks, str(job.node))
+                                       for plan, job, allocated_disks in assignments])
+        failed = set()
+        for (plan, job, allocated_disks), error in zip(assignments, errors):
+            offer = plan.offer
+            if error is None:
+                logger.info('Job {} fits into offer {} in node {}'
+                            .format(job.name, offer.id.value, offer.hostname))
+            else:
+                logger.error("Task %s encountered resource error with Offer %s "
+                             "in node %s: %s", job.name, offer.id.value, offer.hostname,
+                             error)
+                logger.error("Please check that a node with \"%s\" name exists "
+                             "in the resource tree of the kvstore", offer.hostname)
+                # The disks changed behind the inventory, read them again
+                self.inventory.invalidate(offer.hostname)
+                failed.add(job.name)
+        allocated = []
+        leaked = []
+        for group in groups:
+            if any(job.name in failed for _, job, _ in group):
+                leaked.extend((plan.offer.hostname, allocated_disks, str(job.node))
+                              for plan, job, allocated_disks in group
+                              if job.name not in failed)
             else:
-                driver.declineOffer(offer.id)
+                allocated.append(group)
+        if leaked:
+            logger.info('Releasing the disks of {} jobs of incomplete gangs'.format(len(leaked)))
+            self.release_disks(leaked, retry=True)
+        return allocated
+
+    def commit(self, offer, job, allocated_disks):
+        """Remove the job from the queue and return the task to launch it"""
+        self.queue.remove(job)
+        self.index.update(job.cluster, job.name, 'scheduled')
+        self.tasks.launched(job.name, job.cluster, offer.slave_id.value, offer.hostname)
+        self.executors[offer.slave_id.value] = offer.hostname
+        metrics.SUBMIT_TO_LAUNCH_SECONDS.observe(time.time() - job.submitted)
+        job.disks = allocated_disks
+        self.inventory.used(offer.hostname, allocated_disks)
+        self.jobs[job.name] = job
+        usage = self.disk_usage.setdefault(offer.hostname, {})
+        for disk in allocated_disks:
+            usage[disk] = usage.get(disk, 0) + 1
+        logger.info('Disks allocated for this job: {}'.format(job.disks))
+        job.slave_id = offer.slave_id.value
+        job.hostname = offer.hostname
+        job.offer_id = offer.id
+
+        # Update node and cluster information in the background
+        node = job.node
+        for name, allocation in zip(job.disk_names, allocated_disks):
+            disk = registry.Disk('{}/disks/{}'.format(node, name))
+            self.writer.set(job.cluster, disk, 'origin',
+                            utils.disk_origin(allocation, str(node)))
+        cluster = node.cluster
+        for attr, value in self.progress.advance(job.cluster):
+            self.writer.set(job.cluster, cluster, attr, value)
+
+        logger.info("Scheduling new task for launch: {}".format(job.name))
+        return self.task_from(job)
 
     def offerRescinded(self, driver, offer_id):
         """
@@ -153,7 +416,47 @@ class BigDataScheduler(Scheduler):
           invalid offer will receive TASK_LOST status updats for those tasks
           (see Scheduler.resourceOffers).
         """
-        pass
+        logger.debug('Offer {} rescinded'.format(offer_id.value))
+        with self.placing:
+            if self.pool.remove(offer_id.value) is not None:
+                metrics.OFFERS.inc(result='rescinded')
+
+    def place_pooled(self):
+        """Ask for a placement round over the pooled offers, e.g. after new jobs
+        arrive, it is run by the sweeper thread"""
+        self.wakeup.set()
+
+    def sweep(self):
+        """Run the requested placement rounds and decline the pooled offers as
+        they expire until the scheduler stops"""
+        while not self.stopped.is_set():
+            self.wakeup.wait(self.pool.window / 2.0)
+            requested = self.wakeup.is_set()
+            self.wakeup.clear()
+            if self.stopped.is_set():
+                break
+            if self.driver is None or not len(self.pool):
+                continue
+            if requested:
+                self.inventory.refresh([offer.hostname for offer in self.pool.offers()])
+            with self.placing:
+                if requested:
+                    self.handle_offers(self.driver)
+                else:
+                    for offer in self.pool.expire():
+                        self.decline(self.driver, offer)
+
+    def stop(self):
+        """Stop the sweepers and release all the pooled offers and pending disks"""
+        self.stopped.set()
+        self.wakeup.set()
+        self.sweeper.join()
+        self.reclaimer.stop()
+        with self.placing:
+            offers = self.pool.clear()
+            if self.driver is not None:
+                for offer in offers:
+                    self.decline(self.driver, offer)
 
     def statusUpdate(self, driver, update):
         """
@@ -169,8 +472,183 @@ class BigDataScheduler(Scheduler):
           acknowledgements are in use, the scheduler must acknowledge this
           status on the driver.
         """
-        logger.info("Task {} is in state {}".format(
-            update.task_id.value, mesos_pb2.TaskState.Name(update.state)))
+        state = mesos_pb2.TaskState.Name(update.state)
+        logger.info("Task {} is in state {}".format(update.task_id.value, state))
+        self.update_task(update.task_id.value, state, update.slave_id.value)
+
+    def update_task(self, taskid, state, slave_id=None):
+        """Record a new state of a task, reclaiming its resources if it ended
+
+        Ended tasks are dropped from the task table once reclaimed, their
+        final state is kept in the cluster index.
+        """
+        previous = self.tasks.get(taskid)
+        previous_state = previous.state if previous is not None else None
+        task = self.tasks.update(taskid, state, slave_id)
+        if (state == 'TASK_RUNNING' and previous_state != state
+                and task.launched is not None):
+            metrics.LAUNCH_TO_RUNNING_SECONDS.observe(time.time() - task.launched)
+        if task.terminal and self.journal is not None:
+            self.journal.finished(task.taskid)
+        status = tasks.state_name(state)
+        self.index.update(task.cluster, task.taskid, status)
+        node = registry.Node(registry.dn_from(task.taskid))
+        self.writer.set(task.cluster, node, 'status', status)
+        if task.terminal:
+            self.reclaim(task)
+            self.tasks.remove(task.taskid)
+            self.finish(task.cluster)
+
+    def reclaim(self, task):
+        """Release the disks of a task that ended and retry it if it failed
+
+        A failed or lost node is queued again after an exponential backoff,
+        at most retries times. It is journaled as queued right away, so it is
+        not lost if the scheduler restarts during the backoff.
+        """
+        job = self.jobs.pop(task.taskid, None)
+        if job is None:
+            return
+        self.reclaimer.release(job.hostname, job.disks, str(job.node))
+        if task.cluster in self.killed:
+            return
+        if task.state not in RETRY_STATES:
+            return
+        if job.attempts >= self.retries:
+            logger.warn('Task {} ended in {} {} times, not retrying it'
+                        .format(task.taskid, task.state, job.attempts + 1))
+            return
+        job.attempts += 1
+        delay = reclaim.backoff(job.attempts, self.retry_backoff)
+        logger.info('Task {} ended in {}, queueing it again in {}s (attempt {} of {})'
+                    .format(task.taskid, task.state, delay, job.attempts, self.retries))
+        # Back to the requirements, it may land in another agent
+        job.disks = job.required.disks
+        job.slave_id = job.hostname = job.offer_id = None
+        if self.journal is not None:
+            self.journal.enqueued([job], self.index.size(job.cluster))
+        self.reclaimer.retry(job, delay)
+
+    def finish(self, clusterid):
+        """Forget a killed cluster or record a cluster as finished once none
+        of its nodes is queued, running or waiting to be queued again"""
+        with self.placing:
+            if (self.queue.cluster_jobs(clusterid) or self.reclaimer.scheduled(clusterid)
+                    or any(not task.terminal for task in self.tasks.cluster(clusterid))):
+                return
+            if clusterid in self.killed:
+                self.killed.discard(clusterid)
+                self.index.remove(clusterid)
+            else:
+                self.index.finish(clusterid)
+
+    def requeue(self, jobs):
+        """Queue again the jobs of failed or lost tasks"""
+        with self.placing:
+            killed = [job for job in jobs if job.cluster in self.killed]
+            if killed and self.journal is not None:
+                self.journal.removed(killed)
+            jobs = [job for job in jobs if job.cluster not in self.killed]
+            if not jobs:
+                return
+            with self.writer.batch():
+                for job in jobs:
+                    job.submitted = time.time()
+                    self.progress.requeue(job.cluster, self.index.size(job.cluster))
+                    self.index.update(job.cluster, job.name, 'queued')
+                    self.writer.set(job.cluster, job.node, 'status', 'queued')
+            self.queue.extend(jobs)
+        self.revive(jobs)
+        if len(self.pool):
+            self.place_pooled()
+
+    def release_disks(self, releases, retry=False):
+        """Set as free in the disks service the given (host, disks, nodedn) tuples
+
+        Returns the error of each release or None. If retry is true, the
+        failed releases are retried in the background.
+        """
+        errors = utils.release_disks(releases)
+        for (host, names, nodedn), error in zip(releases, errors):
+            if error is None:
+                self.inventory.released(host, names)
+            elif retry:
+                self.reclaimer.release(host, names, nodedn)
+        return errors
+
+    def reclaim_disks(self, releases):
+        """Release in the background the given (host, disks, nodedn) tuples
+
+        Ownership is checked again while placing, so the disks of a node
+        queued again and relaunched since its release was scheduled are not
+        freed under its new task. Returns the error of each release or None.
+        """
+        with self.placing:
+            live = [self.live(registry.id_from(nodedn)) for _, _, nodedn in releases]
+            errors = iter(self.release_disks([release for release, running
+                                              in zip(releases, live) if not running]))
+            return [None if running else next(errors) for running in live]
+
+    def live(self, taskid):
+        """Returns whether the node of the task was launched and has not ended"""
+        task = self.tasks.get(taskid)
+        return taskid in self.jobs or (task is not None and not task.terminal)
+
+    def sweep_disks(self):
+        """Release the disks the disks service has for nodes without a live task
+
+        Only nodes of the clusters known by this scheduler are considered,
+        so they are disks leaked by a missed status update or a failure
+        between their allocation and the launch of the task. The disks
+        service is read outside the lock, the owners are checked again when
+        the releases are sent.
+        """
+        hosts = list(self.capacity)
+        if not hosts:
+            return
+        results = utils.disks_client.get_many_host_disks([(host, None) for host in hosts])
+        leaked = []
+        # Allocations and launches happen together while placing
+        with self.placing:
+            for host, result in zip(hosts, results):
+                if isinstance(result, Exception):
+                    logger.warn('Unable to read the disks of {}: {}'.format(host, result))
+                    continue
+                owners = {}
+                for name, info in result[0].iteritems():
+                    if info.get('status') == disks.USED and info.get('clustername'):
+                        owners.setdefault(info['clustername'], []).append(name)
+                for nodedn, names in owners.iteritems():
+                    taskid = registry.id_from(nodedn)
+                    if self.live(taskid):
+                        continue
+                    if not self.index.size(tasks.cluster_of(taskid)):
+                        continue
+                    leaked.append((host, sorted(names), nodedn))
+        if leaked:
+            logger.info('Releasing {} leaked disk allocations'.format(len(leaked)))
+            for host, names, nodedn in leaked:
+                self.reclaimer.release(host, names, nodedn)
+
+    def kill(self, clusterid):
+        """Stop launching and retrying the nodes of a cluster being killed
+
+        The queued nodes are removed, the disks of the launched ones are
+        released once their tasks are reported as killed.
+        """
+        with self.placing:
+            self.killed.add(clusterid)
+            # Journaled as queued while they wait for their backoff
+            cancelled = self.reclaimer.cancel(clusterid)
+            jobs = self.queue.cluster_jobs(clusterid)
+            for job in jobs:
+                self.queue.remove(job)
+            for job in jobs + cancelled:
+                self.index.update(job.cluster, job.name, 'killed')
+            if (jobs or cancelled) and self.journal is not None:
+                self.journal.removed(jobs + cancelled)
+            # Right away if none of its nodes was launched
+            self.finish(clusterid)
 
     def frameworkMessage(self, driver, executor_id, slave_id, message):
         """
@@ -178,7 +656,47 @@ class BigDataScheduler(Scheduler):
           effort; do not expect a framework message to be retransmitted in any
           reliable fashion.
         """
-        pass
+        try:
+            data = json.loads(message)
+            kind = data['type']
+        except (ValueError, TypeError, KeyError):
+            logger.warn('Invalid message from the executor in {}: {}'
+                        .format(slave_id.value, message))
+            return
+        if kind == 'images':
+            images = data.get('images') or []
+            if not isinstance(images, list):
+                logger.warn('Invalid images message from the executor in {}: {}'
+                            .format(slave_id.value, message))
+                return
+            logger.debug('Images pulled in {}: {}'.format(slave_id.value, images))
+            self.images[slave_id.value] = set(images)
+        elif kind == 'progress':
+            phases = data.get('tasks')
+            if not isinstance(phases, dict):
+                logger.warn('Invalid progress message from the executor in {}: {}'
+                            .format(slave_id.value, message))
+                return
+            self.update_progress(phases)
+        else:
+            logger.warn('Unknown message type from the executor in {}: {}'
+                        .format(slave_id.value, kind))
+
+    def update_progress(self, phases):
+        """Record the start phases reported by an executor by task id
+
+        All the registry writes of a message are flushed together, as a
+        single transaction per cluster if transactions are enabled.
+        """
+        # Placement rounds may run in other threads and update the same tasks
+        with self.placing, self.writer.batch():
+            for taskid, phase in phases.iteritems():
+                task = self.tasks.progress(taskid, phase)
+                if task is None:
+                    continue
+                logger.debug('Task {} is in phase {}'.format(taskid, phase))
+                node = registry.Node(registry.dn_from(taskid))
+                self.writer.set(task.cluster, node, 'phase', phase)
 
     def slaveLost(self, driver, slave_id):
         """
@@ -186,14 +704,24 @@ class BigDataScheduler(Scheduler):
           failure, network partition.) Most frameworks will need to reschedule
           any tasks launched on this slave on a new slave.
         """
-        pass
+        self.forget_executor(slave_id.value)
+        # Their TASK_LOST updates may never arrive, reclaim them now
+        for task in self.tasks.agent(slave_id.value):
+            if not task.terminal:
+                logger.info('Task {} lost with agent {}'.format(task.taskid, slave_id.value))
+                self.update_task(task.taskid, 'TASK_LOST', slave_id.value)
 
     def executorLost(self, driver, executor_id, slave_id, status):
         """
           Invoked when an executor has exited/terminated. Note that any tasks
           running will have TASK_LOST status updates automatically generated.
         """
-        pass
+        self.forget_executor(slave_id.value)
+
+    def forget_executor(self, slave_id):
+        """Stop sending hints to the executor of an agent that is gone"""
+        self.executors.pop(slave_id, None)
+        self.images.pop(slave_id, None)
 
     def error(self, driver, message):
         """
@@ -210,7 +738,7 @@ class BigDataScheduler(Scheduler):
         task.task_id.value = job.name
         task.slave_id.value = job.slave_id
         task.name = job.name
-        task.data = json.dumps({"node_dn": str(job.node)})
+        task.data = json.dumps({"node_dn": str(job.node), "image": job.image})
         task.executor.MergeFrom(self.executor)
 
         cpus = task.resources.add()
@@ -234,10 +762,84 @@ class BigDataScheduler(Scheduler):
 
         return task
 
-    def enqueue(self, cluster):
-        """Enqueue all nodes of a given cluster"""
-        utils.initialize_cluster_status(cluster)
-        self.queue.append(cluster.nodes)
+    def enqueue(self, cluster, priority=utils.NORMAL):
+        """Enqueue all nodes of a given cluster with the given priority class
+
+        Raises kvstore.KeyDoesNotExist, before writing anything, if the
+        cluster does not exist or has no nodes.
+        """
+        definition = self.snapshots.get(cluster)
+        with metrics.REGISTRY_SECONDS.time(operation='write'):
+            utils.initialize_cluster_status(cluster)
+        self.killed.discard(definition.clusterid)
+        nodes = definition.nodes
+        jobs = utils.jobs_from(nodes, definition, priority)
+        self.progress.start(definition.clusterid, len(nodes))
+        # The definition was read in a single request, the nodes are marked
+        # as queued in the background
+        with self.writer.batch():
+            for node in nodes:
+                self.writer.set(definition.clusterid, node, 'status', 'queued')
+        # Recorded before a placement round can launch them, or the launch
+        # would be journaled before the jobs and lost
+        if self.journal is not None:
+            self.journal.enqueued(jobs, len(nodes))
+        for job in jobs:
+            self.index.update(job.cluster, job.name, 'queued')
+        self.queue.extend(jobs)
+        self.prefetch(jobs)
+        self.revive(jobs)
+        if len(self.pool):
+            self.place_pooled()
+
+    def prefetch(self, jobs):
+        """Ask the running executors to pull in advance the images of the jobs
+
+        Each executor is only sent the images it does not have yet of the jobs
+        that could run in its agent.
+        """
+        if self.driver is None:
+            return
+        for slave_id, hostname in self.executors.items():
+            warm = self.images.get(slave_id, ())
+            images = set(job.image for job in jobs
+                         if job.image and job.host in (None, hostname)
+                         and job.image not in warm)
+            if images:
+                logger.debug('Sending image hints to {}: {}'.format(hostname, images))
+                self.driver.sendFrameworkMessage(
+                    self.executor.executor_id, mesos_pb2.SlaveID(value=slave_id),
+                    json.dumps({'type': 'prefetch', 'images': sorted(images)}))
+
+    def restore(self):
+        """Rebuild the job queue and the task table from the journal
+
+        Must be called before the driver is started. The restored tasks are
+        reconciled with the master once the scheduler registers.
+        """
+        if self.journal is None:
+            return
+        queued, running = self.journal.replay()
+        jobs = [utils.Job.from_record(record) for record in queued.itervalues()]
+        self.queue.extend(jobs)
+        totals = {}
+        for record, job in zip(queued.itervalues(), jobs):
+            totals[job.cluster] = record['total']
+            self.index.update(job.cluster, job.name, 'queued')
+        for clusterid, total in totals.iteritems():
+            pending = len(self.queue.cluster_jobs(clusterid))
+            self.progress.start(clusterid, total, total - pending)
+        for record in running.itervalues():
+            self.tasks.launched(record['name'], record['cluster'],
+                                record['slave_id'], record['hostname'])
+            job = utils.Job.from_record(record)
+            if record.get('allocated') is not None:
+                job.disks = record['allocated']
+            self.jobs[job.name] = job
+            self.executors[record['slave_id']] = record['hostname']
+            self.index.update(record['cluster'], record['name'], 'scheduled')
+        logger.info('Restored {} queued jobs and {} running tasks from the journal'
+                    .format(len(jobs), len(running)))
 
     def pending(self):
         """Returns the list of pending jobs"""
@@ -0,0 +1,92 @@
+"""Scoring of the offers a job fits in
+
+When a job fits in several offers, each scorer rates every offer between 0
+(worst) and 1 (best) and the offer with the highest weighted sum is chosen.
+The bin-packing policy only breaks the ties. Scorers are selected and
+weighted with the PLACEMENT_WEIGHTS setting, a weight of 0 disables one:
+
+    spread: avoid agents already running nodes of the same cluster
+    disks: prefer agents that keep more free disks after placing the job
+    locality: prefer the required_node of the job
+    image: prefer agents where the docker image of the job was pulled
+
+A Scoring is built for each placement round, so what it knows about the
+running tasks is only looked up once per cluster and round.
+"""
+from __future__ import print_function
+
+import utils
+
+# Default weight of each scorer
+WEIGHTS = {'spread': 1.0, 'disks': 0.5, 'locality': 2.0, 'image': 1.0}
+
+
+def spread(scoring, plan, job):
+    """Anti-affinity between the nodes of the same cluster"""
+    hostname = plan.offer.hostname
+    nodes = scoring.running(job.cluster).get(hostname, 0)
+    nodes += sum(1 for assigned, _ in plan.assignments if assigned.cluster == job.cluster)
+    return 1.0 / (1 + nodes)
+
+
+def disks(scoring, plan, job):
+    """Fraction of the disks of the offer still free after placing the job"""
+    offered = len(plan.offered.disks or ())
+    if not offered:
+        return 0.0
+    return float(len(plan.available.disks) - utils.shape_of(job)[2]) / offered
+
+
+def locality(scoring, plan, job):
+    """Whether the offer comes from the node the job asks for"""
+    return 1.0 if job.locality and job.locality == plan.offer.hostname else 0.0
+
+
+def image(scoring, plan, job):
+    """Whether the image of the job is already present in the agent"""
+    if not job.image:
+        return 0.0
+    return 1.0 if job.image in scoring.warm.get(plan.offer.slave_id.value, ()) else 0.0
+
+
+SCORERS = {'spread': spread, 'disks': disks, 'locality': locality, 'image': image}
+
+
+def validate(weights):
+    """Raise ValueError if the weights name an unknown scorer"""
+    for name in weights:
+        if name not in SCORERS:
+            raise ValueError('Unknown placement scorer: {}'.format(name))
+
+
+class Scoring(object):
+    """Weighted scorers and the state they need for a placement round
+
+    Contains the following fields:
+        warm: set of images present in each agent by agent id
+        disk_usage: number of times each disk was allocated by hostname
+        nodes: function returning the active nodes of a cluster by hostname
+    """
+    def __init__(self, weights=None, warm=None, disk_usage=None, nodes=None):
+        weights = WEIGHTS if weights is None else weights
+        validate(weights)
+        self.scorers = [(SCORERS[name], weight)
+                        for name, weight in sorted(weights.items()) if weight]
+        self.warm = warm or {}
+        self.disk_usage = disk_usage or {}
+        self.nodes = nodes
+        self._running = {}
+
+    def __nonzero__(self):
+        return bool(self.scorers)
+
+    def running(self, clusterid):
+        """Returns the number of active nodes of a cluster by hostname"""
+        running = self._running.get(clusterid)
+        if running is None:
+            running = self._running[clusterid] = self.nodes(clusterid) if self.nodes else {}
+        return running
+
+    def score(self, plan, job):
+        """Returns the weighted score of placing the job in the plan"""
+        return sum(weight * scorer(self, plan, job) for scorer, weight in self.scorers)
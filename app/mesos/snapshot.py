@@ -0,0 +1,126 @@
+"""In-memory snapshots of cluster definitions
+
+Reading the attributes of a registry.Node costs a KV request per attribute.
+A ClusterSnapshot reads the whole subtree of a cluster with a single
+recursive request and then answers the same questions from memory.
+"""
+from __future__ import print_function
+
+import threading
+import time
+from collections import OrderedDict
+
+import kvstore
+import registry
+
+import metrics
+
+# Seconds a cluster definition is kept in the cache
+TTL = 30
+# Maximum number of cluster definitions kept in the cache
+MAX_SIZE = 128
+
+
+class ClusterSnapshot(object):
+    """Copy of the registry subtree of a cluster at a given time"""
+
+    def __init__(self, clusterdn, entries):
+        self.clusterdn = clusterdn.strip('/')
+        self.timestamp = time.time()
+        self._nodes = {}
+        prefix = self.clusterdn + '/nodes/'
+        for key, value in entries.iteritems():
+            key = key.lstrip('/')
+            if not key.startswith(prefix):
+                continue
+            fields = key[len(prefix):].split('/')
+            if not fields[0]:
+                continue
+            node = self._nodes.setdefault(fields[0], NodeView(prefix + fields[0]))
+            if len(fields) == 2 and fields[1]:
+                node.attrs[fields[1]] = value
+            elif len(fields) > 2 and fields[1] == 'disks' and fields[2]:
+                node.disk_names.add(fields[2])
+
+    @classmethod
+    def fetch(cls, clusterdn):
+        """Read the cluster subtree from the registry
+
+        Raises kvstore.KeyDoesNotExist, as the registry backend does for an
+        unknown key, if the cluster does not exist or has no nodes.
+        """
+        with metrics.REGISTRY_SECONDS.time(operation='read'):
+            entries = registry._kv.recurse(clusterdn)
+        snapshot = cls(clusterdn, entries or {})
+        if not snapshot._nodes:
+            raise kvstore.KeyDoesNotExist('{} has no nodes'.format(snapshot.clusterdn))
+        return snapshot
+
+    @property
+    def clusterid(self):
+        return registry.id_from(self.clusterdn)
+
+    @property
+    def nodes(self):
+        """The registry.Node objects of the cluster"""
+        return [registry.Node(self._nodes[name].dn) for name in sorted(self._nodes)]
+
+    def view(self, node):
+        """Returns the in-memory view of the given node"""
+        return self._nodes[registry.parse_endpoint_last_element(str(node))]
+
+
+class NodeView(object):
+    """Read-only view of a node with the same interface as registry.Node"""
+
+    def __init__(self, dn):
+        self.dn = dn
+        self.attrs = {}
+        self.disk_names = set()
+
+    def __getattr__(self, name):
+        try:
+            return self.attrs[name]
+        except KeyError:
+            raise registry.KeyDoesNotExist('{}/{}'.format(self.dn, name))
+
+    def get(self, name):
+        return self.attrs.get(name)
+
+    @property
+    def disks(self):
+        return [registry.Disk('{}/disks/{}'.format(self.dn, name))
+                for name in self.disk_names]
+
+    def __str__(self):
+        return self.dn
+
+
+class SnapshotCache(object):
+    """Cache of cluster snapshots that expire after ttl seconds"""
+
+    def __init__(self, ttl=TTL, max_size=MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._snapshots = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, clusterdn):
+        """Returns the snapshot of the cluster, reading it if needed"""
+        clusterdn = str(clusterdn)
+        with self._lock:
+            snapshot = self._snapshots.get(clusterdn)
+        if snapshot is not None and time.time() - snapshot.timestamp < self.ttl:
+            return snapshot
+        snapshot = ClusterSnapshot.fetch(clusterdn)
+        with self._lock:
+            self._snapshots.pop(clusterdn, None)
+            self._snapshots[clusterdn] = snapshot
+            while len(self._snapshots) > self.max_size:
+                self._snapshots.popitem(last=False)
+        return snapshot
+
+    def invalidate(self, clusterdn):
+        """Remove the cluster from the cache"""
+        with self._lock:
+            self._snapshots.pop(str(clusterdn), None)
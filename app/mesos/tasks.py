@@ -0,0 +1,172 @@
+"""In-memory table of the tasks launched by the scheduler
+
+The table is fed by the statusUpdate callback and indexed by task id, cluster
+and agent, so questions like "which tasks of this cluster are running" or
+"which tasks were on the lost agent" are answered without going to the
+registry. It is also the source of the task statuses sent to the master for
+reconciliation. The scheduler removes the tasks once their end is handled,
+so only the live ones are kept.
+"""
+from __future__ import print_function
+
+import threading
+import time
+
+from mesos.interface import mesos_pb2
+
+import registry
+
+TERMINAL_STATES = frozenset(['TASK_FINISHED', 'TASK_FAILED', 'TASK_KILLED',
+                             'TASK_LOST', 'TASK_ERROR'])
+
+
+def state_name(state):
+    """Returns the short lowercase name of a task state, e.g. running"""
+    return state.replace('TASK_', '').lower()
+
+
+def cluster_of(taskid):
+    """Returns the id of the cluster a task belongs to"""
+    nodedn = registry.dn_from(taskid)
+    return registry.id_from(registry.extract_clusterdn_from_nodedn(nodedn))
+
+
+class Task(object):
+    """State of a task as last reported by Mesos"""
+    __slots__ = ('taskid', 'cluster', 'slave_id', 'hostname', 'state', 'timestamp',
+                 'launched', 'phase')
+
+    def __init__(self, taskid, cluster, slave_id, hostname, state):
+        self.taskid = taskid
+        self.cluster = cluster
+        self.slave_id = slave_id
+        self.hostname = hostname
+        self.state = state
+        self.timestamp = time.time()
+        # Time the task was launched by this scheduler, None if unknown
+        self.launched = None
+        # Last start phase reported by the executor, e.g. pull
+        self.phase = None
+
+    @property
+    def terminal(self):
+        return self.state in TERMINAL_STATES
+
+    def to_dict(self):
+        return {'taskid': self.taskid, 'cluster': self.cluster,
+                'slave_id': self.slave_id, 'hostname': self.hostname,
+                'state': self.state, 'phase': self.phase, 'timestamp': self.timestamp}
+
+
+class TaskTable(object):
+    """Tasks indexed by task id, cluster id and agent id"""
+
+    def __init__(self):
+        self._tasks = {}
+        self._by_cluster = {}
+        self._by_agent = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def get(self, taskid):
+        """Returns the Task with the given id or None"""
+        return self._tasks.get(taskid)
+
+    def launched(self, taskid, cluster, slave_id, hostname):
+        """Record a task just sent to Mesos"""
+        with self._lock:
+            self._discard(taskid)
+            task = Task(taskid, cluster, slave_id, hostname, 'TASK_STAGING')
+            task.launched = task.timestamp
+            self._add(task)
+            return task
+
+    def update(self, taskid, state, slave_id=None):
+        """Record a new state of a task, adding it if it was unknown"""
+        with self._lock:
+            task = self._tasks.get(taskid)
+            if task is None:
+                task = Task(taskid, cluster_of(taskid), slave_id, None, state)
+                self._add(task)
+                return task
+            if slave_id and slave_id != task.slave_id:
+                self._discard(taskid)
+                task.slave_id = slave_id
+                self._add(task)
+            task.state = state
+            task.timestamp = time.time()
+            return task
+
+    def progress(self, taskid, phase):
+        """Record the start phase of an active task
+
+        Returns the task or None if it is unknown or has already ended, as
+        progress messages may arrive after the final status update.
+        """
+        with self._lock:
+            task = self._tasks.get(taskid)
+            if task is None or task.terminal:
+                return None
+            task.phase = phase
+            return task
+
+    def remove(self, taskid):
+        """Forget a task"""
+        with self._lock:
+            return self._discard(taskid)
+
+    def cluster(self, clusterid):
+        """Returns the tasks of the given cluster"""
+        with self._lock:
+            return [self._tasks[t] for t in self._by_cluster.get(clusterid, ())]
+
+    def hosts(self, clusterid):
+        """Returns the number of active tasks of the given cluster by hostname"""
+        hosts = {}
+        for task in self.cluster(clusterid):
+            if not task.terminal and task.hostname:
+                hosts[task.hostname] = hosts.get(task.hostname, 0) + 1
+        return hosts
+
+    def agent(self, slave_id):
+        """Returns the tasks running in the given agent"""
+        with self._lock:
+            return [self._tasks[t] for t in self._by_agent.get(slave_id, ())]
+
+    def active(self):
+        """Returns the tasks that are not in a terminal state"""
+        with self._lock:
+            return [task for task in self._tasks.itervalues() if not task.terminal]
+
+    def statuses(self):
+        """Returns the TaskStatus of the active tasks to reconcile them"""
+        statuses = []
+        for task in self.active():
+            status = mesos_pb2.TaskStatus()
+            status.task_id.value = task.taskid
+            status.state = mesos_pb2.TaskState.Value(task.state)
+            if task.slave_id:
+                status.slave_id.value = task.slave_id
+            statuses.append(status)
+        return statuses
+
+    def _add(self, task):
+        self._tasks[task.taskid] = task
+        self._by_cluster.setdefault(task.cluster, set()).add(task.taskid)
+        if task.slave_id:
+            self._by_agent.setdefault(task.slave_id, set()).add(task.taskid)
+
+    def _discard(self, taskid):
+        task = self._tasks.pop(taskid, None)
+        if task is None:
+            return None
+        for index, key in ((self._by_cluster, task.cluster),
+                           (self._by_agent, task.slave_id)):
+            taskids = index.get(key)
+            if taskids is not None:
+                taskids.discard(taskid)
+                if not taskids:
+                    del index[key]
+        return task
@@ -1,33 +1,1683 @@
 """Tests for mesos scheduler"""
+import base64
+import imp
+import importlib
+import json
 import unittest
 import registry
 import utils
+import placement
+import pool
+import reclaim
+import scoring
+import disks
+import writebehind
+import txn
+import snapshot
+import ingest
+import index
+import inventory
+import tasks
+import journal
+import metrics
+import memory
+import kvstore
+import os
+import shutil
+import sys
+import tempfile
 from mesos.interface import mesos_pb2
+import threading
+import time
 import uuid
 
-ENDPOINT = 'http://10.112.0.101:8500/v1/kv'
-
 
 class MockDisk(object):
-    def __init__(self):
+    def __init__(self, name=None):
+        self.name = name
         self.origin = None
 
 
+class MockNode(object):
+    def __init__(self, dn, cpu=1, mem=1024, disks=1, host=None, image=None, preferred=None,
+                 custom_disks=None):
+        self.dn = dn
+        self.cpu = cpu
+        self.mem = mem
+        if custom_disks is not None:
+            self.disks = [MockDisk(name) for name in custom_disks]
+        else:
+            self.disks = [MockDisk('disk{}'.format(i + 1)) for i in range(disks)]
+        self.status = None
+        self._attrs = {'host': host, 'required_node': host or preferred,
+                       'docker_image': image, 'use_custom_disks': custom_disks is not None}
+
+    def get(self, name):
+        return self._attrs.get(name)
+
+    def __str__(self):
+        return self.dn
+
+
+class JobQueueTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = utils.JobQueue()
+        self.queue.append([
+            MockNode('instances/test/example/0.1.0/1/nodes/big', cpu=8, mem=8192),
+            MockNode('instances/test/example/0.1.0/1/nodes/small', cpu=1, mem=1024),
+            MockNode('instances/test/example/0.1.0/1/nodes/pinned', cpu=1, mem=1024,
+                     host='c14-1'),
+            MockNode('instances/test/example/0.1.0/1/nodes/last', cpu=2, mem=2048),
+        ])
+
+    def names(self, jobs):
+        return [job.name.split('--')[-1] for job in jobs]
+
+    def test_append_leaves_the_nodes_to_the_caller(self):
+        self.assertEqual(len(self.queue), 4)
+        # The scheduler marks them as queued in the background
+        self.assertEqual([job.node.status for job in self.queue], [None] * 4)
+
+    def test_candidates_filters_by_shape_keeping_fifo_order(self):
+        available = utils.Resources(cpus=2, mem=4096, disks=['disk1'], host='c14-5')
+        self.assertEqual(self.names(self.queue.candidates(available)), ['small', 'last'])
+
+    def test_candidates_includes_jobs_pinned_to_the_offered_host(self):
+        available = utils.Resources(cpus=16, mem=16384, disks=['disk1'], host='c14-1')
+        self.assertEqual(self.names(self.queue.candidates(available)),
+                         ['big', 'small', 'pinned', 'last'])
+
+    def test_candidates_without_disks(self):
+        available = utils.Resources(cpus=16, mem=16384, disks=None, host='c14-1')
+        self.assertEqual(self.queue.candidates(available), [])
+
+    def test_remove(self):
+        job = self.queue.pending()[1]
+        self.queue.remove(job)
+        self.assertFalse(job.name in self.queue)
+        available = utils.Resources(cpus=2, mem=4096, disks=['disk1'], host='c14-5')
+        self.assertEqual(self.names(self.queue.candidates(available)), ['last'])
+
+
+class PriorityTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = utils.JobQueue(aging=60)
+        self.queue.append([MockNode('instances/test/example/0.1.0/1/nodes/batch')],
+                          priority=utils.BATCH)
+        self.queue.append([MockNode('instances/test/example/0.1.0/2/nodes/normal')])
+        self.queue.append([MockNode('instances/test/example/0.1.0/3/nodes/interactive')],
+                          priority=utils.INTERACTIVE)
+        self.available = utils.Resources(cpus=2, mem=4096, disks=['disk1'])
+
+    def names(self, jobs):
+        return [job.name.split('--')[-1] for job in jobs]
+
+    def test_served_by_priority(self):
+        self.assertEqual(self.names(self.queue.candidates(self.available)),
+                         ['interactive', 'normal', 'batch'])
+        self.assertEqual(self.queue.head().name.split('--')[-1], 'interactive')
+
+    def test_aging_promotes_waiting_jobs(self):
+        batch = self.queue.pending()[0]
+        batch.submitted -= 61
+        self.assertEqual(self.queue.rank(batch), 1)
+        # Same class as normal, but it was submitted before
+        self.assertEqual(self.names(self.queue.candidates(self.available)),
+                         ['interactive', 'batch', 'normal'])
+        batch.submitted -= 60
+        self.assertEqual(self.queue.rank(batch), 0)
+        self.assertEqual(self.queue.head(), batch)
+
+    def test_unknown_priority(self):
+        self.assertRaises(ValueError, self.queue.append,
+                          [MockNode('instances/test/example/0.1.0/4/nodes/node')], None, 'urgent')
+
+
+class MockResponse(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.text = ''
+
+
+class MockSession(object):
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+        self.payloads = []
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        self.requests.append((method, url))
+        self.data = kwargs.get('data')
+        self.payloads.append(self.data)
+        for suffix, status_code in self.responses:
+            if url.endswith(suffix):
+                return MockResponse(status_code)
+        return MockResponse(204)
+
+
+class DisksClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = disks.DisksClient('http://disks')
+
+    def test_allocate_in_bulk(self):
+        self.client.session = MockSession([])
+        self.client.allocate('c14-1', ['disk1', 'disk2'], 'nodedn')
+        self.assertEqual(self.client.session.requests, [('PUT', 'http://disks/c14-1/disks')])
+
+    def test_allocate_falls_back_to_one_request_per_disk(self):
+        self.client.session = MockSession([('/c14-1/disks', 405)])
+        self.client.allocate('c14-1', ['disk1', 'disk2'], 'nodedn')
+        self.assertEqual(self.client.session.requests,
+                         [('PUT', 'http://disks/c14-1/disks'),
+                          ('PUT', 'http://disks/c14-1/disks/disk1'),
+                          ('PUT', 'http://disks/c14-1/disks/disk2')])
+
+    def test_unknown_host_keeps_bulk_requests(self):
+        self.client.session = MockSession([('/c14-1/disks', 404)])
+        self.assertRaises(disks.DiskServiceError,
+                          self.client.allocate, 'c14-1', ['disk1'], 'node1')
+        self.client.allocate('c14-2', ['disk1', 'disk2'], 'node2')
+        self.assertEqual(self.client.session.requests,
+                         [('PUT', 'http://disks/c14-1/disks'),
+                          ('PUT', 'http://disks/c14-2/disks')])
+
+    def test_partial_allocation_is_released(self):
+        self.client.session = MockSession([('/c14-1/disks', 501), ('/disk3', 409)])
+        self.assertRaises(disks.DiskServiceError, self.client.allocate,
+                          'c14-1', ['disk1', 'disk2', 'disk3'], 'nodedn')
+        self.assertEqual(self.client.session.requests,
+                         [('PUT', 'http://disks/c14-1/disks'),
+                          ('PUT', 'http://disks/c14-1/disks/disk1'),
+                          ('PUT', 'http://disks/c14-1/disks/disk2'),
+                          ('PUT', 'http://disks/c14-1/disks/disk3'),
+                          ('PUT', 'http://disks/c14-1/disks/disk1'),
+                          ('PUT', 'http://disks/c14-1/disks/disk2')])
+        self.assertEqual(self.client.session.data['status'], 'free')
+
+    def test_allocate_many_reports_errors_by_allocation(self):
+        self.client.session = MockSession([('/c14-2/disks', 409)])
+        errors = self.client.allocate_many([('c14-1', ['disk1'], 'node1'),
+                                            ('c14-2', ['disk1'], 'node2'),
+                                            ('c14-1', ['disk2'], 'node3')])
+        self.assertEqual(errors[0], None)
+        self.assertTrue(isinstance(errors[1], disks.DiskServiceError))
+        self.assertEqual(errors[2], None)
+
+    def test_release_in_bulk(self):
+        self.client.session = MockSession([])
+        errors = self.client.release_many([('c14-1', ['disk1', 'disk2'], 'nodedn')])
+        self.assertEqual(errors, [None])
+        self.assertEqual(self.client.session.requests, [('PUT', 'http://disks/c14-1/disks')])
+        self.assertEqual(self.client.session.data['status'], 'free')
+
+    def test_release_fallback_keeps_bulk_allocations(self):
+        self.client.session = MockSession([('/c14-1/disks', 405)])
+        self.client.release('c14-1', ['disk1', 'disk2'], 'nodedn')
+        self.assertEqual(len(self.client.session.requests), 3)
+        self.client.session = MockSession([])
+        self.client.allocate('c14-1', ['disk1', 'disk2'], 'nodedn')
+        self.assertEqual(self.client.session.requests, [('PUT', 'http://disks/c14-1/disks')])
+
+    def test_get_host_disks_not_modified(self):
+        self.client.session = MockSession([('/c14-1/disks', 304)])
+        self.assertEqual(self.client.get_host_disks('c14-1', '"v1"'), (None, '"v1"'))
+        self.client.session = MockSession([('/c14-1/disks', 500)])
+        result = self.client.get_many_host_disks([('c14-1', None)])[0]
+        self.assertTrue(isinstance(result, disks.DiskServiceError))
+
+
+class ReclaimerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.released = []
+        self.failing = set()
+        self.requeued = []
+        self.reclaimer = reclaim.Reclaimer(self.release, self.requeued.extend,
+                                           interval=60, batch_size=2)
+
+    def tearDown(self):
+        self.failing.clear()
+        self.reclaimer.stop()
+
+    def release(self, releases):
+        self.released.append(releases)
+        return [disks.DiskServiceError() if host in self.failing else None
+                for host, _, _ in releases]
+
+    def test_releases_are_sent_in_batches(self):
+        for i in range(3):
+            self.reclaimer.release('c14-{}'.format(i), ['disk1'], 'node{}'.format(i))
+        self.reclaimer.release('c14-3', [], 'node3')
+        self.reclaimer.stop()
+        self.assertEqual([len(batch) for batch in self.released], [2, 1])
+        self.assertEqual(self.reclaimer.pending(), 0)
+
+    def test_failed_releases_are_retried(self):
+        self.failing.add('c14-1')
+        self.reclaimer.release('c14-1', ['disk1'], 'node1')
+        self.assertEqual(self.reclaimer.flush(), 0)
+        self.assertEqual(self.reclaimer.pending(), 1)
+        self.failing.clear()
+        self.assertEqual(self.reclaimer.flush(), 1)
+        self.assertEqual(self.reclaimer.pending(), 0)
+
+    def test_failed_releases_are_dropped_after_their_attempts(self):
+        self.reclaimer.attempts = 2
+        self.failing.add('c14-1')
+        self.reclaimer.release('c14-1', ['disk1'], 'node1')
+        self.reclaimer.flush()
+        self.assertEqual(self.reclaimer.pending(), 1)
+        self.reclaimer.flush()
+        self.assertEqual(self.reclaimer.pending(), 0)
+        self.assertEqual(len(self.released), 2)
+
+    def test_retries_are_due_after_their_backoff(self):
+        jobs = utils.JobQueue().append([
+            MockNode('instances/test/example/0.1.0/1/nodes/example1'),
+            MockNode('instances/test/example/0.1.0/2/nodes/example1')])
+        self.reclaimer.retry(jobs[0], 20, now=100)
+        self.reclaimer.retry(jobs[1], 10, now=100)
+        self.assertEqual(self.reclaimer.due(now=105), [])
+        self.assertEqual(self.reclaimer.due(now=115), [jobs[1]])
+        self.assertTrue(self.reclaimer.scheduled(jobs[0].cluster))
+        self.assertEqual(self.reclaimer.cancel(jobs[0].cluster), [jobs[0]])
+        self.assertEqual(self.reclaimer.due(now=200), [])
+
+    def test_backoff(self):
+        self.assertEqual([reclaim.backoff(attempt, 10, 60) for attempt in range(1, 5)],
+                         [10, 20, 40, 60])
+
+
+class MockRegistryObject(object):
+    def __init__(self, dn, log):
+        self.dn = dn
+        self.log = log
+
+    def __setattr__(self, name, value):
+        if name in ('dn', 'log'):
+            super(MockRegistryObject, self).__setattr__(name, value)
+        else:
+            self.log.append((self.dn, name, value))
+
+    def __str__(self):
+        return self.dn
+
+
+class MockBlockingObject(object):
+    def __init__(self):
+        self.__dict__['started'] = threading.Event()
+        self.__dict__['release'] = threading.Event()
+
+    def __setattr__(self, name, value):
+        self.started.set()
+        self.release.wait()
+
+
+class WriteBehindTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.writer = writebehind.WriteBehind()
+        self.log = []
+
+    def tearDown(self):
+        self.writer.stop()
+
+    def test_writes_are_coalesced_and_ordered(self):
+        cluster = MockRegistryObject('instances/test/example/0.1.0/1', self.log)
+        node = MockRegistryObject('instances/test/example/0.1.0/1/nodes/example1', self.log)
+        # Hold the background thread while the writes are recorded
+        blocker = MockBlockingObject()
+        self.writer.set('0', blocker, 'status', 'blocked')
+        blocker.started.wait()
+        self.writer.set('1', cluster, 'step', 1)
+        self.writer.set('1', node, 'status', 'queued')
+        self.writer.set('1', cluster, 'step', 2)
+        blocker.release.set()
+        self.writer.flush()
+        self.assertEqual(self.log, [(node.dn, 'status', 'queued'), (cluster.dn, 'step', 2)])
+
+    def test_stop_flushes_pending_writes(self):
+        cluster = MockRegistryObject('instances/test/example/0.1.0/1', self.log)
+        self.writer.set('1', cluster, 'status', 'scheduled')
+        self.writer.stop()
+        self.writer = writebehind.WriteBehind()
+        self.assertEqual(self.log, [(cluster.dn, 'status', 'scheduled')])
+
+
+    def test_batch_holds_writes_until_it_ends(self):
+        cluster = MockRegistryObject('instances/test/example/0.1.0/1', self.log)
+        with self.writer.batch():
+            self.writer.set('1', cluster, 'step', 1)
+            self.assertEqual(self.writer._ready.qsize(), 0)
+        self.writer.flush()
+        self.assertEqual(self.log, [(cluster.dn, 'step', 1)])
+
+    def test_nested_batches(self):
+        cluster = MockRegistryObject('instances/test/example/0.1.0/1', self.log)
+        with self.writer.batch():
+            with self.writer.batch():
+                self.writer.set('1', cluster, 'step', 1)
+            self.writer.set('2', cluster, 'step', 2)
+            self.assertEqual(self.writer._ready.qsize(), 0)
+        self.writer.flush()
+        self.assertEqual(self.log, [(cluster.dn, 'step', 1), (cluster.dn, 'step', 2)])
+
+    def test_set_does_not_block_while_the_registry_is_slow(self):
+        blocker = MockBlockingObject()
+        self.writer.set('0', blocker, 'status', 'blocked')
+        blocker.started.wait()
+
+        def write():
+            for i in range(2000):
+                cluster = MockRegistryObject('instances/test/example/0.1.0/{}'.format(i),
+                                             self.log)
+                self.writer.set(str(i + 1), cluster, 'step', 1)
+
+        thread = threading.Thread(target=write)
+        thread.daemon = True
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        blocker.release.set()
+        self.writer.flush()
+        self.assertEqual(len(self.log), 2000)
+
+    def test_failed_write_does_not_stop_the_thread(self):
+        cluster = MockRegistryObject('instances/test/example/0.1.0/1', self.log)
+        write = self.writer.write
+
+        def fail_once(key, writes):
+            self.writer.write = write
+            raise ValueError('unexpected')
+
+        self.writer.write = fail_once
+        self.writer.set('1', cluster, 'step', 1)
+        self.writer.flush()
+        self.writer.set('1', cluster, 'step', 2)
+        self.writer.flush()
+        self.assertEqual(self.log, [(cluster.dn, 'step', 2)])
+
+
+class TransactionTestCase(unittest.TestCase):
+
+    def test_commit(self):
+        session = MockSession([('/v1/txn', 200)])
+        transaction = txn.Transaction('http://consul:8500/v1/txn', session=session)
+        transaction.set('instances/test/example/0.1.0/1', 'progress', 50)
+        transaction.set('instances/test/example/0.1.0/1', 'status', 'scheduled')
+        transaction.commit()
+        operations = json.loads(session.data)
+        self.assertEqual([op['KV']['Key'] for op in operations],
+                         ['instances/test/example/0.1.0/1/progress',
+                          'instances/test/example/0.1.0/1/status'])
+        self.assertEqual(base64.b64decode(operations[0]['KV']['Value']), '50')
+        self.assertEqual(len(transaction), 0)
+
+    def test_large_transactions_are_rejected(self):
+        session = MockSession([('/v1/txn', 200)])
+        transaction = txn.Transaction('http://consul:8500/v1/txn', session=session)
+        for i in range(txn.MAX_OPERATIONS + 1):
+            transaction.set('instances/test/example/0.1.0/1', 'attr{}'.format(i), i)
+        self.assertRaises(txn.TransactionError, transaction.commit)
+        self.assertEqual(session.requests, [])
+
+    def test_cluster_attributes_are_committed_last(self):
+        writer = writebehind.WriteBehind(txn_endpoint='http://consul:8500/v1/txn')
+        writer._session = session = MockSession([('/v1/txn', 200)])
+        clusterdn = 'instances/test/example/0.1.0/1'
+        with writer.batch():
+            writer.set(registry.id_from(clusterdn), MockRegistryObject(clusterdn, []),
+                       'status', 'scheduled')
+            for i in range(txn.MAX_OPERATIONS):
+                node = MockRegistryObject('{}/nodes/example{}'.format(clusterdn, i), [])
+                writer.set(registry.id_from(clusterdn), node, 'status', 'queued')
+        writer.stop()
+        transactions = [[op['KV']['Key'] for op in json.loads(data)]
+                        for data in session.payloads]
+        self.assertEqual([len(keys) for keys in transactions], [txn.MAX_OPERATIONS, 1])
+        self.assertEqual(transactions[1], [clusterdn + '/status'])
+
+    def test_rolled_back(self):
+        session = MockSession([('/v1/txn', 409)])
+        transaction = txn.Transaction('http://consul:8500/v1/txn', session=session)
+        transaction.set('instances/test/example/0.1.0/1', 'status', 'scheduled')
+        self.assertRaises(txn.TransactionError, transaction.commit)
+
+    def test_txn_endpoint(self):
+        self.assertEqual(txn.txn_endpoint('http://consul:8500/v1/kv'),
+                         'http://consul:8500/v1/txn')
+
+
+class SnapshotTestCase(unittest.TestCase):
+
+    def setUp(self):
+        dn = 'instances/test/example/0.1.0/1'
+        self.snapshot = snapshot.ClusterSnapshot(dn, {
+            dn + '/status': 'queued',
+            dn + '/nodes/': '',
+            dn + '/nodes/example1/cpu': '2',
+            dn + '/nodes/example1/mem': '2048',
+            dn + '/nodes/example1/disks/disk1/origin': '',
+            dn + '/nodes/example1/disks/disk2/origin': '',
+            dn + '/nodes/example2/cpu': '1',
+            dn + '/nodes/example2/mem': '1024',
+            dn + '/nodes/example2/use_custom_disks': 'True',
+            dn + '/nodes/example2/host': 'c14-1',
+            dn + '/nodes/example2/required_node': 'c14-1',
+            dn + '/nodes/example2/disks/disk7/origin': '',
+        })
+
+    def test_nodes(self):
+        self.assertEqual([str(node) for node in self.snapshot.nodes],
+                         ['instances/test/example/0.1.0/1/nodes/example1',
+                          'instances/test/example/0.1.0/1/nodes/example2'])
+
+    def test_jobs_from_snapshot(self):
+        node1, node2 = self.snapshot.nodes
+        job = utils.Job(node1, self.snapshot.view(node1))
+        self.assertEqual((job.cpus, job.mem, job.disks, job.host), (2, 2048, 2, None))
+        self.assertEqual(job.cluster, 'instances--test--example--0__1__0--1')
+        job = utils.Job(node2, self.snapshot.view(node2))
+        self.assertEqual((job.cpus, job.mem, job.disks, job.host), (1, 1024, ['disk7'], 'c14-1'))
+
+    def test_missing_attribute(self):
+        view = self.snapshot.view(self.snapshot.nodes[0])
+        self.assertEqual(view.get('host'), None)
+        self.assertRaises(registry.KeyDoesNotExist, getattr, view, 'host')
+
+    def test_cache(self):
+        cache = snapshot.SnapshotCache(ttl=60)
+        cache._snapshots[self.snapshot.clusterdn] = self.snapshot
+        self.assertTrue(cache.get(self.snapshot.clusterdn) is self.snapshot)
+
+
+class IngestorTestCase(unittest.TestCase):
+
+    def test_accept_passes_options(self):
+        submitted = []
+        ingestor = ingest.Ingestor(lambda cluster, **options: submitted.append(options))
+        ingestor.accept(['instances/test/example/0.1.0/1'], priority='batch')
+        ingestor.stop()
+        self.assertEqual(submitted, [{'priority': 'batch'}])
+
+    def test_accept_enqueues_in_background(self):
+        submitted = []
+
+        def submit(cluster):
+            if str(cluster).endswith('/2'):
+                raise registry.KeyDoesNotExist('instances/test/example/0.1.0/2')
+            submitted.append(str(cluster))
+
+        ingestor = ingest.Ingestor(submit)
+        clusterids = ingestor.accept(['instances/test/example/0.1.0/1',
+                                      'instances/test/example/0.1.0/2'])
+        ingestor.stop()
+        self.assertEqual(clusterids, ['instances--test--example--0__1__0--1',
+                                      'instances--test--example--0__1__0--2'])
+        self.assertEqual(submitted, ['instances/test/example/0.1.0/1'])
+        self.assertEqual(ingestor.state(clusterids[0]), {'state': 'queued'})
+        self.assertEqual(ingestor.state(clusterids[1])['state'], 'failed')
+        self.assertEqual(ingestor.state('unknown'), None)
+
+
+    def test_ids_are_normalized(self):
+        ingestor = ingest.Ingestor(lambda cluster: None)
+        clusterids = ingestor.accept(['instances/test/example/0.1.0/1/'])
+        ingestor.stop()
+        self.assertEqual(clusterids, ['instances--test--example--0__1__0--1'])
+        self.assertEqual(ingestor.state(clusterids[0]), {'state': 'queued'})
+
+class ClusterIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.index = index.ClusterIndex()
+        self.index.update('cluster1', 'node1', 'queued')
+        self.index.update('cluster1', 'node2', 'queued')
+        self.index.update('cluster2', 'node1', 'queued')
+        self.index.update('cluster3', 'node1', 'scheduled')
+
+    def test_cluster(self):
+        view = self.index.cluster('cluster1')
+        self.assertEqual(view['states'], {'queued': 2})
+        self.assertEqual(self.index.cluster('unknown'), None)
+
+    def test_views_are_cached_until_the_cluster_changes(self):
+        view = self.index.cluster('cluster1')
+        self.assertTrue(self.index.cluster('cluster1') is view)
+        self.index.update('cluster1', 'node1', 'scheduled')
+        view = self.index.cluster('cluster1')
+        self.assertEqual(view['states'], {'queued': 1, 'scheduled': 1})
+
+    def test_page_by_state(self):
+        page = self.index.page('queued', limit=1)
+        self.assertEqual([c['id'] for c in page['clusters']], ['cluster1'])
+        self.assertEqual((page['total'], page['next']), (2, 1))
+        page = self.index.page('queued', limit=1, cursor=page['next'])
+        self.assertEqual([c['id'] for c in page['clusters']], ['cluster2'])
+        self.assertEqual(page['next'], None)
+
+    def test_page_after_state_change(self):
+        self.index.update('cluster2', 'node1', 'scheduled')
+        self.assertEqual([c['id'] for c in self.index.page('scheduled')['clusters']],
+                         ['cluster3', 'cluster2'])
+        self.index.remove('cluster1')
+        self.assertEqual(self.index.page('queued')['total'], 0)
+
+    def test_oldest_finished_clusters_are_forgotten(self):
+        self.index.max_finished = 1
+        self.index.finish('cluster1')
+        self.index.finish('cluster3')
+        self.assertEqual(self.index.cluster('cluster1'), None)
+        self.assertEqual(self.index.counts(), {'queued': 1, 'scheduled': 1})
+        # Running again, it is no longer finished
+        self.index.update('cluster3', 'node1', 'queued')
+        self.index.finish('cluster2')
+        self.assertEqual(self.index.page()['total'], 2)
+
+
+class TaskTableTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tasks = tasks.TaskTable()
+        self.taskid = registry.id_from('instances/test/example/0.1.0/1/nodes/example1')
+        self.clusterid = registry.id_from('instances/test/example/0.1.0/1')
+        self.tasks.launched(self.taskid, self.clusterid, 'slave1', 'c14-1')
+
+    def test_update(self):
+        task = self.tasks.update(self.taskid, 'TASK_RUNNING', 'slave1')
+        self.assertEqual(task.state, 'TASK_RUNNING')
+        self.assertEqual(self.tasks.cluster(self.clusterid), [task])
+        self.assertEqual(self.tasks.agent('slave1'), [task])
+
+    def test_update_unknown_task(self):
+        taskid = registry.id_from('instances/test/example/0.1.0/2/nodes/example1')
+        task = self.tasks.update(taskid, 'TASK_RUNNING', 'slave2')
+        self.assertEqual(task.cluster, registry.id_from('instances/test/example/0.1.0/2'))
+        self.assertEqual(self.tasks.agent('slave2'), [task])
+
+    def test_statuses_only_include_active_tasks(self):
+        taskid = registry.id_from('instances/test/example/0.1.0/1/nodes/example2')
+        self.tasks.launched(taskid, self.clusterid, 'slave1', 'c14-1')
+        self.tasks.update(taskid, 'TASK_FINISHED')
+        statuses = self.tasks.statuses()
+        self.assertEqual([status.task_id.value for status in statuses], [self.taskid])
+        self.assertEqual(statuses[0].state, mesos_pb2.TASK_STAGING)
+        self.assertEqual(statuses[0].slave_id.value, 'slave1')
+
+    def test_progress_of_ended_tasks_is_ignored(self):
+        self.assertEqual(self.tasks.progress(self.taskid, 'pull').phase, 'pull')
+        self.tasks.update(self.taskid, 'TASK_FINISHED')
+        self.assertEqual(self.tasks.progress(self.taskid, 'create'), None)
+        self.assertEqual(self.tasks.get(self.taskid).phase, 'pull')
+
+    def test_hosts_count_active_tasks(self):
+        taskid = registry.id_from('instances/test/example/0.1.0/1/nodes/example2')
+        self.tasks.launched(taskid, self.clusterid, 'slave1', 'c14-1')
+        self.assertEqual(self.tasks.hosts(self.clusterid), {'c14-1': 2})
+        self.tasks.update(taskid, 'TASK_FAILED')
+        self.assertEqual(self.tasks.hosts(self.clusterid), {'c14-1': 1})
+
+    def test_remove(self):
+        self.tasks.remove(self.taskid)
+        self.assertEqual(self.tasks.get(self.taskid), None)
+        self.assertEqual(self.tasks.cluster(self.clusterid), [])
+
+    def test_state_name(self):
+        self.assertEqual(tasks.state_name('TASK_RUNNING'), 'running')
+
+
+class ProgressTestCase(unittest.TestCase):
+
+    def test_advance(self):
+        progress = utils.Progress()
+        progress.start('1', 2)
+        self.assertEqual(progress.advance('1'), [('step', 1), ('progress', 50)])
+        self.assertEqual(progress.advance('1'),
+                         [('step', 2), ('progress', 100), ('status', 'scheduled')])
+
+    def test_requeue(self):
+        progress = utils.Progress()
+        progress.requeue('1', 2)
+        self.assertEqual(progress.advance('1'),
+                         [('step', 2), ('progress', 100), ('status', 'scheduled')])
+
+
+class JournalTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'journal')
+        self.journal = journal.Journal(self.path)
+        nodes = [MockNode('instances/test/example/0.1.0/1/nodes/example{}'.format(i))
+                 for i in range(3)]
+        self.jobs = utils.JobQueue().append(nodes)
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.directory)
+
+    def replay(self):
+        return journal.Journal(self.path).replay()
+
+    def test_replay(self):
+        self.journal.enqueued(self.jobs, 3)
+        launched = self.jobs[0]
+        launched.slave_id = 'slave1'
+        launched.hostname = 'c14-1'
+        self.journal.launched([launched])
+        self.journal.removed([self.jobs[1]])
+        queued, running = self.replay()
+        self.assertEqual(queued.keys(), [self.jobs[2].name])
+        self.assertEqual(running[launched.name]['hostname'], 'c14-1')
+        self.assertEqual(running[launched.name]['allocated'], 1)
+        job = utils.Job.from_record(queued[self.jobs[2].name])
+        self.assertEqual(str(job.node), str(self.jobs[2].node))
+        self.assertEqual(job.required.disks, 1)
+
+    def test_finished_tasks_are_forgotten(self):
+        self.journal.enqueued(self.jobs[:1], 3)
+        self.jobs[0].slave_id = 'slave1'
+        self.journal.launched(self.jobs[:1])
+        self.journal.finished(self.jobs[0].name)
+        queued, running = self.replay()
+        self.assertEqual(len(queued), 0)
+        self.assertEqual(len(running), 0)
+
+    def test_compaction(self):
+        self.journal.compact_every = 2
+        self.journal.enqueued(self.jobs, 3)
+        self.assertTrue(os.path.exists(self.journal.snapshot_path))
+        self.assertEqual(os.path.getsize(self.path), 0)
+        self.journal.removed([self.jobs[0]])
+        queued, _ = self.replay()
+        self.assertEqual(queued.keys(), [job.name for job in self.jobs[1:]])
+
+    def test_corrupted_last_entry(self):
+        self.journal.enqueued(self.jobs[:1], 3)
+        with open(self.path, 'a') as f:
+            f.write('{"op": "enq')
+        queued, _ = self.replay()
+        self.assertEqual(queued.keys(), [self.jobs[0].name])
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.registered = list(metrics.REGISTRY)
+
+    def tearDown(self):
+        metrics.REGISTRY[:] = self.registered
+
+    def test_counter(self):
+        counter = metrics.Counter('test_offers_total', 'Offers', ['result'])
+        counter.inc(3, result='received')
+        counter.inc(result='declined')
+        self.assertEqual(counter.value(result='received'), 3)
+        self.assertEqual(counter.samples(), ['test_offers_total{result="declined"} 1.0',
+                                             'test_offers_total{result="received"} 3.0'])
+
+    def test_histogram(self):
+        histogram = metrics.Histogram('test_seconds', 'Latency', buckets=(0.1, 1))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        self.assertEqual(histogram.samples(), ['test_seconds_bucket{le="0.1"} 1',
+                                               'test_seconds_bucket{le="1.0"} 2',
+                                               'test_seconds_bucket{le="+Inf"} 3',
+                                               'test_seconds_sum 5.55',
+                                               'test_seconds_count 3'])
+
+    def test_gauge(self):
+        gauge = metrics.Gauge('test_jobs', 'Jobs', ['state'])
+        self.assertEqual(gauge.samples(), [])
+        gauge.set_function(lambda: {'queued': 2})
+        self.assertEqual(gauge.samples(), ['test_jobs{state="queued"} 2.0'])
+
+    def test_render(self):
+        metrics.Counter('test_total', 'A "test" counter').inc()
+        text = metrics.render()
+        self.assertIn('# TYPE test_total counter\ntest_total 1.0\n', text)
+        self.assertIn('# TYPE scheduler_resource_offers_seconds histogram', text)
+
+
+class MemoryKVTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.kv = memory.MemoryKV({'instances/test/1/status': 'queued',
+                                   'instances/test/1/nodes/node1/cpu': 2,
+                                   'instances/test/10/status': 'running'})
+        self.previous = registry._kv
+        registry._kv = self.kv
+
+    def tearDown(self):
+        registry._kv = self.previous
+
+    def test_get(self):
+        self.assertEqual(self.kv.get('/instances/test/1/nodes/node1/cpu'), '2')
+        self.assertRaises(kvstore.KeyDoesNotExist, self.kv.get, 'instances/test/2')
+
+    def test_recurse_only_returns_the_subtree(self):
+        self.assertEqual(sorted(self.kv.recurse('instances/test/1/')),
+                         ['instances/test/1/nodes/node1/cpu', 'instances/test/1/status'])
+
+    def test_delete_recursive(self):
+        self.kv.delete('instances/test/1/', recursive=True)
+        self.assertEqual(self.kv.keys, ['instances/test/10/status'])
+
+    def test_registry_objects(self):
+        cluster = registry.Cluster('instances/test/1')
+        cluster.progress = 50
+        self.assertEqual(cluster.progress, '50')
+        self.assertRaises(registry.KeyDoesNotExist, getattr, cluster, 'step')
+
+    def test_snapshot_of_unknown_cluster(self):
+        self.assertRaises(kvstore.KeyDoesNotExist,
+                          snapshot.ClusterSnapshot.fetch, 'instances/test/2')
+        # It exists but has no nodes
+        self.assertRaises(kvstore.KeyDoesNotExist,
+                          snapshot.ClusterSnapshot.fetch, 'instances/test/10')
+
+
+class MemoryDisksClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = memory.MemoryDisksClient()
+        self.client.add_host('c14-1', ['disk1', 'disk2'])
+
+    def test_allocate(self):
+        self.client.allocate('c14-1', ['disk1', 'disk2'], 'node1')
+        info = self.client.get_disk_info('c14-1', 'disk2')
+        self.assertEqual((info['status'], info['clustername'], info['path']),
+                         ('used', 'node1', '/data/2'))
+
+    def test_allocate_used_disk(self):
+        self.client.set_disk_as_used('c14-1', 'node1', 'disk1')
+        self.assertRaises(disks.DiskServiceError, self.client.allocate,
+                          'c14-1', ['disk2', 'disk1'], 'node2')
+        self.assertEqual(self.client.get_disk_info('c14-1', 'disk2')['status'], 'free')
+
+    def test_allocate_failed_disk(self):
+        self.client.set_status('c14-1', 'disk1', 'failed')
+        self.assertRaises(disks.DiskServiceError, self.client.allocate,
+                          'c14-1', ['disk1'], 'node1')
+
+    def test_release(self):
+        self.client.allocate('c14-1', ['disk1', 'disk2'], 'node1')
+        self.assertRaises(disks.DiskServiceError, self.client.release,
+                          'c14-1', ['disk1'], 'node2')
+        self.assertEqual(self.client.release_many([('c14-1', ['disk1', 'disk2'], 'node1')]),
+                         [None])
+        self.assertEqual(self.client.get_disk_info('c14-1', 'disk1')['status'], 'free')
+
+    def test_host_disks_etag(self):
+        info, etag = self.client.get_host_disks('c14-1')
+        self.assertEqual(sorted(info), ['disk1', 'disk2'])
+        self.assertEqual(self.client.get_host_disks('c14-1', etag), (None, etag))
+        self.client.allocate('c14-1', ['disk1'], 'node1')
+        info, _ = self.client.get_host_disks('c14-1', etag)
+        self.assertEqual(info['disk1']['status'], 'used')
+
+    def test_allocate_many(self):
+        errors = self.client.allocate_many([('c14-1', ['disk1'], 'node1'),
+                                            ('c14-1', ['disk1'], 'node2'),
+                                            ('c14-2', ['disk1'], 'node3')])
+        self.assertEqual(errors[0], None)
+        self.assertTrue(isinstance(errors[1], disks.DiskServiceError))
+        self.assertEqual(errors[2], None)
+
+
+executor = imp.load_source('bigdata_executor',
+                           os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                        'bigdata-executor.py'))
+
+
+class MockExecutorDriver(object):
+    def __init__(self):
+        self.updates = []
+        self.messages = []
+        self.lock = threading.Lock()
+
+    def sendFrameworkMessage(self, message):
+        with self.lock:
+            self.messages.append(json.loads(message))
+
+    def sendStatusUpdate(self, update):
+        with self.lock:
+            self.updates.append((update.task_id.value,
+                                 mesos_pb2.TaskState.Name(update.state)))
+
+    def states(self, taskid):
+        with self.lock:
+            return [state for t, state in self.updates if t == taskid]
+
+    def wait_for(self, taskid, state, timeout=5):
+        """Wait until the task is reported in the given state, as its end is
+        sent by the thread watching its process"""
+        deadline = time.time() + timeout
+        while state not in self.states(taskid) and time.time() < deadline:
+            time.sleep(0.001)
+        return self.states(taskid)
+
+
+class MockProcess(object):
+    """docker-executor process that runs until it is released or killed"""
+    def __init__(self, args):
+        self.args = args
+        self.returncode = None
+        self.done = threading.Event()
+
+    def wait(self):
+        self.done.wait()
+        return self.returncode
+
+    def finish(self, returncode=0):
+        self.returncode = returncode
+        self.done.set()
+
+    def kill(self):
+        self.finish(-9)
+
+
+class MockSubprocess(object):
+    """Records the processes started, destroy and pull processes end right away"""
+    def __init__(self):
+        self.processes = []
+        self.destroyed = []
+        self.pulls = []
+        self.hang_destroy = False
+        self.hang_pull = False
+        self.started = threading.Semaphore(0)
+        self.calls = []
+
+    def call(self, args):
+        self.calls.append(args)
+        return 0
+
+    def Popen(self, args):
+        process = MockProcess(args)
+        if args[1] == 'destroy':
+            self.destroyed.append(args[-1])
+            if not self.hang_destroy:
+                process.finish()
+            return process
+        if args[1] == 'pull':
+            self.calls.append(args)
+            self.pulls.append(process)
+            if not self.hang_pull:
+                process.finish()
+            return process
+        self.processes.append(process)
+        self.started.release()
+        return process
+
+
+def make_task(nodedn, image=None):
+    task = mesos_pb2.TaskInfo()
+    task.task_id.value = registry.id_from(nodedn)
+    data = {'node_dn': nodedn}
+    if image:
+        data['image'] = image
+    task.data = json.dumps(data)
+    return task
+
+
+class DiskInventoryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = utils.disks_client
+        utils.disks_client = memory.MemoryDisksClient()
+        utils.disks_client.add_host('c14-1', ['disk1', 'disk2', 'disk3'])
+        self.inventory = inventory.DiskInventory(ttl=30)
+
+    def tearDown(self):
+        utils.disks_client = self.client
+
+    def test_used_and_failed_disks_are_unavailable(self):
+        utils.disks_client.allocate('c14-1', ['disk1'], 'node1')
+        utils.disks_client.set_status('c14-1', 'disk2', 'failed')
+        self.inventory.refresh(['c14-1', 'c14-2'], now=100)
+        self.assertEqual(self.inventory.unavailable(['c14-1', 'c14-2']),
+                         {'c14-1': set(['disk1', 'disk2'])})
+
+    def test_unknown_statuses_are_left_to_the_allocation(self):
+        utils.disks_client.set_status('c14-1', 'disk3', 'maintenance')
+        self.inventory.refresh(['c14-1'], now=100)
+        self.assertEqual(self.inventory.unavailable(['c14-1']), {})
+
+    def test_refresh_after_ttl(self):
+        self.inventory.refresh(['c14-1'], now=100)
+        utils.disks_client.allocate('c14-1', ['disk1'], 'node1')
+        self.inventory.refresh(['c14-1'], now=120)
+        self.assertEqual(self.inventory.unavailable(['c14-1']), {})
+        self.inventory.refresh(['c14-1'], now=130)
+        self.assertEqual(self.inventory.unavailable(['c14-1']), {'c14-1': set(['disk1'])})
+
+    def test_allocated_disks_are_unavailable_until_read_again(self):
+        self.inventory.refresh(['c14-1'], now=100)
+        self.inventory.used('c14-1', ['disk3'])
+        self.assertEqual(self.inventory.unavailable(['c14-1']), {'c14-1': set(['disk3'])})
+        self.inventory.invalidate('c14-1')
+        self.inventory.refresh(['c14-1'], now=101)
+        self.assertEqual(self.inventory.unavailable(['c14-1']), {})
+
+
+class ExecutorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.subprocess = MockSubprocess()
+        self.original = executor.subprocess
+        executor.subprocess = self.subprocess
+        self.driver = MockExecutorDriver()
+
+    def tearDown(self):
+        for process in self.subprocess.processes:
+            process.finish()
+        executor.subprocess = self.original
+
+    def test_concurrency_is_bounded(self):
+        self.subprocess.hang_pull = True
+        bigdata = executor.BigDataExecutor(workers=2, timeout=60)
+        tasks = [make_task('instances/test/example/0.1.0/1/nodes/node{}'.format(i),
+                           'hadoop:2.{}'.format(i))
+                 for i in range(3)]
+        for task in tasks:
+            bigdata.launchTask(self.driver, task)
+        while len(self.subprocess.pulls) < 2:
+            time.sleep(0.001)
+        self.assertEqual(self.driver.states(tasks[2].task_id.value), [])
+        self.subprocess.pulls[0].finish()
+        self.subprocess.started.acquire()
+        while len(self.subprocess.pulls) < 3:
+            time.sleep(0.001)
+        # The queue is FIFO
+        self.assertEqual(self.subprocess.pulls[2].args[-1], 'hadoop:2.2')
+        for pull in self.subprocess.pulls:
+            pull.finish()
+        bigdata.pool.shutdown(wait=True)
+
+    def test_running_tasks_do_not_hold_workers(self):
+        bigdata = executor.BigDataExecutor(workers=1, timeout=0)
+        tasks = [make_task('instances/test/example/0.1.0/1/nodes/node{}'.format(i))
+                 for i in range(3)]
+        for task in tasks:
+            bigdata.launchTask(self.driver, task)
+        for _ in tasks:
+            self.subprocess.started.acquire()
+        bigdata.pool.shutdown(wait=True)
+        first = self.subprocess.processes[0]
+        first.finish()
+        self.assertEqual(self.driver.wait_for(tasks[0].task_id.value, 'TASK_FINISHED'),
+                         ['TASK_STARTING', 'TASK_RUNNING', 'TASK_FINISHED'])
+        for task in tasks[1:]:
+            self.assertEqual(self.driver.states(task.task_id.value),
+                             ['TASK_STARTING', 'TASK_RUNNING'])
+
+    def test_start_timeout(self):
+        self.subprocess.hang_pull = True
+        bigdata = executor.BigDataExecutor(workers=1, timeout=0.01)
+        task = make_task('instances/test/example/0.1.0/1/nodes/node1', 'hadoop:2.7')
+        bigdata.launchTask(self.driver, task)
+        bigdata.pool.shutdown(wait=True)
+        self.assertEqual(self.driver.states(task.task_id.value),
+                         ['TASK_STARTING', 'TASK_FAILED'])
+        self.assertEqual(self.subprocess.processes, [])
+        self.assertFalse(bigdata.images.cached('hadoop:2.7'))
+
+    def test_task_outlives_the_timeout(self):
+        bigdata = executor.BigDataExecutor(workers=1, timeout=0.01)
+        task = make_task('instances/test/example/0.1.0/1/nodes/node1', 'hadoop:2.7')
+        bigdata.launchTask(self.driver, task)
+        self.subprocess.started.acquire()
+        bigdata.pool.shutdown(wait=True)
+        time.sleep(0.05)
+        self.assertEqual(self.driver.states(task.task_id.value),
+                         ['TASK_STARTING', 'TASK_RUNNING'])
+        self.assertEqual(bigdata.running_dockers, ['instances/test/example/0.1.0/1/nodes/node1'])
+        self.subprocess.processes[0].finish()
+        self.assertEqual(self.driver.wait_for(task.task_id.value, 'TASK_FINISHED'),
+                         ['TASK_STARTING', 'TASK_RUNNING', 'TASK_FINISHED'])
+
+    def launch(self, bigdata, count, image=None):
+        tasks = [make_task('instances/test/example/0.1.0/1/nodes/node{}'.format(i), image)
+                 for i in range(count)]
+        for task in tasks:
+            bigdata.launchTask(self.driver, task)
+        return [task.task_id.value for task in tasks]
+
+    def test_kill_queued_task(self):
+        self.subprocess.hang_pull = True
+        bigdata = executor.BigDataExecutor(workers=1, timeout=60)
+        starting, queued = self.launch(bigdata, 2, 'hadoop:2.7')
+        while not self.subprocess.pulls:
+            time.sleep(0.001)
+        bigdata.killTask(self.driver, mesos_pb2.TaskID(value=queued))
+        self.assertEqual(self.driver.states(queued), ['TASK_KILLED'])
+        self.subprocess.pulls[0].finish()
+        bigdata.pool.shutdown(wait=True)
+        self.assertEqual(len(self.subprocess.processes), 1)
+        self.assertEqual(self.subprocess.destroyed, [])
+
+    def test_kill_running_task(self):
+        bigdata = executor.BigDataExecutor(workers=1, timeout=0)
+        taskid, = self.launch(bigdata, 1)
+        self.subprocess.started.acquire()
+        bigdata.killTask(self.driver, mesos_pb2.TaskID(value=taskid))
+        bigdata.teardown.shutdown(wait=True)
+        bigdata.pool.shutdown(wait=True)
+        self.assertEqual(self.subprocess.destroyed, [registry.dn_from(taskid)])
+        self.assertEqual(self.driver.states(taskid),
+                         ['TASK_STARTING', 'TASK_RUNNING', 'TASK_KILLED'])
+
+    def test_shutdown(self):
+        bigdata = executor.BigDataExecutor(workers=1, timeout=60)
+        running = self.launch(bigdata, 2)
+        self.subprocess.started.acquire()
+        self.subprocess.started.acquire()
+        self.subprocess.hang_pull = True
+        starting = make_task('instances/test/example/0.1.0/1/nodes/node2', 'hadoop:2.7')
+        queued = make_task('instances/test/example/0.1.0/1/nodes/node3', 'hadoop:2.7')
+        bigdata.launchTask(self.driver, starting)
+        bigdata.launchTask(self.driver, queued)
+        while not self.subprocess.pulls:
+            time.sleep(0.001)
+        bigdata.shutdown(self.driver)
+        self.assertEqual(sorted(self.subprocess.destroyed),
+                         sorted(registry.dn_from(taskid)
+                                for taskid in running + [starting.task_id.value]))
+        self.assertEqual(self.driver.states(queued.task_id.value), ['TASK_KILLED'])
+        for taskid in running + [starting.task_id.value]:
+            self.assertEqual(self.driver.states(taskid)[-1], 'TASK_KILLED')
+        self.subprocess.pulls[0].finish()
+        bigdata.pool.shutdown(wait=True)
+        self.assertEqual(len(self.subprocess.processes), 2)
+
+    def test_shutdown_deadline(self):
+        self.subprocess.hang_destroy = True
+        bigdata = executor.BigDataExecutor(workers=1, timeout=0, destroy_timeout=0.01)
+        taskid, = self.launch(bigdata, 1)
+        self.subprocess.started.acquire()
+        bigdata.shutdown(self.driver)
+        self.assertEqual(self.driver.states(taskid),
+                         ['TASK_STARTING', 'TASK_RUNNING', 'TASK_FAILED'])
+
+
+class ImageCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.subprocess = MockSubprocess()
+        self.original = executor.subprocess
+        executor.subprocess = self.subprocess
+        self.reported = []
+        self.cache = executor.ImageCache(2, self.reported.append)
+
+    def tearDown(self):
+        executor.subprocess = self.original
+
+    def test_prefetch_pulls_once(self):
+        self.cache.prefetch(['hadoop:2.7', 'spark:2.1', 'hadoop:2.7'])
+        self.cache.pool.shutdown(wait=True)
+        self.assertEqual(self.subprocess.calls,
+                         [['docker', 'pull', 'hadoop:2.7'], ['docker', 'pull', 'spark:2.1']])
+        self.assertEqual(self.reported[-1], ['hadoop:2.7', 'spark:2.1'])
+
+    def test_least_recently_used_is_evicted(self):
+        self.cache.add('hadoop:2.7')
+        self.cache.add('spark:2.1')
+        self.cache.add('hadoop:2.7')
+        self.cache.add('mpi:1.0')
+        self.assertEqual(self.subprocess.calls, [['docker', 'rmi', 'spark:2.1']])
+        self.assertEqual(self.reported[-1], ['hadoop:2.7', 'mpi:1.0'])
+
+    def test_executor_handles_hints(self):
+        bigdata = executor.BigDataExecutor(image_cache_size=2)
+        driver = MockExecutorDriver()
+        bigdata.frameworkMessage(driver, json.dumps({'type': 'prefetch',
+                                                     'images': ['hadoop:2.7']}))
+        bigdata.frameworkMessage(driver, 'garbage')
+        bigdata.images.pool.shutdown(wait=True)
+        self.assertEqual(driver.messages, [{'type': 'images', 'images': ['hadoop:2.7']}])
+
+    def test_executor_ignores_hints_without_images(self):
+        bigdata = executor.BigDataExecutor(image_cache_size=2)
+        driver = MockExecutorDriver()
+        bigdata.frameworkMessage(driver, json.dumps({'type': 'prefetch'}))
+        bigdata.frameworkMessage(driver, json.dumps({'type': 'prefetch', 'images': 'hadoop:2.7'}))
+        bigdata.images.pool.shutdown(wait=True)
+        self.assertEqual(self.subprocess.calls, [])
+        self.assertEqual(driver.messages, [])
+
+
+class ProgressReporterTestCase(unittest.TestCase):
+
+    def test_phases_are_coalesced(self):
+        driver = MockExecutorDriver()
+        reporter = executor.ProgressReporter(interval=0.05)
+        reporter.report(driver, 'task1', 'pull')
+        reporter.report(driver, 'task1', 'create')
+        reporter.report(driver, 'task2', 'pull')
+        reporter.report(driver, 'task3', 'pull')
+        reporter.discard('task3')
+        self.assertEqual(len(driver.messages), 1)
+        reporter.timer.join()
+        self.assertEqual(driver.messages,
+                         [{'type': 'progress', 'tasks': {'task1': 'pull'}},
+                          {'type': 'progress', 'tasks': {'task1': 'create', 'task2': 'pull'}}])
+
+    def test_task_reports_its_phases(self):
+        subprocess = MockSubprocess()
+        original = executor.subprocess
+        executor.subprocess = subprocess
+        try:
+            driver = MockExecutorDriver()
+            bigdata = executor.BigDataExecutor(workers=1, timeout=0, progress_interval=0)
+            task = make_task('instances/test/example/0.1.0/1/nodes/node1')
+            task.data = json.dumps({'node_dn': registry.dn_from(task.task_id.value),
+                                    'image': 'hadoop:2.7'})
+            bigdata.launchTask(driver, task)
+            subprocess.started.acquire()
+            subprocess.processes[0].finish()
+            bigdata.pool.shutdown(wait=True)
+        finally:
+            executor.subprocess = original
+        self.assertEqual(subprocess.calls, [['docker', 'pull', 'hadoop:2.7']])
+        self.assertEqual([message['tasks'] for message in driver.messages
+                          if message['type'] == 'progress'],
+                         [{task.task_id.value: 'pull'}, {task.task_id.value: 'create'}])
+
+
+def make_offer(hostname, cpus=1, mem=1024, disks=('disk1',)):
+    offer = mesos_pb2.Offer()
+    offer.id.value = str(uuid.uuid4())
+    offer.framework_id.value = 'PaaS'
+    offer.slave_id.value = hostname
+    offer.hostname = hostname
+
+    offer_cpus = offer.resources.add()
+    offer_cpus.name = "cpus"
+    offer_cpus.type = mesos_pb2.Value.SCALAR
+    offer_cpus.scalar.value = cpus
+
+    offer_mem = offer.resources.add()
+    offer_mem.name = "mem"
+    offer_mem.type = mesos_pb2.Value.SCALAR
+    offer_mem.scalar.value = mem
+
+    offer_disks = offer.resources.add()
+    offer_disks.name = "dataDisks"
+    offer_disks.type = mesos_pb2.Value.SET
+    for disk in disks:
+        offer_disks.set.item.append(disk)
+
+    return offer
+
+
+class PlacementTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = utils.JobQueue()
+        self.queue.append([
+            MockNode('instances/test/example/0.1.0/1/nodes/big', cpu=4, mem=4096),
+            MockNode('instances/test/example/0.1.0/1/nodes/small', cpu=1, mem=1024),
+        ])
+        self.offers = [
+            make_offer('c14-1', cpus=8, mem=8192, disks=('disk1', 'disk2')),
+            make_offer('c14-2', cpus=4, mem=4096, disks=('disk1', 'disk2')),
+        ]
+
+    def placed(self, plans):
+        return [[job.name.split('--')[-1] for job, _ in plan.assignments]
+                for plan in plans]
+
+    def test_first_fit(self):
+        plans = placement.place(self.offers, self.queue, placement.FIRST_FIT)
+        self.assertEqual(self.placed(plans), [['big', 'small'], []])
+
+    def test_best_fit(self):
+        plans = placement.place(self.offers, self.queue, placement.BEST_FIT)
+        self.assertEqual(self.placed(plans), [['small'], ['big']])
+
+    def test_worst_fit(self):
+        plans = placement.place(self.offers, self.queue, placement.WORST_FIT)
+        self.assertEqual(self.placed(plans), [['big'], ['small']])
+
+    def test_assignment_reserves_resources(self):
+        plans = placement.place(self.offers, self.queue, placement.FIRST_FIT)
+        self.assertEqual(plans[0].available.cpus, 3)
+        self.assertEqual(plans[0].available.disks, [])
+        self.assertEqual(plans[0].assignments[0][1], ['disk1'])
+        self.assertEqual(len(self.queue), 2)
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, placement.place, self.offers, self.queue, 'random')
+
+    def test_pinned_jobs_of_any_offered_host_are_candidates(self):
+        self.queue.append([MockNode('instances/test/example/0.1.0/2/nodes/pinned', host='c14-2'),
+                           MockNode('instances/test/example/0.1.0/2/nodes/elsewhere',
+                                    host='c14-9')])
+        plans = placement.place(self.offers, self.queue, placement.FIRST_FIT)
+        self.assertEqual(self.placed(plans), [['big', 'small'], ['pinned']])
+
+    def test_fits_any(self):
+        self.assertTrue(self.queue.fits_any(utils.Resources(1, 1024, ['disk1'], 'c14-1')))
+        self.assertFalse(self.queue.fits_any(utils.Resources(1, 512, ['disk1'], 'c14-1')))
+        self.assertFalse(self.queue.fits_any(utils.Resources(8, 8192, None, 'c14-1')))
+
+    def test_fits_any_with_specific_disks(self):
+        queue = utils.JobQueue()
+        queue.append([MockNode('instances/test/example/0.1.0/2/nodes/pinned',
+                               custom_disks=['disk2'])])
+        available = utils.Resources(1, 1024, ['disk1'], 'c14-1')
+        self.assertFalse(queue.fits_any(available))
+        job, = queue.append([MockNode('instances/test/example/0.1.0/2/nodes/any')])
+        self.assertTrue(queue.fits_any(available))
+        queue.remove(job)
+        self.assertFalse(queue.fits_any(available))
+
+    def test_warm_agents_are_preferred(self):
+        queue = utils.JobQueue()
+        queue.append([MockNode('instances/test/example/0.1.0/2/nodes/hadoop',
+                               image='hadoop:2.7')])
+        warm = {'c14-2': set(['hadoop:2.7'])}
+        plans = placement.place(self.offers, queue, placement.FIRST_FIT,
+                                scoring=scoring.Scoring({'image': 1.0}, warm=warm))
+        self.assertEqual(self.placed(plans), [[], ['hadoop']])
+        # Cold agents are used if the job does not fit in the warm ones
+        warm = {'c14-3': set(['hadoop:2.7'])}
+        plans = placement.place(self.offers, queue, placement.FIRST_FIT,
+                                scoring=scoring.Scoring({'image': 1.0}, warm=warm))
+        self.assertEqual(self.placed(plans), [['hadoop'], []])
+
+    def test_nodes_of_a_cluster_are_spread(self):
+        queue = utils.JobQueue()
+        queue.append([MockNode('instances/test/example/0.1.0/2/nodes/{}'.format(i))
+                      for i in range(2)])
+        plans = placement.place(self.offers, queue, placement.FIRST_FIT,
+                                scoring=scoring.Scoring({'spread': 1.0}))
+        self.assertEqual(self.placed(plans), [['0'], ['1']])
+        # Agents already running nodes of the cluster are avoided
+        nodes = lambda clusterid: {'c14-1': 1}
+        plans = placement.place(self.offers, queue, placement.FIRST_FIT,
+                                scoring=scoring.Scoring({'spread': 1.0}, nodes=nodes))
+        self.assertEqual(self.placed(plans), [['1'], ['0']])
+
+    def test_preferred_node_is_not_required(self):
+        queue = utils.JobQueue()
+        queue.append([MockNode('instances/test/example/0.1.0/2/nodes/local',
+                               preferred='c14-2')])
+        plans = placement.place(self.offers, queue, placement.FIRST_FIT,
+                                scoring=scoring.Scoring({'locality': 1.0}))
+        self.assertEqual(self.placed(plans), [[], ['local']])
+        plans = placement.place(self.offers[:1], queue, placement.FIRST_FIT,
+                                scoring=scoring.Scoring({'locality': 1.0}))
+        self.assertEqual(self.placed(plans), [['local']])
+
+    def test_least_used_disks_are_selected(self):
+        usage = {'c14-1': {'disk1': 3}}
+        plans = placement.place(self.offers, self.queue, placement.FIRST_FIT,
+                                scoring=scoring.Scoring({}, disk_usage=usage))
+        self.assertEqual(plans[0].assignments[0][1], ['disk2'])
+
+
+    def test_unavailable_disks_are_left_out(self):
+        plans = placement.place(self.offers, self.queue, placement.FIRST_FIT,
+                                unavailable={'c14-1': set(['disk1'])})
+        self.assertEqual(self.placed(plans), [['big'], ['small']])
+        self.assertEqual(plans[0].assignments[0][1], ['disk2'])
+
+
+class ScoringTestCase(unittest.TestCase):
+
+    def test_unknown_scorer(self):
+        self.assertRaises(ValueError, scoring.Scoring, {'random': 1.0})
+
+    def test_disabled_scorers(self):
+        self.assertFalse(scoring.Scoring({'spread': 0, 'image': 0}))
+        self.assertTrue(scoring.Scoring())
+
+    def test_disks_score_prefers_more_free_disks(self):
+        job = utils.Job(MockNode('instances/test/example/0.1.0/2/nodes/0'))
+        plans = [placement.Plan(make_offer('c14-1', disks=('disk1', 'disk2'))),
+                 placement.Plan(make_offer('c14-2', disks=('disk1',)))]
+        weights = scoring.Scoring({'disks': 1.0})
+        self.assertEqual([weights.score(plan, job) for plan in plans], [0.5, 0.0])
+
+    def test_running_nodes_are_looked_up_once_per_cluster(self):
+        calls = []
+        weights = scoring.Scoring(nodes=lambda clusterid: calls.append(clusterid) or {})
+        weights.running('a')
+        weights.running('a')
+        self.assertEqual(calls, ['a'])
+
+
+class OfferPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = pool.OfferPool(size=2, window=5)
+        self.offers = [make_offer('c14-{}'.format(i)) for i in range(3)]
+
+    def test_oldest_offers_are_evicted(self):
+        self.assertEqual(self.pool.add(self.offers[:2], now=100), [])
+        self.assertEqual(self.pool.add(self.offers[2:], now=101), [self.offers[0]])
+        self.assertEqual(self.pool.offers(), self.offers[1:])
+
+    def test_expire(self):
+        self.pool.add(self.offers[:1], now=100)
+        self.pool.add(self.offers[1:2], now=103)
+        self.assertEqual(self.pool.expire(now=104), [])
+        self.assertEqual(self.pool.expire(now=105), [self.offers[0]])
+        self.assertEqual(self.pool.offers(), [self.offers[1]])
+
+    def test_remove_rescinded_offer(self):
+        self.pool.add(self.offers[:2])
+        self.assertEqual(self.pool.remove(self.offers[0].id.value), self.offers[0])
+        self.assertEqual(self.pool.remove(self.offers[0].id.value), None)
+        self.assertFalse(self.offers[0].id.value in self.pool)
+        self.assertEqual(self.pool.clear(), [self.offers[1]])
+        self.assertEqual(len(self.pool), 0)
+
+
+class BackfillTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = utils.JobQueue()
+        self.queue.append([MockNode('instances/test/example/0.1.0/1/nodes/wide', cpu=8, mem=8192)])
+        self.queue.append([MockNode('instances/test/example/0.1.0/2/nodes/small', cpu=2, mem=2048)])
+        self.queue.append([MockNode('instances/test/example/0.1.0/3/nodes/medium', cpu=4, mem=4096)])
+        self.head = self.queue.head()
+        self.offers = [
+            make_offer('c14-1', cpus=6, mem=6144, disks=('disk1', 'disk2')),
+            make_offer('c14-2', cpus=4, mem=4096, disks=('disk1',)),
+        ]
+
+    def placed(self, plans):
+        return [[job.name.split('--')[-1] for job, _ in plan.assignments]
+                for plan in plans]
+
+    def test_reserved_agent_is_only_backfilled(self):
+        plans = placement.place(self.offers, self.queue, reservation=(self.head, 'c14-1'))
+        # Nothing fits in c14-1 without taking resources the wide job needs
+        self.assertEqual(self.placed(plans), [[], ['small']])
+        self.assertTrue(plans[0].reserved is self.head)
+
+    def test_without_reservation_everything_is_backfilled(self):
+        plans = placement.place(self.offers, self.queue)
+        self.assertEqual(self.placed(plans), [['small', 'medium'], []])
+
+    def test_head_that_fits_takes_the_offer(self):
+        offers = [make_offer('c14-1', cpus=12, mem=12288, disks=('disk1', 'disk2'))]
+        plans = placement.place(offers, self.queue, reservation=(self.head, 'c14-1'))
+        self.assertEqual(self.placed(plans), [['wide', 'small']])
+        self.assertTrue(plans[0].reserved is None)
+
+
+class GangPlacementTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = utils.JobQueue()
+        self.queue.append([
+            MockNode('instances/test/mpi/0.1.0/1/nodes/mpi1', cpu=4, mem=4096),
+            MockNode('instances/test/mpi/0.1.0/1/nodes/mpi2', cpu=4, mem=4096),
+        ])
+        self.queue.append([
+            MockNode('instances/test/mpi/0.1.0/2/nodes/mpi1', cpu=2, mem=2048),
+            MockNode('instances/test/mpi/0.1.0/2/nodes/mpi2', cpu=2, mem=2048),
+        ])
+        self.offers = [make_offer('c14-1', cpus=6, mem=6144, disks=('disk1', 'disk2'))]
+
+    def test_cluster_that_does_not_fit_returns_its_resources(self):
+        plans = placement.place(self.offers, self.queue, gang=True)
+        self.assertEqual([job.cluster for job, _ in plans[0].assignments],
+                         ['instances--test--mpi--0__1__0--2'] * 2)
+        self.assertEqual(plans[0].available.cpus, 2)
+        self.assertEqual(plans[0].available.disks, [])
+
+    def test_without_gang_nodes_are_placed_piecemeal(self):
+        plans = placement.place(self.offers, self.queue)
+        self.assertEqual([job.cluster for job, _ in plans[0].assignments],
+                         ['instances--test--mpi--0__1__0--1',
+                          'instances--test--mpi--0__1__0--2'])
+
+    def test_groups_by_cluster(self):
+        offers = self.offers + [make_offer('c14-2', cpus=6, mem=6144,
+                                           disks=('disk1', 'disk2'))]
+        plans = placement.place(offers, self.queue, gang=True)
+        groups = placement.groups(plans, gang=True)
+        self.assertEqual([len(group) for group in groups], [2, 2])
+        self.assertEqual(len(placement.groups(plans)), 4)
+
+    def test_reservation_is_ignored_in_gang_mode(self):
+        head = self.queue.head()
+        plans = placement.place(self.offers, self.queue, gang=True,
+                                reservation=(head, 'c14-1'))
+        # Reserving c14-1 for one node of the first cluster would not let
+        # its gang fit and would keep the second cluster out
+        self.assertEqual([job.cluster for job, _ in plans[0].assignments],
+                         ['instances--test--mpi--0__1__0--2'] * 2)
+        self.assertTrue(plans[0].reserved is None)
+
+
+# The scheduler uses package relative imports, so this directory is loaded as
+# a package without initializing the Flask application of its parent
+bigdata = imp.new_module('bigdata')
+bigdata.__path__ = [os.path.dirname(os.path.abspath(__file__))]
+sys.modules['bigdata'] = bigdata
+scheduler = importlib.import_module('bigdata.scheduler')
+
+
+class MockSchedulerDriver(object):
+    def __init__(self):
+        self.launched = []
+        self.declined = []
+        self.suppressed = 0
+        self.revived = 0
+        self.launching = threading.Event()
+        self.thread = None
+
+    def launchTasks(self, offer_id, tasks, filters=None):
+        self.launched.extend(task.task_id.value for task in tasks)
+        self.thread = threading.current_thread().name
+        self.launching.set()
+
+    def declineOffer(self, offer_id, filters=None):
+        refuse_seconds = filters.refuse_seconds if filters is not None else None
+        self.declined.append((offer_id.value, refuse_seconds))
+
+    def suppressOffers(self):
+        self.suppressed += 1
+
+    def reviveOffers(self):
+        self.revived += 1
+
+    def reconcileTasks(self, statuses):
+        pass
+
+    def sendFrameworkMessage(self, executor_id, slave_id, message):
+        pass
+
+
+class SchedulerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.kv = registry._kv
+        self.client = scheduler.utils.disks_client
+        scheduler.utils.connect_registry(scheduler.utils.MEMORY)
+        scheduler.utils.connect_disks_service(backend=scheduler.utils.MEMORY)
+        self.directory = tempfile.mkdtemp()
+        self.journal = journal.Journal(os.path.join(self.directory, 'journal'))
+        executor_info = mesos_pb2.ExecutorInfo()
+        executor_info.executor_id.value = 'BigDataExecutor'
+        self.scheduler = scheduler.BigDataScheduler(executor_info, journal=self.journal)
+        self.driver = self.scheduler.driver = MockSchedulerDriver()
+
+    def tearDown(self):
+        self.scheduler.stop()
+        self.scheduler.writer.stop()
+        self.journal.close()
+        shutil.rmtree(self.directory)
+        registry._kv = self.kv
+        scheduler.utils.disks_client = self.client
+
+    def add_cluster(self, name, nodes=1, cpu=1, mem=1024):
+        clusterdn = 'instances/test/example/0.1.0/{}'.format(name)
+        for i in range(nodes):
+            nodedn = '{}/nodes/example{}'.format(clusterdn, i + 1)
+            registry._kv.set(nodedn + '/cpu', cpu)
+            registry._kv.set(nodedn + '/mem', mem)
+            registry._kv.set(nodedn + '/status', '')
+            registry._kv.set(nodedn + '/disks/disk1/origin', '')
+        return registry.Cluster(clusterdn)
+
+    def test_unknown_cluster_submission_fails_without_writes(self):
+        self.add_cluster('1')
+        keys = list(registry._kv.keys)
+        self.assertRaises(kvstore.KeyDoesNotExist, self.scheduler.enqueue,
+                          registry.Cluster('instances/test/example/0.1.0/2'))
+        self.scheduler.writer.flush()
+        self.assertEqual(registry._kv.keys, keys)
+        self.assertEqual(len(self.scheduler.queue), 0)
+
+    def test_nodes_are_marked_as_queued_in_the_background(self):
+        cluster = self.add_cluster('1', nodes=2)
+        # Hold the background thread while the cluster is enqueued
+        blocker = MockBlockingObject()
+        self.scheduler.writer.set('0', blocker, 'status', 'blocked')
+        blocker.started.wait()
+        self.scheduler.enqueue(cluster)
+        self.assertEqual([node.status for node in cluster.nodes], [''] * 2)
+        blocker.release.set()
+        self.scheduler.writer.flush()
+        self.assertEqual([node.status for node in cluster.nodes], ['queued'] * 2)
+
+    def test_offers_are_suppressed_when_idle_and_revived_for_new_jobs(self):
+        offer = make_offer('c14-1')
+        self.scheduler.resourceOffers(self.driver, [offer])
+        self.assertEqual(self.driver.declined, [(offer.id.value, scheduler.REFUSE_SECONDS)])
+        self.assertEqual(self.driver.suppressed, 1)
+        self.scheduler.enqueue(self.add_cluster('1'))
+        self.assertEqual(self.driver.revived, 1)
+        # Offers are not suppressed or filtered anymore
+        self.scheduler.enqueue(self.add_cluster('2'))
+        self.assertEqual(self.driver.revived, 1)
+
+    def test_agents_where_no_job_fits_are_refused(self):
+        self.scheduler.enqueue(self.add_cluster('1', cpu=8))
+        offer = make_offer('c14-1', cpus=4)
+        self.scheduler.resourceOffers(self.driver, [offer])
+        self.assertEqual(self.driver.declined, [(offer.id.value, scheduler.REFUSE_SECONDS)])
+        self.assertEqual(self.driver.suppressed, 0)
+        # It does not fit in the refused agent either
+        self.scheduler.enqueue(self.add_cluster('2', cpu=8))
+        self.assertEqual(self.driver.revived, 0)
+        self.scheduler.enqueue(self.add_cluster('3', cpu=2))
+        self.assertEqual(self.driver.revived, 1)
+        # The filters were cleared by reviving
+        self.scheduler.enqueue(self.add_cluster('4', cpu=2))
+        self.assertEqual(self.driver.revived, 1)
+
+    def test_no_reservation_in_gang_mode(self):
+        self.scheduler.enqueue(self.add_cluster('1', cpu=8))
+        self.scheduler.capacity['c14-1'] = utils.Resources(8, 8192, ['disk1'], 'c14-1')
+        head, hostname = self.scheduler.reserve()
+        self.assertEqual(hostname, 'c14-1')
+        self.scheduler.gang = True
+        self.assertEqual(self.scheduler.reserve(), None)
+
+    def test_expired_filters_do_not_revive(self):
+        self.scheduler.refuse_seconds = 0
+        self.scheduler.enqueue(self.add_cluster('1', cpu=8))
+        self.scheduler.resourceOffers(self.driver, [make_offer('c14-1', cpus=4)])
+        self.scheduler.enqueue(self.add_cluster('2', cpu=2))
+        self.assertEqual(self.driver.revived, 0)
+
+    def test_pooled_offers_are_used_by_the_sweeper_thread(self):
+        self.scheduler.pool.add([make_offer('c14-1')])
+        self.scheduler.enqueue(self.add_cluster('1'))
+        self.assertTrue(self.driver.launching.wait(5))
+        self.assertEqual(self.driver.thread, 'OfferSweeper')
+        self.assertEqual(len(self.scheduler.pool), 0)
+
+    def test_disks_are_read_outside_the_placement_lock(self):
+        client = scheduler.utils.disks_client
+        get_many_host_disks = client.get_many_host_disks
+        free = []
+
+        def try_placing():
+            if self.scheduler.placing.acquire(False):
+                self.scheduler.placing.release()
+                free.append(True)
+            else:
+                free.append(False)
+
+        def read(hosts):
+            thread = threading.Thread(target=try_placing)
+            thread.start()
+            thread.join()
+            return get_many_host_disks(hosts)
+
+        client.get_many_host_disks = read
+        self.scheduler.enqueue(self.add_cluster('1'))
+        self.scheduler.resourceOffers(self.driver, [make_offer('c14-1')])
+        self.assertEqual(free, [True])
+        self.assertEqual(len(self.driver.launched), 1)
+
+    def test_job_launched_while_being_enqueued_is_journaled_as_running(self):
+        cluster = self.add_cluster('1')
+        extend = self.scheduler.queue.extend
+
+        def extend_and_launch(jobs):
+            extend(jobs)
+            # The driver thread places the jobs as soon as they are visible
+            self.scheduler.resourceOffers(self.driver, [make_offer('c14-1')])
+
+        self.scheduler.queue.extend = extend_and_launch
+        self.scheduler.enqueue(cluster)
+        name = registry.id_from('{}/nodes/example1'.format(cluster))
+        self.assertEqual(self.driver.launched, [name])
+        queued, running = journal.Journal(self.journal.path).replay()
+        self.assertEqual(list(queued), [])
+        self.assertEqual(list(running), [name])
+
+
+EXAMPLE_TEMPLATE = json.dumps({
+    'name': '{{ servicename }}',
+    'dn': '{{ instancedn }}',
+    'nodes': dict(('example{}'.format(i), {
+        'name': 'example{}'.format(i),
+        'cpu': 1,
+        'mem': 1024,
+        'disks': {'disk1': {'name': 'disk1', 'origin': '', 'destination': '/data/1'}},
+    }) for i in (1, 2)),
+})
+EXAMPLE_OPTIONS = json.dumps({'required': {'size': 2}, 'optional': {}, 'advanced': {}})
+
+
 class StatusTestCase(unittest.TestCase):
 
     def setUp(self):
-        registry.connect(ENDPOINT)
-        # FIXME: Instantiating/deinstantiating each time is too slow
+        self.kv = registry._kv
+        self.client = utils.disks_client
+        utils.connect_registry(utils.MEMORY)
+        utils.connect_disks_service(backend=utils.MEMORY)
+        utils.disks_client.add_host('c13-1', ['disk1', 'disk2'])
+        registry.register('example', '0.1.0', 'Example service',
+                          template=EXAMPLE_TEMPLATE, options=EXAMPLE_OPTIONS)
         self.cluster = registry.instantiate('test', 'example', '0.1.0', {'size': 2})
         self.node = self.cluster.nodes[0]
         #self.cluster = registry.Cluster('instances/test/example/0.1.0/1')
         #self.node = registry.Node('instances/test/example/0.1.0/1/nodes/example1')
 
     def tearDown(self):
-        # FIXME: Instantiating/deinstatiating each time is too slow
         dn = self.cluster.dn
         id = dn[dn.rfind('/')+1:]
         registry.deinstantiate('test', 'example', '0.1.0', id)
+        registry._kv = self.kv
+        utils.disks_client = self.client
 
     def test_update_cluster_step(self):
         node = self.node
@@ -54,7 +1704,7 @@ class StatusTestCase(unittest.TestCase):
         cluster.progress = 50
         utils.update_cluster_progress(node)
         self.assertEqual(cluster.progress, '100')
-        self.assertEqual(cluster.status, 'executing')
+        self.assertEqual(cluster.status, 'scheduled')
 
     def test_obtain_resources_from_offer(self):
         offer = self.generate_offer(cpus=12, mem=8096, disks=('disk1', 'disk2'))
@@ -137,16 +1787,29 @@ class StatusTestCase(unittest.TestCase):
         self.assertEqual(disks[1].origin, expected)
 
     def test_update_disks_service_allocate(self):
-        raise NotImplementedError
+        nodedn = str(self.node)
+        utils.update_disks_service_allocate('c13-1', ['disk1', 'disk2'], nodedn)
+        for disk in ('disk1', 'disk2'):
+            info = utils.get_disk_info('c13-1', disk)
+            self.assertEqual(info['status'], 'used')
+            self.assertEqual(info['clustername'], nodedn)
+        # Disks used by another node are not allocated
+        self.assertRaises(disks.DiskServiceError, utils.update_disks_service_allocate,
+                          'c13-1', ['disk2'], 'instances/test/example/0.1.0/2/nodes/example1')
 
     def test_set_disk_as_used(self):
-        raise NotImplementedError
+        nodedn = str(self.node)
+        utils.set_disk_as_used('c13-1', nodedn, 'disk2')
+        self.assertEqual(utils.get_disk_info('c13-1', 'disk1')['status'], 'free')
+        info = utils.get_disk_info('c13-1', 'disk2')
+        self.assertEqual(info['status'], 'used')
+        self.assertEqual(info['clustername'], nodedn)
 
     def test_initialize_cluster_status(self):
         cluster = self.cluster
         cluster.status = 'pending'
         utils.initialize_cluster_status(cluster)
-        self.assertEqual(cluster.status, 'queued')
+        self.assertEqual(cluster.status, 'scheduling')
         self.assertEqual(cluster.progress, '0')
 
     def generate_offer(self, cpus=1, mem=1024, disks=('disk1')):
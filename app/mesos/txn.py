@@ -0,0 +1,70 @@
+"""Consul KV transactions
+
+Groups several registry attribute updates in a single request to the Consul
+/v1/txn endpoint, which applies all of them atomically or none of them.
+Consul rejects transactions of more than MAX_OPERATIONS updates, larger ones
+must be split by the caller.
+"""
+from __future__ import print_function
+
+import base64
+import json
+
+import requests
+
+TXN_ENDPOINT = 'http://consul:8500/v1/txn'
+# Maximum number of operations accepted by Consul in a single transaction
+MAX_OPERATIONS = 64
+# Seconds to wait to connect and to receive a response
+TIMEOUT = (2, 10)
+
+
+class TransactionError(Exception):
+    pass
+
+
+def txn_endpoint(kv_endpoint):
+    """Returns the transactions endpoint of the given Consul KV endpoint"""
+    return kv_endpoint.rstrip('/').replace('/v1/kv', '/v1/txn')
+
+
+class Transaction(object):
+    """A list of registry updates to commit together
+
+    Registry objects store each attribute under the key <dn>/<attribute>, the
+    same key used here, so committing the transaction is equivalent to
+    setting the attributes of the objects one by one.
+    """
+    def __init__(self, endpoint=TXN_ENDPOINT, session=None, timeout=TIMEOUT):
+        self.endpoint = endpoint
+        self.session = session or requests.Session()
+        self.timeout = timeout
+        self.operations = []
+
+    def __len__(self):
+        return len(self.operations)
+
+    def set(self, obj, attr, value):
+        """Add the update obj.attr = value to the transaction"""
+        key = '{}/{}'.format(obj, attr).lstrip('/')
+        self.operations.append({'KV': {'Verb': 'set', 'Key': key,
+                                       'Value': base64.b64encode(str(value))}})
+
+    def commit(self):
+        """Apply all the updates
+
+        Raises TransactionError, without applying any of them, if there are
+        more than MAX_OPERATIONS.
+        """
+        if len(self.operations) > MAX_OPERATIONS:
+            raise TransactionError('Transaction of {} operations, the maximum is {}'
+                                   .format(len(self.operations), MAX_OPERATIONS))
+        try:
+            r = self.session.put(self.endpoint, data=json.dumps(self.operations),
+                                 timeout=self.timeout)
+        except requests.RequestException as e:
+            raise TransactionError('Unable to contact the registry: {}'.format(e))
+        if r.status_code != 200:
+            raise TransactionError('Transaction rolled back: {} {}'
+                                   .format(r.status_code, r.text))
+        self.operations = []
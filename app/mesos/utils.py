@@ -1,21 +1,105 @@
 from __future__ import print_function
 
+import heapq
+import itertools
 import logging
-import copy
+import threading
+import time
+from collections import OrderedDict
 
-import requests
 import registry
 from registry import id_from
 
+from disks import DisksClient, DiskServiceError
+from memory import MemoryKV, MemoryDisksClient
+
 
 ENDPOINT = 'http://consul:8500/v1/kv'
 DISKS_ENDPOINT = 'http://disks.service.int.cesga.es:5000/resources/disks/v1'
 
-registry.connect(ENDPOINT)
+# Registry backends: Consul or an in-process key/value store
+CONSUL = 'consul'
+# Disks service backends: the HTTP service or an in-process one
+HTTP = 'http'
+# In-process backend of both the registry and the disks service
+MEMORY = 'memory'
+
+# Priority classes of the submitted clusters, from the most to the least urgent
+INTERACTIVE = 'interactive'
+NORMAL = 'normal'
+BATCH = 'batch'
+PRIORITIES = (INTERACTIVE, NORMAL, BATCH)
+RANKS = dict((priority, rank) for rank, priority in enumerate(PRIORITIES))
+# Seconds a job waits before being promoted to the next priority class
+AGING = 300
+
+# Client of the disks service, set by connect_disks_service
+disks_client = None
+
+
+def connect_registry(backend=CONSUL, endpoint=ENDPOINT):
+    """Select the key/value store used by the registry"""
+    if backend == CONSUL:
+        registry.connect(endpoint)
+    elif backend == MEMORY:
+        registry._kv = MemoryKV()
+    else:
+        raise ValueError('Unknown registry backend: {}'.format(backend))
+
+
+def connect_disks_service(endpoint=DISKS_ENDPOINT, backend=HTTP, **options):
+    """Configure a new client of the disks service
+
+    options are passed to DisksClient, e.g. timeout or max_workers, the
+    in-process backend ignores them.
+    """
+    global disks_client
+    if backend == HTTP:
+        disks_client = DisksClient(endpoint, **options)
+    elif backend == MEMORY:
+        disks_client = MemoryDisksClient()
+    else:
+        raise ValueError('Unknown disks service backend: {}'.format(backend))
+
 
+class Progress(object):
+    """In-memory launching progress of the queued clusters
 
-class DiskServiceError(Exception):
-    pass
+    Allows to compute the cluster step, progress and status without reading
+    them back from the registry for every scheduled node.
+    """
+    def __init__(self):
+        self._steps = {}
+
+    def start(self, clusterid, total, step=0):
+        """Start tracking a cluster with the given number of nodes
+
+        step is the number of nodes already scheduled, e.g. when the queue is
+        restored after a restart.
+        """
+        self._steps[clusterid] = [step, total]
+
+    def advance(self, clusterid):
+        """Account a new scheduled node of the cluster
+
+        Returns the list of (attribute, value) pairs to update in the cluster.
+        """
+        steps = self._steps[clusterid]
+        steps[0] += 1
+        step, total = steps
+        attrs = [('step', step), ('progress', int(float(step) / total * 100))]
+        if step == total:
+            attrs.append(('status', 'scheduled'))
+            del self._steps[clusterid]
+        return attrs
+
+    def requeue(self, clusterid, total):
+        """Account a scheduled node of a cluster with total nodes queued again"""
+        steps = self._steps.get(clusterid)
+        if steps is None:
+            self._steps[clusterid] = [total - 1, total]
+        else:
+            steps[0] -= 1
 
 
 def update_cluster_progress(node):
@@ -31,12 +115,21 @@ def update_cluster_progress(node):
 
 class Resources(object):
     """Represents a set of resources available"""
+    __slots__ = ('cpus', 'mem', 'disks', 'host')
+
     def __init__(self, cpus, mem, disks, host=None):
         self.cpus = cpus
         self.mem = mem
         self.disks = disks
         self.host = host
 
+    def copy(self):
+        """Returns a copy that can be modified without changing this one"""
+        disks = self.disks
+        if isinstance(disks, list):
+            disks = list(disks)
+        return Resources(self.cpus, self.mem, disks, self.host)
+
 
 class Job(object):
     """A Job represents the resource requirements for a given cluster node
@@ -46,49 +139,327 @@ class Job(object):
         mem: MB of memory
         disks: it can be a number or a list of specific disks
         host: if a specific docker engine host is needed
+        locality: the preferred docker engine host, if any, when it is not required
         node: the registry.Node object
+        cluster: the id of the cluster the node belongs to
+        disk_names: names of the disks of the node in the registry
+        required: the Resources requested, computed once when the job is created
+        submitted: time the job was created
+        image: the docker image of the node if known, it can be pulled in advance
+        priority: the priority class of the cluster, one of PRIORITIES
+        attempts: number of times the node was requeued after its task failed
+
+    The attributes of the node are read from view if given (e.g. a
+    snapshot.NodeView) instead of from the registry.
     """
-    def __init__(self, node):
-        self.node = node
-        self.name = registry.id_from(node.dn)
-        self.cpus = int(node.cpu)
-        self.mem = int(node.mem)
+    __slots__ = ('node', 'name', 'cluster', 'cpus', 'mem', 'disk_names', 'disks',
+                 'host', 'required', 'seq', 'slave_id', 'hostname', 'offer_id',
+                 'submitted', 'image', 'priority', 'locality', 'attempts')
 
-        if node.get('use_custom_disks'):
-            self.disks = [disk.name for disk in node.disks]
+    def __init__(self, node, view=None, priority=NORMAL):
+        if view is None:
+            view = node
+        self.node = node
+        self.name = registry.id_from(view.dn)
+        self.cluster = id_from(registry.extract_clusterdn_from_nodedn(str(node)))
+        self.cpus = int(view.cpu)
+        self.mem = int(view.mem)
+
+        self.disk_names = [disk.name for disk in view.disks]
+        if view.get('use_custom_disks'):
+            self.disks = list(self.disk_names)
         else:
-            self.disks = len(node.disks)
+            self.disks = len(self.disk_names)
 
-        if node.get('host') is not None:
-            self.host = node.get('required_node')
+        if view.get('host') is not None:
+            self.host = view.get('required_node')
         else:
             self.host = None
+        self.locality = view.get('required_node')
+
+        self.image = view.get('docker_image')
+        self.priority = priority
+        self.attempts = 0
+        self.required = Resources(self.cpus, self.mem, self.disks, self.host)
+        self.seq = None
+        self.slave_id = None
+        self.hostname = None
+        self.offer_id = None
+        self.submitted = time.time()
+
+    def to_record(self):
+        """Returns a dict with the fields needed to rebuild the job"""
+        return {'name': self.name, 'node': str(self.node), 'cluster': self.cluster,
+                'cpus': self.cpus, 'mem': self.mem, 'disk_names': self.disk_names,
+                'disks': self.disks, 'host': self.host, 'submitted': self.submitted,
+                'image': self.image, 'priority': self.priority,
+                'locality': self.locality, 'attempts': self.attempts}
+
+    @classmethod
+    def from_record(cls, record):
+        """Rebuild a job from a record created by to_record without reading the registry"""
+        job = cls.__new__(cls)
+        job.node = registry.Node(record['node'])
+        job.name = record['name']
+        job.cluster = record['cluster']
+        job.cpus = record['cpus']
+        job.mem = record['mem']
+        job.disk_names = record['disk_names']
+        job.disks = record['disks']
+        job.host = record['host']
+        job.locality = record.get('locality')
+        job.image = record.get('image')
+        job.priority = record.get('priority', NORMAL)
+        job.attempts = record.get('attempts', 0)
+        job.required = Resources(job.cpus, job.mem, job.disks, job.host)
+        job.seq = None
+        job.slave_id = record.get('slave_id')
+        job.hostname = record.get('hostname')
+        job.offer_id = None
+        job.submitted = record.get('submitted', time.time())
+        return job
+
+
+def jobs_from(nodes, snapshot=None, priority=NORMAL):
+    """Returns the jobs of the given nodes with the given priority class
+
+    If a snapshot.ClusterSnapshot of the cluster is given the jobs are built
+    from it instead of reading each node from the registry.
+    """
+    if priority not in RANKS:
+        raise ValueError('Unknown priority class: {}'.format(priority))
+    if snapshot is not None:
+        return [Job(node, snapshot.view(node), priority) for node in nodes]
+    return [Job(node, priority=priority) for node in nodes]
 
 
 class JobQueue(object):
-    """A job queue"""
+    """A job queue indexed by required host and resource shape
+
+    Jobs are kept in submission order keyed by name, so they can be removed in
+    constant time. The same jobs are also grouped by the host they require
+    (None if any host is valid), by their (cpus, mem, disks) shape and by
+    their priority class, so an offer only needs to look at the buckets that
+    could fit into it.
+
+    Jobs are served by priority and then in FIFO order. A job is promoted to
+    the next priority class every `aging` seconds it waits, so low priority
+    jobs are never starved. The jobs of a bucket are always in the same order
+    with aging, so buckets can still be merged instead of sorted.
+
+    Jobs are appended from the REST API threads while the scheduler driver
+    thread looks for candidates and removes them, so the queue is protected by
+    a lock.
+    """
 
-    def __init__(self):
-        self._queue = []
+    def __init__(self, aging=AGING):
+        self.aging = aging
+        self._queue = OrderedDict()
+        self._index = {}
+        # Number of jobs of each (host, bucket) that do not ask for specific disks
+        self._flexible = {}
+        self._clusters = {}
+        self._seq = itertools.count()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def __iter__(self):
+        """Iterate over the queued jobs in FIFO order without copying them"""
+        return self._queue.itervalues()
+
+    def __contains__(self, name):
+        return name in self._queue
+
+    def get(self, name):
+        """Returns the queued job with the given name or None"""
+        return self._queue.get(name)
 
     def pending(self):
         """Returns the list of pending jobs"""
-        return copy.copy(self._queue)
-
-    def append(self, nodes):
-        """Adds the given node list to the to the queue"""
-        for node in nodes:
-            job = Job(node)
-            #job = Job(clusterid=node.clusterid,
-                      #name=node.clusterid + '_' + node.name,
-                      #node_dn=str(node),
-                      #cpus=int(node.cpu), mem=int(node.mem))
-            node.status = 'queued'
-            self._queue.append(job)
+        with self._lock:
+            return self._queue.values()
+
+    def cluster_jobs(self, clusterid):
+        """Returns, in FIFO order, the queued jobs of the given cluster"""
+        with self._lock:
+            return self._clusters.get(clusterid, {}).values()
+
+    def rank(self, job, now=None):
+        """Returns the priority rank of a job after aging, 0 is the most urgent"""
+        return self.sort_key(now)(job)[0]
+
+    def sort_key(self, now=None):
+        """Returns a key function to sort jobs in the order they are served"""
+        now = now or time.time()
+        aging = self.aging
+
+        def key(job):
+            rank = RANKS[job.priority]
+            if rank and aging:
+                rank = max(0, rank - int((now - job.submitted) / aging))
+            return rank, job.seq
+        return key
+
+    def head(self):
+        """Returns the job that would be served first or None if it is empty"""
+        key = self.sort_key()
+        with self._lock:
+            firsts = [next(bucket.itervalues())
+                      for buckets in self._index.itervalues()
+                      for bucket in buckets.itervalues()]
+        return min(firsts, key=key) if firsts else None
+
+    def append(self, nodes, snapshot=None, priority=NORMAL):
+        """Adds the given node list to the to the queue
+
+        If a snapshot.ClusterSnapshot of the cluster is given the jobs are
+        built from it instead of reading each node from the registry.
+        Returns the new jobs. The caller is responsible for marking their
+        nodes as queued, e.g. in the background.
+        """
+        jobs = jobs_from(nodes, snapshot, priority)
+        self.extend(jobs)
+        return jobs
+
+    def extend(self, jobs):
+        """Adds already built jobs, e.g. new, rebuilt after a restart or requeued
+
+        All the jobs are made visible at once so a gang is never placed while
+        it is still being added. The caller is responsible for marking their
+        nodes as queued.
+        """
+        with self._lock:
+            for job in jobs:
+                self._push(job)
+
+    def _push(self, job):
+        """Adds an already built job to the queue and its indexes"""
+        job.seq = next(self._seq)
+        self._queue[job.name] = job
+        # Buckets are only built when missing, building an OrderedDict is slow
+        jobs = self._clusters.get(job.cluster)
+        if jobs is None:
+            jobs = self._clusters[job.cluster] = OrderedDict()
+        jobs[job.name] = job
+        buckets = self._index.setdefault(job.host, {})
+        key = bucket_of(job)
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = OrderedDict()
+        bucket[job.name] = job
+        if not has_specific_disks(job):
+            self._flexible[(job.host, key)] = self._flexible.get((job.host, key), 0) + 1
 
     def remove(self, job):
         """Removed the given job from the queue"""
-        self._queue.remove(job)
+        with self._lock:
+            self._remove(job)
+
+    def _remove(self, job):
+        del self._queue[job.name]
+        jobs = self._clusters[job.cluster]
+        del jobs[job.name]
+        if not jobs:
+            del self._clusters[job.cluster]
+        buckets = self._index[job.host]
+        key = bucket_of(job)
+        bucket = buckets[key]
+        del bucket[job.name]
+        if not has_specific_disks(job):
+            flexible = self._flexible[(job.host, key)] - 1
+            if flexible:
+                self._flexible[(job.host, key)] = flexible
+            else:
+                del self._flexible[(job.host, key)]
+        if not bucket:
+            del buckets[key]
+            if not buckets:
+                del self._index[job.host]
+
+    def fits_any(self, available):
+        """Verify if any queued job fits in the given resources
+
+        Unlike candidates it only looks at the shape of each bucket. The jobs
+        of a bucket are only checked one by one if all of them ask for
+        specific disks.
+        """
+        if available.disks is None:
+            return False
+        ndisks = len(available.disks)
+        with self._lock:
+            for host in set([None, available.host]):
+                for key, bucket in self._index.get(host, {}).iteritems():
+                    cpus, mem, disks, _ = key
+                    if cpus <= available.cpus and mem <= available.mem and disks <= ndisks:
+                        if (host, key) in self._flexible:
+                            return True
+                        # Only jobs asking for specific disks may not fit
+                        for job in bucket.itervalues():
+                            if offer_has_enough_resources(available, job.required):
+                                return True
+        return False
+
+    def candidates(self, available, hosts=None):
+        """Returns, in serving order, the jobs whose shape fits the given resources
+
+        Only jobs without a host constraint or requiring one of the given
+        hosts (by default available.host) are considered. The result is a new
+        list so the queue can be modified while iterating over it.
+        """
+        if available.disks is None:
+            return []
+        ndisks = len(available.disks)
+        if hosts is None:
+            hosts = [available.host]
+        hosts = [None] + [host for host in hosts if host is not None]
+        key = self.sort_key()
+        buckets = []
+        with self._lock:
+            for host in hosts:
+                for (cpus, mem, disks, _), bucket in self._index.get(host, {}).iteritems():
+                    if cpus <= available.cpus and mem <= available.mem and disks <= ndisks:
+                        buckets.append(bucket)
+            if len(buckets) == 1:
+                return buckets[0].values()
+            return [job for _, _, job in heapq.merge(*[_keyed(bucket, key)
+                                                      for bucket in buckets])]
+
+
+def _keyed(bucket, key):
+    """Yields (rank, seq, job) tuples of a bucket so buckets can be merged in order
+
+    All the jobs of a bucket have the same priority class and ranks only grow
+    along it, so once a job is not promoted the rest are not either.
+    """
+    jobs = bucket.itervalues()
+    for job in jobs:
+        rank, seq = key(job)
+        yield rank, seq, job
+        if rank == RANKS[job.priority]:
+            break
+    for job in jobs:
+        yield rank, job.seq, job
+
+
+def bucket_of(job):
+    """Returns the (cpus, mem, number of disks, priority) bucket of a job"""
+    return shape_of(job) + (job.priority,)
+
+
+def has_specific_disks(job):
+    """Verify if a job asks for a specific list of disks instead of a number"""
+    return isinstance(job.disks, list) or isinstance(job.disks, tuple)
+
+
+def shape_of(job):
+    """Returns the (cpus, mem, number of disks) shape of a job"""
+    if has_specific_disks(job):
+        ndisks = len(job.disks)
+    else:
+        ndisks = job.disks
+    return job.cpus, job.mem, ndisks
 
 
 def match_host(offered, required):
@@ -115,19 +486,21 @@ def has_enough_disks(offered, required):
 
 def get_disk_info(host, disk):
     """Get disk info from the disks service"""
-    r = requests.get(DISKS_ENDPOINT + "/{}/disks/{}".format(host, disk))
-    if r.status_code == 200:
-        return r.json()[disk]
-    else:
-        raise DiskServiceError('Unable to get information from the disks service')
+    return disks_client.get_disk_info(host, disk)
+
 
+def select_disks(offered, required, usage=None):
+    """Select the disks to be used
 
-def select_disks(offered, required):
-    """Select the disks to be used"""
+    usage is an optional dict with the number of times each disk was
+    allocated, the least used disks are selected first.
+    """
     # If a specific list of disks is requested this are the selected disks
     if isinstance(required, list) or isinstance(required, tuple):
         return required
     # In other case just a given number of disks is requested
+    if usage:
+        offered = sorted(offered, key=lambda disk: usage.get(disk, 0))
     selected = offered[:required]
 
     return selected
@@ -135,23 +508,42 @@ def select_disks(offered, required):
 
 def update_disks_service_allocate(host, disks, nodedn):
     """Set disks as used in the disks service"""
-    for disk in disks:
-        set_disk_as_used(host, nodedn, disk)
+    disks_client.allocate(host, disks, nodedn)
+
+
+def allocate_disks(allocations):
+    """Set disks as used in the disks service for many nodes in parallel
+
+    allocations is a list of (host, disks, nodedn) tuples. Returns the list
+    of errors of each allocation (None if it succeeded).
+    """
+    return disks_client.allocate_many(allocations)
+
+
+def release_disks(releases):
+    """Set disks as free in the disks service for many nodes in parallel
+
+    releases is a list of (host, disks, nodedn) tuples. Returns the list of
+    errors of each release (None if it succeeded).
+    """
+    return disks_client.release_many(releases)
 
 
 def set_disk_as_used(host, nodedn, disk):
     """Set the disk as used in the disks service"""
-    payload = {'status': 'used', 'clustername': nodedn, 'node': host}
-    r = requests.put(DISKS_ENDPOINT + "/{}/disks/{}".format(host, disk), data=payload)
-    if r.status_code != 204:
-        raise DiskServiceError('Error setting disk as used in the disks service')
+    disks_client.set_disk_as_used(host, nodedn, disk)
 
 
 def update_disks_origin(disks, allocations, nodedn):
     """Update the disk.origin of each Disk object"""
     for disk, name in zip(disks, allocations):
-        number = name.replace('disk', '')
-        disk.origin = '/data/{}/{}'.format(number, id_from(nodedn))
+        disk.origin = disk_origin(name, nodedn)
+
+
+def disk_origin(allocation, nodedn):
+    """Returns the origin path of a disk allocated to the given node"""
+    number = allocation.replace('disk', '')
+    return '/data/{}/{}'.format(number, id_from(nodedn))
 
 
 def remove_disks(offered, used):
@@ -173,21 +565,22 @@ def offer_has_enough_resources(available, required):
 
 def resources_from_offer(offer):
     """Returns the available resources in the offer"""
+    cpus = mem = 0
+    disks = None
     for resource in offer.resources:
-        if resource.name == "cpus":
+        name = resource.name
+        if name == "cpus":
             cpus = resource.scalar.value
-        if resource.name == "mem":
+        elif name == "mem":
             mem = resource.scalar.value
-        disks = None
-        if resource.name == "dataDisks":
-            disks = resource.set.item
-    host = offer.hostname
-    return Resources(cpus=cpus, mem=mem, disks=disks, host=host)
+        elif name == "dataDisks":
+            disks = list(resource.set.item)
+    return Resources(cpus, mem, disks, offer.hostname)
 
 
 def resources_from_job(job):
     """Returns the requested resources in the job"""
-    return Resources(cpus=job.cpus, mem=job.mem, disks=job.disks, host=job.host)
+    return job.required
 
 
 def initialize_cluster_status(cluster):
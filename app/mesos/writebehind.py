@@ -0,0 +1,163 @@
+"""Write-behind of registry updates
+
+The Mesos driver invokes all the scheduler callbacks from a single thread, so
+any blocking request to the registry made inside them delays the processing
+of offers and status updates. Instead the callbacks record the attributes to
+update in a WriteBehind object and a background thread writes them.
+
+Pending writes are grouped by cluster. Several writes of the same attribute
+of the same object are coalesced, only the last value is written. The writes
+of a cluster are applied in the order they were made and clusters are
+flushed in the order they were first updated.
+
+If a Consul transactions endpoint is given, all the pending writes of a
+cluster are committed in a single transaction, so readers never see a
+partial update (e.g. a new progress with an old status). Writes made inside
+a batch() block, e.g. during an offer cycle, are only flushed when the block
+ends so they end up in the same transaction. Batches can be nested or
+overlap, the writes are held until the last open one ends.
+
+Consul limits the size of a transaction, so the writes of a cluster that do
+not fit in one (more than txn.MAX_OPERATIONS) are split in several. Then
+readers may see the updates of some of its nodes before the rest, but the
+attributes of the cluster itself (e.g. its status) go in the last one, so
+they are never ahead of the nodes. If a transaction fails the writes are
+applied one by one.
+"""
+from __future__ import print_function
+
+import logging
+import Queue
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import requests
+
+import registry
+
+import metrics
+import txn
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class WriteBehind(object):
+    """Background writer of registry attributes"""
+
+    def __init__(self, txn_endpoint=None):
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._held = None
+        # Number of batch() blocks open
+        self._depth = 0
+        self.txn_endpoint = txn_endpoint
+        self._session = requests.Session()
+        # Keys with writes to flush. Callers never block on it, e.g. the
+        # driver callbacks while placing, and it has at most one entry per
+        # key because the writes of a key are coalesced while pending
+        self._ready = Queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='WriteBehind')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def set(self, key, obj, attr, value):
+        """Schedule setting obj.attr = value, grouping it under the given key
+
+        obj is a registry object (e.g. Cluster, Node or Disk) and key is
+        usually the id of the cluster it belongs to.
+        """
+        with self._lock:
+            writes = self._pending.get(key)
+            new = writes is None
+            if new:
+                writes = self._pending[key] = OrderedDict()
+            # Move coalesced writes to the end to keep the order of updates
+            writes.pop((str(obj), attr), None)
+            writes[(str(obj), attr)] = (obj, attr, value)
+            if new and self._held is not None:
+                self._held.append(key)
+                new = False
+        if new:
+            self._ready.put(key)
+
+    @contextmanager
+    def batch(self):
+        """Hold the writes made inside the block until it and any other open
+        batch end"""
+        with self._lock:
+            self._depth += 1
+            if self._held is None:
+                self._held = []
+        try:
+            yield
+        finally:
+            held = ()
+            with self._lock:
+                self._depth -= 1
+                if not self._depth:
+                    held, self._held = self._held, None
+            for key in held:
+                self._ready.put(key)
+
+    def flush(self):
+        """Block until all the writes scheduled so far have been applied"""
+        self._ready.join()
+
+    def stop(self):
+        """Apply all the pending writes and stop the background thread"""
+        self._ready.put(_STOP)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            key = self._ready.get()
+            try:
+                if key is _STOP:
+                    return
+                with self._lock:
+                    writes = self._pending.pop(key)
+                with metrics.REGISTRY_SECONDS.time(operation='write'):
+                    self.write(key, writes.values())
+            except Exception:
+                # The thread must survive, or every later write would be lost
+                logger.exception('Unable to write the updates of {}'.format(key))
+            finally:
+                self._ready.task_done()
+
+    def write(self, key, writes):
+        """Apply the given (obj, attr, value) writes of a cluster"""
+        if self.txn_endpoint:
+            try:
+                self.commit(key, writes)
+                return
+            except txn.TransactionError as e:
+                logger.warn('Unable to commit the updates of {} in transactions, '
+                            'writing them one by one: {}'.format(key, e))
+        for obj, attr, value in writes:
+            try:
+                setattr(obj, attr, value)
+            except Exception:
+                logger.exception('Unable to set {} of {}'.format(attr, obj))
+
+    def commit(self, key, writes):
+        """Commit the writes of a cluster in as few transactions as possible
+
+        The writes of the cluster object itself, whose id is the key, go in
+        the last transaction.
+        """
+        last = [write for write in writes if registry.id_from(str(write[0])) == key]
+        rest = [write for write in writes if registry.id_from(str(write[0])) != key]
+        chunks = [rest[i:i + txn.MAX_OPERATIONS]
+                  for i in range(0, len(rest), txn.MAX_OPERATIONS)]
+        if chunks and len(chunks[-1]) + len(last) <= txn.MAX_OPERATIONS:
+            chunks[-1].extend(last)
+        elif last:
+            chunks.append(last)
+        for chunk in chunks:
+            transaction = txn.Transaction(self.txn_endpoint, session=self._session)
+            for obj, attr, value in chunk:
+                transaction.set(obj, attr, value)
+            transaction.commit()
@@ -0,0 +1,5 @@
+#!/bin/bash
+# Micro-benchmarks of the offer parsing and fit checks
+(cd app/mesos && python benchmarks.py)
+# Offer cycle of the scheduler with a fake driver and in-memory backends
+python -m app.mesos.benchmarks scheduler "$@"
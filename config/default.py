@@ -0,0 +1,66 @@
+# Settings shared by all the environments, loaded before the file of the
+# environment (FLASK_CONFIG) which only gives the ones that differ. The
+# optional behaviours (gang scheduling, best-fit, registry transactions and
+# the journal) are disabled here and must be enabled explicitly.
+
+# Bin-packing policy used to place jobs: first-fit, best-fit or worst-fit
+PLACEMENT_POLICY = 'first-fit'
+# Weight of each placement scorer (spread, disks, locality, image), 0 disables it
+PLACEMENT_WEIGHTS = {'spread': 1.0, 'disks': 0.5, 'locality': 2.0, 'image': 1.0}
+# Launch all the nodes of a cluster together or none of them
+GANG_SCHEDULING = False
+# Times a failed or lost node is queued again before giving up
+TASK_RETRIES = 3
+# Seconds before queueing again a failed node, doubled on every attempt
+TASK_RETRY_BACKOFF = 10
+# Seconds a queued job waits before being promoted to the next priority class
+PRIORITY_AGING = 300
+# Keep free in an agent the resources of the head of the queue (EASY backfill),
+# not used with GANG_SCHEDULING
+BACKFILL_RESERVATION = True
+# Registry backend: consul or memory (in-process, for tests and local runs)
+REGISTRY_BACKEND = 'consul'
+REGISTRY_ENDPOINT = 'http://consul:8500/v1/kv'
+# Disks service backend: http or memory (in-process, for tests and local runs)
+DISKS_BACKEND = 'http'
+DISKS_ENDPOINT = 'http://disks.service.int.cesga.es:5000/resources/disks/v1'
+# Seconds to wait to connect and to receive a response from the disks service
+DISKS_TIMEOUT = (2, 5)
+# Maximum number of hosts whose disks are allocated in parallel
+DISKS_MAX_WORKERS = 8
+# Seconds the status of the disks of a host is cached before reading it again
+DISKS_INVENTORY_TTL = 30
+# Seconds between two batches of disks released after their tasks ended
+DISKS_RELEASE_INTERVAL = 1
+# Seconds between two reconciliations of the disks service with the live tasks
+DISKS_SWEEP_INTERVAL = 300
+# Commit the registry updates of each cluster in a single Consul transaction,
+# or in several with the cluster status in the last one if they do not fit
+REGISTRY_TRANSACTIONS = False
+# Seconds a cluster definition read from the registry is cached
+SNAPSHOT_TTL = 30
+# Seconds to refuse offers from agents where no queued job fits
+OFFER_REFUSE_SECONDS = 300
+# Seconds an unused offer is kept in the pool before it is declined
+OFFER_POOL_WINDOW = 5
+# Maximum number of unused offers kept in the pool
+OFFER_POOL_SIZE = 100
+# Number of clusters of a bulk submission enqueued in parallel
+INGEST_WORKERS = 4
+# File where the job queue is journaled to restore it after a restart, e.g.
+# /var/lib/bigdata-scheduler/journal, None to disable the journal
+JOURNAL_PATH = None
+# Number of journal entries written before compacting it into a snapshot
+JOURNAL_COMPACT_EVERY = 10000
+# Maximum number of containers being started at the same time by each executor
+EXECUTOR_WORKERS = 4
+# Seconds the start of a task (pulling its image) can take, 0 for no timeout
+EXECUTOR_TASK_TIMEOUT = 0
+# Maximum number of containers destroyed at the same time by each executor
+EXECUTOR_DESTROY_WORKERS = 8
+# Seconds the executor waits for the containers to be destroyed
+EXECUTOR_DESTROY_TIMEOUT = 60
+# Maximum number of docker images pulled in advance kept in each agent
+EXECUTOR_IMAGE_CACHE_SIZE = 20
+# Minimum seconds between two progress messages sent by each executor
+EXECUTOR_PROGRESS_INTERVAL = 1
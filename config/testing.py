@@ -6,3 +6,6 @@ DEBUG = False
 IGNORE_AUTH = True
 SECRET_KEY = 'admin'
 MESOS_MASTER = 'mesosmaster.service.int.cesga.es:5050'
+# In-process registry and disks service
+REGISTRY_BACKEND = 'memory'
+DISKS_BACKEND = 'memory'
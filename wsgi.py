@@ -25,7 +25,7 @@ setup_flask_logging()
 
 # Initialize a mesos framework instance
 master = application.config.get('MESOS_MASTER')
-mesos.framework.start(master)
+mesos.framework.start(master, application.config)
 
 if __name__ == '__main__':
     application.run(threaded=False, port=6001)